@@ -0,0 +1,74 @@
+# Benchmark: SEARCH/REPLACE patch edits vs. regenerating the whole script for LLM fixes.
+# Output tokens dominate fix latency (decode is sequential), so the model side is estimated from the reply size
+# with --tokens-per-second/--ttft; applying the patch (exact, re-indented and fuzzy matches) is measured.
+# Usage: python benchmarks/bench_patch_edits.py [--lines 200,1000,4000] [--tokens-per-second 60] [--ttft 0.8]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import poop
+
+
+def synthetic_script(line_count, seed=11):
+    rng = random.Random(seed)
+    parts = ["import os", "import sys", "import math", ""]
+    function_index = 0
+    while len("\n".join(parts).splitlines()) < line_count:
+        body = [f"    value_{j} = value_{j - 1} * {rng.randint(2, 9)} + math.sqrt({rng.randint(1, 99)})" if j else f"    value_0 = argument + {rng.randint(1, 9)}"
+                for j in range(rng.randint(6, 18))]
+        parts += [f"def compute_{function_index}(argument):", *body, f"    return value_{len(body) - 1}", ""]
+        function_index += 1
+    parts += ["if __name__ == '__main__':", "    print(compute_0(1))", ""]
+    return "\n".join(parts), function_index
+
+def fix_scenarios(script, function_count):
+    # (name, SEARCH/REPLACE reply, fully regenerated script) for typical fixes in the middle of the script.
+    target = f"def compute_{function_count // 2}(argument):\n"
+    start = script.index(target)
+    header_line = target.rstrip("\n")
+    body_line = script[start + len(target):script.index("\n", start + len(target))]
+    fixed_body_line = body_line.replace("argument +", "float(argument) +")
+    one_line_reply = f"<<<<<<< SEARCH\n{header_line}\n{body_line}\n=======\n{header_line}\n{fixed_body_line}\n>>>>>>> REPLACE"
+    shifted_reply = "\n".join("    " + line if line and not line.startswith(("<<<", "===", ">>>")) else line for line in one_line_reply.splitlines())
+    fuzzy_reply = f"<<<<<<< SEARCH\n{header_line}\n{body_line.replace(' + ', '+')}\n=======\n{header_line}\n{fixed_body_line}\n>>>>>>> REPLACE"
+    import_reply = f"<<<<<<< SEARCH\n=======\nimport json\n>>>>>>> REPLACE\n{one_line_reply}"
+    fixed_script = script[:start] + target + fixed_body_line + script[start + len(target) + len(body_line):]
+    return [
+        ("one-line fix (exact)", one_line_reply, fixed_script),
+        ("re-indented SEARCH", shifted_reply, fixed_script),
+        ("fuzzy SEARCH", fuzzy_reply, fixed_script),
+        ("import + one-line fix", import_reply, "import json\n" + fixed_script),
+    ]
+
+def estimated_decode_seconds(text, tokens_per_second, ttft):
+    return ttft + poop.estimate_tokens(text) / tokens_per_second
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Patch edit benchmark")
+    arg_parser.add_argument("--lines", default="200,1000,4000")
+    arg_parser.add_argument("--tokens-per-second", type=float, default=60.0)
+    arg_parser.add_argument("--ttft", type=float, default=0.8)
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    print(f"{'lines':>6} {'scenario':<24} {'full out tok':>12} {'patch out tok':>13} {'apply ms':>9} {'full s':>7} {'patch s':>8} {'speedup':>8} {'ok':>3}")
+    for line_count in (int(n) for n in args.lines.split(",")):
+        script, function_count = synthetic_script(line_count)
+        for name, reply, expected_script in fix_scenarios(script, function_count):
+            apply_timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                patched_script = poop.apply_search_replace_blocks(script, reply)
+                apply_timings.append(time.perf_counter() - started)
+            apply_seconds = min(apply_timings)
+            full_seconds = estimated_decode_seconds(expected_script, args.tokens_per_second, args.ttft)
+            patch_seconds = estimated_decode_seconds(reply, args.tokens_per_second, args.ttft) + apply_seconds
+            applied_ok = patched_script is not None and patched_script.strip() == expected_script.strip()
+            print(f"{line_count:>6} {name:<24} {poop.estimate_tokens(expected_script):>12} {poop.estimate_tokens(reply):>13} {apply_seconds * 1000:>9.2f} "
+                  f"{full_seconds:>7.1f} {patch_seconds:>8.2f} {full_seconds / patch_seconds:>7.1f}x {'yes' if applied_ok else 'NO':>3}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Benchmark: POOP's single-pass plan tokenizer vs. the previous regex-based parser.
+# Usage: python benchmarks/bench_plan_parser.py [--steps 10,50,200,1000] [--repeat 5]
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import poop
+
+
+# --- Frozen copy of the regex parser this replaced (for comparison only) ---
+def legacy_parse_plan_step_details(step_text_content):
+    details = {}
+    def extract_field(field_name, text, stop_keywords_list):
+        pattern_str = rf"^\s*{re.escape(field_name)}:\s*(.*?)(?=(" + "|".join(map(lambda kw: r"\n\s*" + re.escape(kw) + ":", stop_keywords_list)) + r")|$)"
+        match = re.search(pattern_str, text, re.DOTALL | re.IGNORECASE | re.MULTILINE)
+        return match.group(1).strip() if match and match.group(1) else None
+
+    all_fields_ordered = ["Task", "Details", "Dependencies", "Outcome", "Requires_Code_Gen", "Additive_Code", "Requires_User_Input_During_Step", "Requires_User_Action", "Screenshot_Analysis_Signal"]
+    current_field_map = {
+        "Task": "task", "Details": "details", "Dependencies": "dependencies", "Outcome": "outcome",
+        "Requires_Code_Gen": "requires_code_gen", "Additive_Code": "additive_code",
+        "Requires_User_Input_During_Step": "requires_user_input_during_step",
+        "Requires_User_Action": "requires_user_action",
+        "Screenshot_Analysis_Signal": "screenshot_analysis_signal"
+    }
+    remaining_text = step_text_content
+    task_match = re.match(r"^\s*Task:\s*(.*?)(?=\n\s*(?:Details:|Dependencies:|Outcome:|Requires_Code_Gen:|Additive_Code:|Requires_User_Input_During_Step:|Requires_User_Action:|Screenshot_Analysis_Signal:|$))", remaining_text, re.DOTALL | re.IGNORECASE)
+    if task_match:
+        details["task"] = task_match.group(1).strip()
+        remaining_text = remaining_text[task_match.end():]
+    else:
+        task_lines = []
+        for line in remaining_text.splitlines(keepends=True):
+            line_stripped_check = line.strip()
+            is_field_label = any(line_stripped_check.lower().startswith(f_kw.lower() + ":") for f_kw in all_fields_ordered[1:])
+            if not is_field_label and line_stripped_check:
+                task_lines.append(line)
+            elif task_lines or is_field_label:
+                break
+        if task_lines:
+            details["task"] = "".join(task_lines).strip()
+            remaining_text = remaining_text[sum(len(l) for l in task_lines):]
+
+    for i, field_name_caps in enumerate(all_fields_ordered):
+        if field_name_caps == "Task" and "task" in details: continue
+        value = extract_field(field_name_caps, remaining_text, all_fields_ordered[i+1:])
+        if value:
+            field_key = current_field_map[field_name_caps]
+            details[field_key] = (value.lower() == "yes") if field_key in ["requires_code_gen", "additive_code", "screenshot_analysis_signal"] else value
+
+    if "requires_code_gen" not in details: details["requires_code_gen"] = True
+    if details["requires_code_gen"]:
+        details.setdefault("additive_code", False)
+        details.setdefault("screenshot_analysis_signal", False)
+    else:
+        details["additive_code"] = False
+        details["screenshot_analysis_signal"] = False
+    return details
+
+def legacy_parse_plan(plan_text_input):
+    parsed_steps_list = []
+    step_pattern = re.compile(r"^\s*(\d+)\.\s*(.*?)(?=(?:\n\s*\d+\.\s*)|$)", re.MULTILINE | re.DOTALL)
+    for match_obj in step_pattern.finditer(plan_text_input):
+        step_content_after_num = match_obj.group(2).strip()
+        if not step_content_after_num: continue
+        step_data = legacy_parse_plan_step_details(step_content_after_num)
+        if not step_data.get("task"):
+            step_data["task"] = step_content_after_num.splitlines()[0].strip()
+        parsed_steps_list.append(step_data)
+    return parsed_steps_list
+# --- End of frozen copy ---
+
+
+def synthetic_plan(step_count, details_lines=4):
+    steps = []
+    for i in range(1, step_count + 1):
+        details = "\n    ".join(f"Detail line {j} for step {i}: handle edge case {j} with care." for j in range(details_lines))
+        steps.append(
+            f"{i}.  Task: Implement feature number {i} of the generated application.\n"
+            f"    Details: {details}\n"
+            f"    Dependencies: Code from Step {max(1, i - 1)}; Python library 'numpy'.\n"
+            f"    Outcome: Feature {i} works and prints a short status line.\n"
+            f"    Requires_Code_Gen: {'Yes' if i % 5 else 'No'}\n"
+            f"    Additive_Code: {'Yes' if i > 1 else 'No'}\n"
+            + (f"    Requires_User_Action: Check the window after step {i}.\n" if i % 5 == 0 else "")
+            + ("    Screenshot_Analysis_Signal: Yes\n" if i % 7 == 0 else "")
+        )
+    return "\n".join(steps)
+
+def best_of(repeat, func, *args):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Plan parser benchmark")
+    arg_parser.add_argument("--steps", default="10,50,200,1000")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+
+    print(f"{'steps':>6} {'plan KB':>8} {'legacy ms':>10} {'new ms':>8} {'speedup':>8} {'memo hit ms':>12} {'steps w/ same fields':>21}")
+    for step_count in (int(n) for n in args.steps.split(",")):
+        plan_text = synthetic_plan(step_count)
+        legacy_seconds = best_of(args.repeat, legacy_parse_plan, plan_text)
+        new_seconds = best_of(args.repeat, poop._parse_plan_uncached, plan_text)
+        poop.parse_plan(plan_text)
+        memo_seconds = best_of(args.repeat, poop.parse_plan, plan_text)
+
+        # Field-level agreement per step. The legacy step splitter only kept each step's first line,
+        # so the comparison feeds the legacy step parser the same (correctly split) step text.
+        step_texts = [block.split(".", 1)[1] for block in plan_text.split("\n\n")]
+        same_steps = 0
+        for step_text, new_step in zip(step_texts, poop._parse_plan_uncached(plan_text)):
+            legacy_step = legacy_parse_plan_step_details(step_text.strip())
+            # Known, intended differences: multi-line values are kept whole, and the last field
+            # (Screenshot_Analysis_Signal) is parsed at all.
+            comparable_keys = set(legacy_step) - {"details", "screenshot_analysis_signal"}
+            if all(legacy_step[k] == new_step.get(k) for k in comparable_keys): same_steps += 1
+        print(f"{step_count:>6} {len(plan_text) / 1024:>8.1f} {legacy_seconds * 1000:>10.2f} {new_seconds * 1000:>8.2f} "
+              f"{legacy_seconds / new_seconds:>7.1f}x {memo_seconds * 1000:>12.3f} {same_steps:>14}/{step_count}")
+
+if __name__ == "__main__":
+    main()
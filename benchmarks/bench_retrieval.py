@@ -0,0 +1,77 @@
+# Benchmark: BM25 retrieval of past POOP scripts (PastScriptRetrievalIndex).
+# Usage: python benchmarks/bench_retrieval.py [--docs 1000,5000,20000] [--queries 200]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import poop
+
+
+def synthetic_corpus(doc_count, vocabulary_size=20000, seed=7):
+    # Zipf-ish term frequencies, roughly the shape of identifier/word counts in generated scripts.
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(vocabulary_size)]
+    weights = [1.0 / (rank + 1) for rank in range(vocabulary_size)]
+    corpus = {}
+    for doc_index in range(doc_count):
+        term_counts = {}
+        for term in rng.choices(vocabulary, weights, k=rng.randint(80, 400)):
+            term_counts[term] = term_counts.get(term, 0) + 1
+        corpus[f"poop{doc_index}.py"] = dict(sorted(term_counts.items(), key=lambda item: -item[1])[:poop.RETRIEVAL_MAX_TERMS_PER_SCRIPT])
+    queries = [" ".join(rng.choices(vocabulary[:3000], k=rng.randint(3, 12))) for _ in range(1000)]
+    return corpus, queries
+
+def percentile_ms(timings, percentile):
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))] * 1000
+
+def time_queries(index, queries):
+    index.query(queries[0]) # Build the lazily cached arrays for a fair steady-state number
+    timings = []
+    for query_text in queries:
+        started = time.perf_counter()
+        index.query(query_text, poop.PAST_SCRIPT_RETRIEVAL_TOP_K)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Past-script retrieval benchmark")
+    arg_parser.add_argument("--docs", default="1000,5000,20000")
+    arg_parser.add_argument("--queries", type=int, default=200)
+    args = arg_parser.parse_args()
+    numpy_module = poop.np
+
+    print(f"{'docs':>6} {'build s':>8} {'upsert ms':>10} {'numpy p50/p95 ms':>17} {'python p50/p95 ms':>18} {'after-upsert ms':>16}")
+    for doc_count in (int(n) for n in args.docs.split(",")):
+        corpus, queries = synthetic_corpus(doc_count)
+        queries = queries[:args.queries]
+        index = poop.PastScriptRetrievalIndex()
+        started = time.perf_counter()
+        for name, term_counts in corpus.items(): index.upsert(name, term_counts)
+        build_seconds = time.perf_counter() - started
+
+        poop.np = numpy_module
+        numpy_timings = time_queries(index, queries) if numpy_module is not None else None
+        poop.np = None
+        python_timings = time_queries(index, queries)
+        poop.np = numpy_module
+
+        # Incremental update: re-index one script (as after a file write), then the first query
+        # pays for rebuilding only the touched terms' arrays.
+        name, term_counts = next(iter(corpus.items()))
+        started = time.perf_counter()
+        index.upsert(name, term_counts)
+        upsert_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        index.query(queries[1], poop.PAST_SCRIPT_RETRIEVAL_TOP_K)
+        after_upsert_ms = (time.perf_counter() - started) * 1000
+
+        numpy_text = f"{percentile_ms(numpy_timings, 50):.2f}/{percentile_ms(numpy_timings, 95):.2f}" if numpy_timings else "n/a"
+        python_text = f"{percentile_ms(python_timings, 50):.2f}/{percentile_ms(python_timings, 95):.2f}"
+        print(f"{doc_count:>6} {build_seconds:>8.2f} {upsert_ms:>10.3f} {numpy_text:>17} {python_text:>18} {after_upsert_ms:>16.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,47 @@ import shutil
 import time
 import platform
 import random
-from PIL import Image
+import math
+from PIL import Image, ImageStat
 import re
+import ast
+import json
+import heapq
+import difflib
+import builtins
+import importlib.util
+import hashlib
+import venv
+import site
+import threading
+import queue
+import asyncio
+import socket
+import select
+import signal
+import io
+import csv
+import glob
+import shlex
+from collections import OrderedDict, deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import sqlite3 # For the on-disk LLM response cache
+except ImportError:
+    sqlite3 = None # Cache falls back to memory-only
+try:
+    import numpy as np # Vectorised BM25 scoring for past-script retrieval
+except ImportError:
+    np = None # Pure-Python scoring fallback
+try:
+    from multiprocessing import shared_memory # Screenshot handoff from scripts without encoding or disk
+except ImportError:
+    shared_memory = None # Scripts use the file path signal
+try:
+    import resource # For rlimits and rusage of executed scripts (POSIX only)
+except ImportError:
+    resource = None # Only the wall-clock limit is enforced
 try:
     import readline # For command history
 except ImportError:
@@ -36,8 +75,17 @@ LINK_END = "\x1b\\"
 LINK_RESET = "\x1b]8;;\x1b\\"
 API_KEY_LINK = f"{LINK_START}https://makersuite.google.com/app/apikey{LINK_END}makersuite.google.com/app/apikey{LINK_RESET}"
 
-ACTIVE_SUBPROCESS = None
-ACTIVE_SUBPROCESS_FILE = None
+# Background jobs started with 'start': id -> job dict (process, log file, restart policy, CPU/RSS samples)
+BACKGROUND_JOBS = OrderedDict()
+BACKGROUND_JOB_NEXT_ID = 1
+BACKGROUND_JOB_RESTART_POLICIES = ("never", "on-failure", "always")
+BACKGROUND_JOB_DEFAULT_RESTART_POLICY = "never"
+BACKGROUND_JOB_MAX_RESTARTS = 5
+BACKGROUND_JOB_SAMPLE_INTERVAL_SECONDS = 2.0
+BACKGROUND_JOB_SAMPLES_KEPT = 150
+_BACKGROUND_JOBS_LOCK = threading.RLock()
+_BACKGROUND_JOB_MONITOR = None
+_BACKGROUND_JOBS_SHUTDOWN = threading.Event() # Set on exit: exited jobs are no longer restarted
 
 CODE_MODIFIED_BY_LLM_SINCE_LAST_RUN = False
 LAST_CODE_FOR_CONFIRMATION = ""
@@ -50,6 +98,102 @@ PLAN_STEP_FAILED_INFO = None
 
 PAST_POOP_FILES_CONTEXT = []
 MAX_PAST_FILES_CONTEXT = 5
+PAST_FILES_INDEX = None # File name -> {"name", "mtime", "summary"}; loaded lazily from PAST_FILES_INDEX_FILE
+PAST_FILES_INDEX_DIR_MTIME_NS = None # Directory mtime at the last reconcile; rescan only when it changes
+_PAST_FILES_INDEX_LOCK = threading.RLock() # Index load, upserts and reconcile (write hook on the main thread vs. queries)
+PAST_SCRIPT_RETRIEVAL_TOP_K = 3 # Similar past scripts given to the planner (2 to code generation)
+PAST_SCRIPT_RETRIEVAL_MIN_SCORE = 2.0 # BM25 score below which a script isn't considered related
+PAST_SCRIPT_EXCERPT_CHARS = 1200
+RETRIEVAL_MAX_TERMS_PER_SCRIPT = 120 # Most frequent terms kept per script in the index
+RETRIEVAL_HEADER_WEIGHT = 3 # '# POOP: Task/Overall Goal' words count this many times
+RETRIEVAL_STOPWORDS = frozenset('''
+the and for with from that this into are was were has have not you your use using all any can will its but then than
+else elif def class import return self none true false print while break continue pass lambda try except finally raise
+assert global nonlocal yield del str int float list dict set len range open file code script python poop task plan step
+part goal overall
+'''.split())
+
+# Plan parsing: parse_plan results by plan text, so a regenerated or cached identical plan is not parsed again
+PLAN_PARSE_MEMO = OrderedDict() # sha256(plan text) -> parsed steps
+PLAN_PARSE_MEMO_MAX_ENTRIES = 32
+# Speculative code generation for upcoming non-additive plan steps
+PLAN_PREFETCH_ENABLED = True
+PLAN_PREFETCH_MAX_AHEAD = 2 # How many steps beyond the current one may be generated ahead
+PLAN_PREFETCH_WORKERS = 2
+PLAN_PREFETCH = {} # step index -> {'fingerprint', 'future'}
+PLAN_PREFETCH_STATS = {"submitted": 0, "used": 0, "discarded": 0, "saved_seconds": 0.0}
+_PLAN_PREFETCH_EXECUTOR = None
+# Verified snippets: plan-step fingerprint -> code that ran with exit code 0 (+ environment fingerprint)
+VERIFIED_SNIPPET_REUSE = "ask" # "ask", "auto" (reuse without asking when the environment matches) or "off"
+VERIFIED_SNIPPETS_MAX_ENTRIES = 500
+VERIFIED_SNIPPETS = None # Loaded lazily from VERIFIED_SNIPPETS_FILE
+VERIFIED_SNIPPET_STATS = {"reused": 0, "reuse_failed": 0, "recorded": 0}
+_ENVIRONMENT_FINGERPRINT = None # (fingerprint, summary); reset after package installs
+# Fix slicing: fixes of long scripts send only the code the traceback points into (enclosing definitions,
+# call sites, imports) as numbered segments; the model returns changed segments, which are spliced back.
+FIX_SLICE_MIN_CHARS = 3000 # Shorter scripts are always sent whole
+FIX_SLICE_MAX_FRACTION = 0.6 # Send the whole script when the slice would be larger than this share of it
+FIX_SLICE_SYNTAX_WINDOW_LINES = 25 # Lines kept on each side of a syntax error (the script can't be parsed)
+FIX_SLICE_STATS = {"sliced": 0, "spliced": 0, "fallbacks": 0, "chars_saved": 0}
+# Patch edits: fixes of larger scripts ask for SEARCH/REPLACE blocks instead of the whole script
+CODE_EDIT_MODE = "patch" # "patch" or "full" (always regenerate the whole script)
+CODE_PATCH_MIN_CHARS = 1200 # Below this, regenerating the script costs about as much as a patch
+CODE_PATCH_FUZZY_THRESHOLD = 0.88 # Minimum similarity for a SEARCH block that doesn't match exactly
+CODE_PATCH_STATS = {"applied": 0, "fallbacks": 0, "blocks": 0, "fuzzy_blocks": 0, "output_chars": 0, "script_chars": 0}
+
+POOP_STATE_DIR = os.path.abspath(".poop") # Per-working-directory state (caches, indexes)
+
+# LLM response cache (content-addressed: model name + GCFG + full prompt)
+LLM_CACHE_ENABLED = True
+LLM_CACHE_BYPASS_NEXT = False # One-shot bypass for intentional regeneration ('cache bypass', plan step retry)
+LLM_CACHE_MEMORY_MAX_ENTRIES = 256
+LLM_CACHE_DISK_MAX_ENTRIES = 5000
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 3600
+LLM_CACHE_DB_FILE = os.path.join(POOP_STATE_DIR, "llm_cache.sqlite3")
+PAST_FILES_INDEX_FILE = os.path.join(POOP_STATE_DIR, "past_files_index.jsonl") # Append-only log of index updates
+VERIFIED_SNIPPETS_FILE = os.path.join(POOP_STATE_DIR, "verified_snippets.json")
+LLM_CACHE_STATS = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "bypassed": 0}
+_LLM_CACHE_MEMORY = OrderedDict() # key -> (response_text, created_timestamp), LRU order
+_LLM_CACHE_DB = None
+_LLM_CACHE_LOCK = threading.Lock()
+
+# Async LLM client: one event loop thread shared by all wrappers (reuses the model's async
+# transport/connections), with retries, per-model token buckets and in-flight request coalescing.
+LLM_RETRY_MAX_ATTEMPTS = 5
+LLM_RETRY_BASE_DELAY_SECONDS = 1.0
+LLM_RETRY_MAX_DELAY_SECONDS = 30.0
+LLM_RATE_LIMITS = {"default": (1.0, 5)} # Model short name (or 'default') -> (requests per second, burst)
+LLM_CALL_METRICS = {} # Model name -> {'calls', 'errors', 'retries', 'coalesced', 'latencies'}
+LLM_METRICS_WINDOW = 200 # Latency samples kept per model
+# Prompt budgeting: every prompt builder assembles prioritized sections into a per-kind token budget.
+PROMPT_TOKEN_BUDGETS = {"plan": 12000, "code": 16000, "fix": 12000, "chat": 6000}
+PROMPT_TOKEN_COUNTING = "estimate" # "estimate" (local, calibrated from usage metadata) or "model" (count_tokens near the budget)
+PROMPT_CHARS_PER_TOKEN_DEFAULT = 4.0
+_PROMPT_CHARS_PER_TOKEN = {} # Model name -> chars/token, moving average of observed prompts
+LAST_PROMPT_REPORTS = {} # Call kind -> {'estimated_tokens', 'budget_tokens', 'trimmed'} of the last assembled prompt
+LLM_TOKEN_LOG = deque(maxlen=50) # Recent {'model', 'input_tokens', 'output_tokens', 'estimated_input_tokens'} records
+_LLM_RETRYABLE_ERRORS = (
+    google.api_core.exceptions.TooManyRequests, google.api_core.exceptions.ResourceExhausted,
+    google.api_core.exceptions.ServiceUnavailable, google.api_core.exceptions.InternalServerError,
+    google.api_core.exceptions.DeadlineExceeded, google.api_core.exceptions.BadGateway,
+)
+_LLM_LOOP = None
+_LLM_LOOP_LOCK = threading.Lock()
+_LLM_TOKEN_BUCKETS = {} # Model name -> [tokens, last_refill_time]
+_LLM_INFLIGHT = {} # Coalescing key -> {'task': asyncio.Task of the in-flight request, 'waiters': callers awaiting it}
+
+# Model routing: cheap calls go to the light model, planning to the primary; automatic failover
+# on errors or when a call exceeds its latency SLO. Rolling p95 per model can reorder the choice.
+MODEL_ROUTING_ENABLED = True # Manual 'm <model>' turns this off, 'm auto' turns it back on
+MODEL_LATENCY_SLO_SECONDS = {"plan": 90.0, "code": 60.0, "fix": 60.0, "chat": 30.0, "multimodal": 60.0}
+MODEL_ROUTING_LIGHT_MAX_SCRIPT_CHARS = 1500 # Fix-ups of scripts shorter than this go to the light model
+MODEL_ROUTING_MIN_SAMPLES = 5 # Latency samples needed before p95 influences routing
+
+# Streaming LLM output (gmc/gmtc render tokens live instead of blocking on the full response)
+LLM_STREAM_OUTPUT = True
+LLM_STREAM_TIMINGS = [] # Recent {'model', 'ttft', 'total', 'chars'} records, newest last
+LLM_STREAM_TIMINGS_MAX = 50
+_LLM_STREAM_STOP_REASONS = {"SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "IMAGE_SAFETY", "OTHER", 3, 4, 5, 7, 8, 9, 11}
 
 # Color Definitions
 _BASE_COLORS = [ # For random prompt color
@@ -70,10 +214,129 @@ CODE_OUTPUT_HEADER_COLOR = "\x1b[34m" # Blue
 CHAT_LLM_RESPONSE_COLOR = "\x1b[32m" # Darker Green for chat
 
 IMAGE_ANALYSIS_SIGNAL = "#POOP_ANALYZE_IMAGE_PATH:"
+# Screenshot handoff: scripts call poop_handoff.analyze_image(img) (module written to IMAGE_HANDOFF_LIB_DIR, which is on
+# their PYTHONPATH). It copies raw pixels into a shared memory segment and prints IMAGE_SHM_SIGNAL; POOP copies them
+# out and unlinks the segment as soon as the line arrives. No PNG encode, disk write or decode. The path signal remains
+# the fallback (Windows, background jobs, scripts run outside POOP).
+IMAGE_SHM_SIGNAL = "#POOP_ANALYZE_IMAGE_SHM:"
+IMAGE_HANDOFF_ENABLED = True
+IMAGE_HANDOFF_MODULE = "poop_handoff"
+IMAGE_HANDOFF_LIB_DIR = os.path.join(POOP_STATE_DIR, "lib")
+IMAGE_HANDOFF_MAX_PENDING = 8 # Received images kept until analysed (oldest dropped first)
+IMAGE_HANDOFF_STALE_SECONDS = 3600 # Unclaimed segments (e.g. POOP was killed) older than this are removed
+IMAGE_HANDOFF_STATS = {"received": 0, "bytes": 0, "seconds": 0.0, "failed": 0, "path_signals": 0}
+_IMAGE_HANDOFFS = OrderedDict() # Segment name -> PIL image copied out of it
+_IMAGE_HANDOFF_LOCK = threading.Lock()
+_IMAGE_HANDOFF_LIB_READY = False
+# Images for multimodal calls are downsampled and re-encoded before upload; descriptions are cached by prompt and
+# a hash of the decoded pixels. Near-duplicate matching (fine dHash) is opt-in: screenshots of different text can
+# look identical to any small perceptual hash.
+IMAGE_MAX_EDGE = 1568 # Longest edge in pixels after downsampling (None keeps the original size)
+IMAGE_UPLOAD_FORMAT = "JPEG" # "JPEG", "WEBP" or "PNG" (lossless)
+IMAGE_UPLOAD_QUALITY = 85 # JPEG/WebP quality target
+IMAGE_DESC_CACHE_ENABLED = True
+IMAGE_DESC_CACHE_NEAR_DUPLICATES = False # Also reuse descriptions of images whose dHash is within IMAGE_DESC_CACHE_MAX_DISTANCE
+IMAGE_DESC_HASH_SIZE = 32 # dHash grid (32x32 = 1024 bits)
+IMAGE_DESC_CACHE_MAX_DISTANCE = 0 # Max differing dHash bits for a near-duplicate match
+IMAGE_DESC_CACHE_MAX_COLOR_DELTA = 8 # Max difference of any mean RGB channel for a near-duplicate (flat images all hash to zero)
+IMAGE_DESC_CACHE_MAX_ENTRIES = 2000
+IMAGE_DESC_CACHE_FILE = os.path.join(POOP_STATE_DIR, "image_descriptions.json")
+IMAGE_DESC_CACHE = None # Loaded lazily from IMAGE_DESC_CACHE_FILE: list of {'pixels', 'dhash', 'prompt', 'description', ...}
+IMAGE_DESC_STATS = {"calls": 0, "hits": 0, "misses": 0, "errors": 0, "original_bytes": 0, "uploaded_bytes": 0,
+                    "preprocess_seconds": 0.0, "llm_seconds": 0.0}
+_IMAGE_DESC_LOCK = threading.Lock()
+# 'img_desc' over globs/directories: concurrent requests (the per-model rate limit in LLM_RATE_LIMITS still applies),
+# results appended to a JSONL/CSV file as they complete; files whose content hash is already in it are skipped.
+IMAGE_BATCH_WORKERS = 4
+IMAGE_BATCH_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif", ".tif", ".tiff")
+IMAGE_BATCH_DEFAULT_OUTPUT = "image_descriptions.jsonl"
+IMAGE_BATCH_FIELDS = ["path", "sha256", "description", "error", "cached", "original_bytes", "uploaded_bytes", "seconds", "described_at"]
 MODULE_INSTALL_SIGNAL = "#POOP_INSTALLED_MODULE:"
 
 LAST_SCRIPT_STDOUT_LINES = []
 LAST_SCRIPT_STDERR_MESSAGE = None
+LAST_SCRIPT_OUTPUT_CAPTURE = None # BoundedLineCapture of the last run (interleaved, timestamped)
+IN_MEMORY_CANCEL_GRACE_SECONDS = 3 # After a cancel request, how long in-memory code gets before it is also sent SIGINT (wakes blocking calls)
+
+# Resource limits for executed scripts (file mode and 'start'; in-memory runs get wall_seconds). None disables a limit.
+RUN_LIMITS = {
+    "cpu_seconds": 300, # RLIMIT_CPU; SIGXCPU at the soft limit
+    "memory_mb": 4096, # RLIMIT_DATA (heap + anonymous mmaps), so MemoryError instead of the host swapping
+    "file_size_mb": 2048, # RLIMIT_FSIZE
+    "wall_seconds": 900, # Enforced by POOP; the script is killed when it runs longer
+    "background_wall_seconds": None, # Same, for 'start' (long-running servers by default)
+}
+LAST_RUN_TELEMETRY = None # Dict: wall/cpu/peak RSS/exit code/limit_hit of the last file-mode run
+RUN_TELEMETRY_HISTORY = deque(maxlen=50)
+# Automatic fix loop: failed runs are fixed by the LLM and re-run until they pass or a budget runs out
+AUTO_FIX_MAX_ATTEMPTS = 3 # LLM fix attempts per 'run' / plan step; 0 = one fix proposal, no automatic re-run
+AUTO_FIX_TIME_BUDGET_SECONDS = 300 # Total for runs + fixes; no new attempt starts after this
+AUTO_FIX_ESCALATE = True # After a failed fix, fix-ups skip the light model and go to the primary model
+AUTO_FIX_LOG = deque(maxlen=100) # Per attempt: {'attempt', 'run_seconds', 'fix_seconds', 'outcome', 'error', 'escalated', ...}
+_AUTO_FIX_ESCALATED = False # Set while a fix loop has escalated; read by route_models
+LAST_LLM_FIX_SECONDS = 0.0 # Duration of the last request_llm_fix call
+# Static pre-flight checks before a run: compile, imports that can't be found, names that are never defined
+PREFLIGHT_ENABLED = True
+PREFLIGHT_STATS = {"checks": 0, "blocked": 0, "syntax_errors": 0, "missing_modules": 0, "undefined_names": 0, "seconds": 0.0}
+_PREFLIGHT_FOUND_MODULES = set() # (interpreter, module) pairs known to be importable; missing ones are re-checked
+# Dependency installs: import name -> pip distribution, one batched install per run, local wheelhouse first (offline)
+IMPORT_TO_DISTRIBUTION = {
+    "cv2": "opencv-python", "PIL": "Pillow", "sklearn": "scikit-learn", "skimage": "scikit-image", "yaml": "PyYAML",
+    "bs4": "beautifulsoup4", "dateutil": "python-dateutil", "dotenv": "python-dotenv", "Crypto": "pycryptodome",
+    "serial": "pyserial", "usb": "pyusb", "jwt": "PyJWT", "magic": "python-magic", "docx": "python-docx",
+    "pptx": "python-pptx", "fitz": "PyMuPDF", "OpenGL": "PyOpenGL", "gi": "PyGObject", "zmq": "pyzmq",
+    "wx": "wxPython", "win32api": "pywin32", "win32con": "pywin32", "win32gui": "pywin32", "pythoncom": "pywin32",
+    "attr": "attrs", "mpl_toolkits": "matplotlib", "Levenshtein": "python-Levenshtein", "telegram": "python-telegram-bot",
+    "google.generativeai": "google-generativeai", "googleapiclient": "google-api-python-client", "discord": "discord.py",
+    "sounddevice": "sounddevice", "pyaudio": "PyAudio", "speech_recognition": "SpeechRecognition", "playsound": "playsound",
+    "Xlib": "python-xlib", "pynput": "pynput", "github": "PyGithub", "psycopg2": "psycopg2-binary", "MySQLdb": "mysqlclient",
+    "tflite_runtime": "tflite-runtime", "pkg_resources": "setuptools", "jose": "python-jose", "socks": "PySocks",
+}
+DEPENDENCY_WHEELHOUSE_DIR = os.path.join(POOP_STATE_DIR, "wheelhouse") # Wheels of everything installed so far; reinstalls work offline
+DEPENDENCY_INSTALL_TIMEOUT_SECONDS = 600 # For the whole batch
+DEPENDENCY_INSTALL_LOG = deque(maxlen=50) # {'distributions', 'source', 'seconds', 'ok', 'time'}
+
+# Per-plan virtual environments, keyed by a hash of the plan's requirement set (+ base interpreter). Built with
+# --system-site-packages and no pip of their own, so creation is a fraction of a second; when POOP itself runs in a
+# venv, a .pth file adds that venv's site-packages too (--system-site-packages only reaches the base interpreter's).
+# A pip is only installed into the env when none is visible. Whatever a plan installs lands in its own env. Least
+# recently used envs beyond PLAN_VENV_MAX_COUNT are deleted.
+PLAN_VENVS_ENABLED = True
+PLAN_VENV_DIR = os.path.join(POOP_STATE_DIR, "venvs")
+PLAN_VENV_MAX_COUNT = 8
+PLAN_VENV_MAX_AGE_DAYS = 30 # Unused for this long -> deleted on the next GC
+PLAN_VENV_STATS = {"created": 0, "reused": 0, "creation_seconds": 0.0, "removed": 0}
+CURRENT_PLAN_INTERPRETER = None # Interpreter of the active plan's venv (None = sys.executable)
+
+# Forking a long-lived interpreter is only safe on Linux: on macOS a child forked after Accelerate/ObjC initialised
+# (numpy, matplotlib) can crash or deadlock, so the warm pool and the plan kernel are Linux + Python 3.9+ only.
+FORK_WORKERS_SUPPORTED = sys.platform.startswith("linux") and hasattr(os, "fork") and hasattr(socket, "send_fds")
+
+# Warm worker pool for file-mode runs: pre-started interpreters with heavy modules already imported.
+# Each run forks a fresh child of a worker (clean namespace, real exit code). Linux only (see above).
+WARM_WORKERS_ENABLED = FORK_WORKERS_SUPPORTED
+WARM_WORKER_POOL_SIZE = 2 # Per interpreter
+WARM_WORKER_PREIMPORTS = ["numpy", "pandas", "matplotlib"] # Missing modules are skipped
+WARM_WORKER_MAX_RUNS = 50 # Recycle a worker after this many runs...
+WARM_WORKER_MAX_RSS_MB = 1024 # ...or when its resident memory passes this
+_WARM_WORKER_POOLS = {} # Interpreter path -> list of worker dicts
+_WARM_WORKER_LOCK = threading.Lock()
+
+# Incremental kernel for plan steps: one persistent process per plan keeps the script's namespace alive, and each run
+# executes only the cells (appended step code) that changed. Every successfully run cell is a forked checkpoint, so
+# an edited earlier cell rolls back to the last unchanged state instead of re-running the file. Linux only (see above).
+PLAN_KERNEL_ENABLED = FORK_WORKERS_SUPPORTED
+PLAN_KERNEL_MAX_CELLS = 64 # Beyond this many checkpoints the kernel restarts and re-runs the file as one cell
+PLAN_KERNEL_FORK_UNSAFE_MODULES = ["tkinter", "pygame", "pyglet", "kivy", "wx", "PyQt5", "PyQt6", "PySide2", "PySide6"]
+PLAN_KERNEL_STATS = {"cells_run": 0, "cells_reused": 0, "seconds_saved": 0.0, "appends": 0, "rollbacks": 0,
+                     "reactive_updates": 0, "full_reruns": 0, "restarts": 0, "fallbacks": 0}
+_PLAN_KERNEL = None # Active kernel dict (see _start_plan_kernel)
+_PLAN_KERNEL_DISABLED_REASON = None # Set when a cell left state a fork can't carry (threads, GUI); cleared per plan
+
+SCRIPT_OUTPUT_MAX_LINES_IN_MEMORY = 2000 # Older lines of a run are spilled to disk
+BACKGROUND_JOB_LOG_DIR = os.path.join(POOP_STATE_DIR, "jobs")
+SCRIPT_OUTPUT_SPILL_DIR = os.path.join(POOP_STATE_DIR, "output")
+SCRIPT_OUTPUT_SPILL_MAX_FILES = 20 # Spill files kept in SCRIPT_OUTPUT_SPILL_DIR (left by crashed or earlier sessions)
 
 
 _CMDS_TEMPLATE = f"""CMDS for POOP ({POOP_NAME}):
@@ -82,26 +345,69 @@ q(uit)/exit: Exit the agent.
 run: If new/modified Python code exists, show for confirmation, then execute it
      (blocking, live output) and attempt to debug errors (incl. pip install for ModuleNotFound).
      If script signals for image analysis, POOP will attempt it.
-start [path]: Start Python code in the target file in the background (live output).
-              No confirmation before start; assumes code is tested.
+start [path] [--restart[=on-failure|always]]: Start Python code in the target file as a background job.
+              Output goes to a per-job log file. No confirmation before start; assumes code is tested.
               If no path given, uses the current target file. If none, a new unique file is created.
-stop: Stop the last background process started with 'start'.
-status_process: Check the status of the background process.
+              With --restart, the job is restarted (with backoff) when it exits.
+jobs: List background jobs with status, restarts, CPU and memory use.
+stop [id|all]: Stop a background job (default: the most recent one).
+logs [id] [--follow]: Show the tail of a job's log; --follow keeps printing new output until Ctrl+C.
+status_process [id]: Detailed status of a background job, incl. sampled CPU% and RSS.
 show: Display the current Python code buffer, target file, and active plan (if any).
 clear: Clear Python code buffer, task history, and active plan. Resets confirmation status and target file.
-m(odel) [name/alias]: Change LLM. Aliases: 'primary', 'light'. Full names or short names also work.
+m(odel) [name/alias|auto]: Change LLM. Aliases: 'primary', 'light'. Full names or short names also work.
                       Available: '{{multi_model_name_short}}' (primary), '{{light_model_name_short}}' (light).
-img_desc [path]: Describe an image using POOP's multimodal AI.
+                      Choosing a model turns off automatic routing (chat/short fix-ups -> light,
+                      planning/code -> primary, failover on errors or slow calls); 'm auto' turns it back on.
+img_desc [path|dir|glob ...] [-o out.jsonl|out.csv] [-j workers]: Describe an image using POOP's multimodal AI.
+                  Several paths, directories or globs ('shots/**/*.png') are described concurrently; results stream
+                  to the terminal and are appended to the output file (default {IMAGE_BATCH_DEFAULT_OUTPUT}).
+                  Re-running skips images whose content is already described there.
+img_cache [on|off|clear|maxedge n|quality q|format jpeg|webp|png|near on|off|distance bits|handoff on|off]: Show upload
+                  bytes, model latency and hit rate of image descriptions, or change preprocessing. Images are downsampled
+                  to 'maxedge' and re-encoded before upload; images with identical pixels reuse the cached description for
+                  the same prompt. 'near on' also reuses it for near duplicates (32x32 dHash within 'distance' bits, default 0). 'handoff off' makes {IMAGE_HANDOFF_MODULE} save
+                  files (path signal) instead of passing pixels through shared memory.
 f(ile) [path]: Set Python target file. 'f none' for in-memory/auto-file per plan.
                Loads code if file exists, resets confirmation and task history.
 sysinfo: Display detected system information.
 chat [query]: Chat with the LLM about the current context (last instruction, code, output/errors).
               If no query, LLM gives general thoughts.
+llm_stats: Show per-model LLM call counts, retries, coalesced requests, p50/p95 latency and token usage.
+deps [map import dist]: Show the local wheelhouse and install timings, or map an import name to its pip distribution
+                  (built in: cv2 -> opencv-python, PIL -> Pillow, ...). Missing modules are installed in one batch,
+                  offline from .poop/wheelhouse when it already has them.
+venvs [gc|clear|on|off]: List the per-plan venvs (.poop/venvs, keyed by a hash of the plan's requirements) with
+                  creation time vs. reuse hits; 'gc' drops least recently used ones, 'clear' all but the active one.
+fixloop [attempts n|seconds s|escalate on|off|preflight on|off]: Show the automatic fix -> re-run loop's budgets,
+                  per-attempt log (run/fix latency, outcome, error) and pre-flight check stats, or change them.
+                  'fixloop attempts 0' proposes one fix without re-running. Pre-flight checks (compile, missing imports,
+                  undefined names) run before every execution; blocking findings are fixed in one LLM call, possibly
+                  undefined names and conditional imports are only reported.
+edits [patch|full]: Whether LLM fixes of larger scripts come back as SEARCH/REPLACE edits (default) or whole scripts.
+budget [kind tokens|estimate|model]: Show or set prompt token budgets (plan, code, fix, chat); over-budget prompts
+                  trim their lowest-priority context first. 'estimate' counts tokens locally, 'model' asks count_tokens.
+limits [name value|off]: Show resource limits for executed scripts (cpu_seconds, memory_mb, file_size_mb,
+                  wall_seconds, background_wall_seconds) and recent run stats, set one ('limits cpu_seconds 60'),
+                  or turn them all off. In-memory runs stream their output and are stopped at wall_seconds too.
+snippets [ask|auto|off|clear]: Show code verified by successful plan steps, set whether matching steps reuse it
+                               (ask first, automatically when the environment matches, or never), or clear the store.
+past [query]: List recent POOP files in this directory, or those most related to a query (BM25 over headers and code).
+workers [restart]: Show the warm worker pool used for file-mode runs (pre-imported interpreters), or restart it.
+kernel [on|off|reset]: Show the incremental plan kernel (cells, per-cell runtime, checkpoints, time saved). Plan steps
+                  run only their new or changed code on top of the kept namespace; an edited earlier step rolls back to
+                  the last unchanged checkpoint, or re-runs just the steps that use what it defines.
+transcript [n]: Show the last n (default 40) lines of the last script run, stdout/stderr interleaved with timestamps.
+stream [on|off]: Toggle live streaming of generated code and chat replies. Without argument, shows
+              time-to-first-token and total time of recent streamed responses.
+cache [stats|clear|on|off|bypass]: Show LLM response cache hit/miss counters (default), clear it,
+              enable/disable it, or bypass it once to force regeneration on the next LLM call.
 [any other text]: Generate a plan. If confirmed, POOP executes step-by-step.
                   Failed plan steps offer retry/skip/abort options.
                   POOP will attempt to `pip install` missing modules if ModuleNotFoundError occurs.
                   Planner favors additive code for iterative tasks like game dev.
-                  Scripts signaling '{IMAGE_ANALYSIS_SIGNAL} <filepath>' trigger AI image analysis.
+                  Scripts signaling '{IMAGE_ANALYSIS_SIGNAL} <filepath>' trigger AI image analysis; scripts can
+                  also call {IMAGE_HANDOFF_MODULE}.analyze_image(image) to hand over raw pixels via shared memory.
                   Code from approved plan steps runs without individual confirmation.
 """
 CMDS = ""
@@ -201,32 +507,291 @@ def update_cmds_display():
         IMAGE_ANALYSIS_SIGNAL=IMAGE_ANALYSIS_SIGNAL
     )
 
+_RETRIEVAL_TOKEN_RE = re.compile(r"[a-z][a-z0-9]{1,30}")
+
+def retrieval_terms(text):
+    # Lowercase word/identifier pieces (snake_case splits on '_'), minus stopwords.
+    return [term for term in _RETRIEVAL_TOKEN_RE.findall(text.lower()) if term not in RETRIEVAL_STOPWORDS]
+
+class PastScriptRetrievalIndex:
+    # Okapi BM25 over past POOP scripts. Postings are updated per script (upsert/remove), and a
+    # term's NumPy id/tf arrays are rebuilt lazily the first time a query needs them after a change.
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1, self.b = k1, b
+        self.doc_ids = {} # Name -> doc id
+        self.doc_names, self.doc_terms, self.doc_lengths = [], [], [] # By doc id; removed ids hold None/{}/0
+        self.total_length = 0
+        self.postings = {} # Term -> {doc id: term frequency}
+        self._posting_arrays = {}
+        self._length_norms = None
+
+    def __len__(self): return len(self.doc_ids)
+
+    def upsert(self, name, term_counts):
+        self.remove(name)
+        doc_id = len(self.doc_names)
+        self.doc_ids[name] = doc_id
+        self.doc_names.append(name); self.doc_terms.append(term_counts)
+        doc_length = sum(term_counts.values())
+        self.doc_lengths.append(doc_length); self.total_length += doc_length
+        for term, term_frequency in term_counts.items():
+            self.postings.setdefault(term, {})[doc_id] = term_frequency
+            self._posting_arrays.pop(term, None)
+        self._length_norms = None
+
+    def remove(self, name):
+        doc_id = self.doc_ids.pop(name, None)
+        if doc_id is None: return
+        for term in self.doc_terms[doc_id]:
+            posting = self.postings.get(term)
+            if posting is not None:
+                posting.pop(doc_id, None)
+                if not posting: del self.postings[term]
+            self._posting_arrays.pop(term, None)
+        self.total_length -= self.doc_lengths[doc_id]
+        self.doc_names[doc_id], self.doc_terms[doc_id], self.doc_lengths[doc_id] = None, {}, 0
+        self._length_norms = None
+        if len(self.doc_names) > 2 * len(self.doc_ids) + 64: self._compact()
+
+    def _compact(self): # Drop the slots of removed scripts
+        live_docs = [(self.doc_names[i], self.doc_terms[i]) for i in sorted(self.doc_ids.values())]
+        self.__init__(self.k1, self.b)
+        for name, term_counts in live_docs: self.upsert(name, term_counts)
+
+    def _idf(self, document_frequency):
+        return math.log(1 + (len(self.doc_ids) - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def query(self, text, top_k=3):
+        # [(name, score), ...] best first; only scripts sharing at least one term with `text`.
+        query_terms = [term for term in set(retrieval_terms(text)) if term in self.postings]
+        if not query_terms or not self.doc_ids: return []
+        average_length = self.total_length / len(self.doc_ids) or 1.0
+        if np is not None:
+            if self._length_norms is None:
+                self._length_norms = self.k1 * (1 - self.b + self.b * np.asarray(self.doc_lengths, dtype=np.float64) / average_length)
+            scores = np.zeros(len(self.doc_names))
+            for term in query_terms:
+                if term not in self._posting_arrays:
+                    posting = self.postings[term]
+                    self._posting_arrays[term] = (np.fromiter(posting.keys(), dtype=np.int64, count=len(posting)),
+                                                  np.fromiter(posting.values(), dtype=np.float64, count=len(posting)))
+                doc_id_array, tf_array = self._posting_arrays[term]
+                scores[doc_id_array] += self._idf(len(doc_id_array)) * tf_array * (self.k1 + 1) / (tf_array + self._length_norms[doc_id_array])
+            matched_count = int(np.count_nonzero(scores))
+            if not matched_count: return []
+            top_k = min(top_k, matched_count)
+            best_ids = np.argpartition(-scores, top_k - 1)[:top_k]
+            best_ids = best_ids[np.argsort(-scores[best_ids])]
+            return [(self.doc_names[i], float(scores[i])) for i in best_ids]
+        scores = {}
+        for term in query_terms:
+            posting = self.postings[term]
+            term_idf = self._idf(len(posting))
+            for doc_id, term_frequency in posting.items():
+                length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + term_idf * term_frequency * (self.k1 + 1) / (term_frequency + length_norm)
+        return [(self.doc_names[i], score) for i, score in heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])]
+
+PAST_SCRIPT_RETRIEVAL = PastScriptRetrievalIndex()
+
+def _is_past_poop_file_name(f_name):
+    return f_name.startswith("poop") and f_name.endswith(".py")
+
+def _read_poop_file_record(file_path, f_name, file_mtime):
+    # Index record: '# POOP:' header summary (first line, plus the Overall Goal line of plan steps)
+    # and the script's most frequent retrieval terms.
+    summary, body = "", ""
+    try:
+        with open(file_path, 'r', encoding='utf-8') as pf:
+            first_line = pf.readline().strip()
+            if first_line.startswith("# POOP:"):
+                summary = first_line.replace("# POOP:", "", 1).strip()
+                second_line_peek = pf.readline().strip()
+                if second_line_peek.startswith("# POOP: Overall Goal:"):
+                    goal = second_line_peek.replace("# POOP: Overall Goal:", "",1).strip()
+                    summary = f"{summary} (Part of Goal: {goal})"
+                else:
+                    body = second_line_peek + "\n"
+            else:
+                body = first_line + "\n"
+            body += pf.read(64 * 1024)
+    except Exception:
+        pass # Ignore errors for individual files
+    term_counts = {}
+    for term in retrieval_terms(body): term_counts[term] = term_counts.get(term, 0) + 1
+    for term in retrieval_terms(summary): term_counts[term] = term_counts.get(term, 0) + RETRIEVAL_HEADER_WEIGHT
+    if len(term_counts) > RETRIEVAL_MAX_TERMS_PER_SCRIPT:
+        term_counts = dict(heapq.nlargest(RETRIEVAL_MAX_TERMS_PER_SCRIPT, term_counts.items(), key=lambda item: item[1]))
+    return {"name": f_name, "mtime": file_mtime, "summary": summary, "terms": term_counts}
+
+def _set_past_file_record(record):
+    PAST_FILES_INDEX[record["name"]] = record
+    PAST_SCRIPT_RETRIEVAL.upsert(record["name"], record.get("terms") or {})
+
+def _drop_past_file_record(f_name):
+    PAST_FILES_INDEX.pop(f_name, None)
+    PAST_SCRIPT_RETRIEVAL.remove(f_name)
+
+def _append_past_files_index_records(records):
+    try:
+        os.makedirs(POOP_STATE_DIR, exist_ok=True)
+        with open(PAST_FILES_INDEX_FILE, "a", encoding="utf-8") as index_file:
+            for record in records: index_file.write(json.dumps(record) + "\n")
+    except OSError:
+        pass # Index stays valid in memory; the next session reconciles
+
+def _compact_past_files_index():
+    # Rewrites the log with one line per live file once dead/superseded lines dominate.
+    try:
+        temp_path = PAST_FILES_INDEX_FILE + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as index_file:
+            for record in PAST_FILES_INDEX.values(): index_file.write(json.dumps(record) + "\n")
+            index_file.write(json.dumps({"dir_mtime_ns": PAST_FILES_INDEX_DIR_MTIME_NS}) + "\n")
+        os.replace(temp_path, PAST_FILES_INDEX_FILE)
+    except OSError:
+        pass
+
+def reconcile_past_files_index(force=False):
+    with _PAST_FILES_INDEX_LOCK: return _reconcile_past_files_index(force)
+
+def _reconcile_past_files_index(force=False):
+    # Loads the index log once, then rescans the directory only when its mtime changed since the last
+    # reconcile (files created/deleted outside POOP). Headers are re-read only for new or changed files.
+    global PAST_FILES_INDEX, PAST_FILES_INDEX_DIR_MTIME_NS
+    log_lines = 0
+    if PAST_FILES_INDEX is None:
+        PAST_FILES_INDEX = {}
+        try:
+            with open(PAST_FILES_INDEX_FILE, "r", encoding="utf-8") as index_file:
+                for index_line in index_file:
+                    try: record = json.loads(index_line)
+                    except ValueError: continue # Torn last line after a crash
+                    log_lines += 1
+                    if "dir_mtime_ns" in record: PAST_FILES_INDEX_DIR_MTIME_NS = record["dir_mtime_ns"]
+                    elif record.get("deleted"): _drop_past_file_record(record["name"])
+                    else: _set_past_file_record(record)
+        except FileNotFoundError:
+            pass
+        if any("terms" not in record for record in PAST_FILES_INDEX.values()): force = True # Indexed before retrieval terms existed
+
+    try: dir_mtime_ns = os.stat(".").st_mtime_ns
+    except OSError: return PAST_FILES_INDEX
+    if not force and dir_mtime_ns == PAST_FILES_INDEX_DIR_MTIME_NS:
+        return PAST_FILES_INDEX
+
+    changed_records, seen_names = [], set()
+    with os.scandir(".") as dir_entries:
+        for dir_entry in dir_entries:
+            if not _is_past_poop_file_name(dir_entry.name): continue
+            seen_names.add(dir_entry.name)
+            try: entry_mtime = dir_entry.stat().st_mtime
+            except OSError: continue
+            known = PAST_FILES_INDEX.get(dir_entry.name)
+            if known and known["mtime"] == entry_mtime and "terms" in known: continue
+            record = _read_poop_file_record(dir_entry.path, dir_entry.name, entry_mtime)
+            _set_past_file_record(record)
+            changed_records.append(record)
+    for vanished_name in set(PAST_FILES_INDEX) - seen_names:
+        _drop_past_file_record(vanished_name)
+        changed_records.append({"name": vanished_name, "deleted": True})
+    os.makedirs(POOP_STATE_DIR, exist_ok=True) # May itself touch the directory mtime, so stat after it
+    try: dir_mtime_ns = os.stat(".").st_mtime_ns
+    except OSError: pass
+    _append_past_files_index_records(changed_records + [{"dir_mtime_ns": dir_mtime_ns}])
+    PAST_FILES_INDEX_DIR_MTIME_NS = dir_mtime_ns
+    if log_lines > 2 * len(PAST_FILES_INDEX) + 100: _compact_past_files_index()
+    return PAST_FILES_INDEX
+
+def index_past_poop_file(file_path):
+    with _PAST_FILES_INDEX_LOCK: _index_past_poop_file(file_path)
+
+def _index_past_poop_file(file_path):
+    # Write hook: keeps the index current for files POOP itself writes, without a directory rescan.
+    global PAST_FILES_INDEX_DIR_MTIME_NS
+    f_name = os.path.basename(file_path)
+    if PAST_FILES_INDEX is None or not _is_past_poop_file_name(f_name): return
+    if os.path.dirname(os.path.abspath(file_path)) != os.getcwd(): return
+    try: file_mtime = os.path.getmtime(file_path)
+    except OSError: return
+    is_new_file = f_name not in PAST_FILES_INDEX
+    record = _read_poop_file_record(file_path, f_name, file_mtime)
+    _set_past_file_record(record)
+    _append_past_files_index_records([record])
+    if is_new_file and PAST_FILES_INDEX_DIR_MTIME_NS is not None:
+        try: PAST_FILES_INDEX_DIR_MTIME_NS = os.stat(".").st_mtime_ns # Our own create; no rescan needed
+        except OSError: return
+        _append_past_files_index_records([{"dir_mtime_ns": PAST_FILES_INDEX_DIR_MTIME_NS}])
+
+def write_code_file(file_path, code_content):
+    with open(file_path, "w", encoding='utf-8') as f: f.write(code_content)
+    index_past_poop_file(file_path)
+
+def recent_past_poop_files(limit=MAX_PAST_FILES_CONTEXT):
+    with _PAST_FILES_INDEX_LOCK:
+        candidates = [record for record in _reconcile_past_files_index().values() if record["summary"]]
+    return heapq.nlargest(limit, candidates, key=lambda record: record["mtime"])
+
+def find_relevant_past_scripts(query_text, top_k=PAST_SCRIPT_RETRIEVAL_TOP_K, exclude_files=()):
+    # Most similar past scripts (BM25 over headers + code) with a code excerpt each, for prompt context.
+    excluded_names = {os.path.basename(f) for f in exclude_files if f}
+    with _PAST_FILES_INDEX_LOCK:
+        try: reconcile_past_files_index()
+        except Exception: return []
+        ranked = [(f_name, score, PAST_FILES_INDEX[f_name]["summary"]) for f_name, score in PAST_SCRIPT_RETRIEVAL.query(query_text, top_k + len(excluded_names))]
+    relevant_scripts = []
+    for f_name, score, summary in ranked:
+        if f_name in excluded_names or score < PAST_SCRIPT_RETRIEVAL_MIN_SCORE: continue
+        try:
+            with open(f_name, "r", encoding="utf-8", errors="replace") as pf:
+                excerpt = "".join(line for line in pf.read(PAST_SCRIPT_EXCERPT_CHARS * 2).splitlines(keepends=True) if not line.startswith("# POOP:"))
+        except OSError:
+            continue
+        if len(excerpt) > PAST_SCRIPT_EXCERPT_CHARS: excerpt = excerpt[:PAST_SCRIPT_EXCERPT_CHARS] + "\n# ... (truncated)"
+        relevant_scripts.append({"name": f_name, "summary": summary, "score": score, "excerpt": excerpt.strip()})
+        if len(relevant_scripts) >= top_k: break
+    return relevant_scripts
+
+def past_scripts_for_code_gen(instruction, plan_context=None):
+    # Retrieval context of a new-script gmc() request. Plan steps compute it on the main thread, as part of the request.
+    return find_relevant_past_scripts(f"{instruction} {plan_context.get('current_step_description', '') if plan_context else ''}",
+                                      top_k=2, exclude_files=[CURRENT_TARGET_FILE])
+
+def format_relevant_past_scripts(relevant_scripts):
+    return "\n".join(
+        f"- {script['name']} (similarity {script['score']:.1f}): {script['summary'] or 'no header'}" + (f"\n```python\n{script['excerpt']}\n```" if script['excerpt'] else "")
+        for script in relevant_scripts
+    )
+
 def load_past_poop_files_context():
     global PAST_POOP_FILES_CONTEXT
     PAST_POOP_FILES_CONTEXT = []
     try:
-        files = [f for f in os.listdir(".") if f.startswith("poop") and f.endswith(".py")]
-        files.sort(key=lambda f: os.path.getmtime(os.path.join(".", f)), reverse=True)
-
-        for f_name in files[:MAX_PAST_FILES_CONTEXT]:
-            try:
-                with open(os.path.join(".", f_name), 'r', encoding='utf-8') as pf:
-                    first_line = pf.readline().strip()
-                    summary = ""
-                    if first_line.startswith("# POOP:"):
-                        summary = first_line.replace("# POOP:", "", 1).strip()
-                        second_line_peek = pf.readline().strip()
-                        if second_line_peek.startswith("# POOP: Overall Goal:"):
-                            goal = second_line_peek.replace("# POOP: Overall Goal:", "",1).strip()
-                            summary = f"{summary} (Part of Goal: {goal})"
-                        PAST_POOP_FILES_CONTEXT.append(f"- {f_name}: {summary}")
-            except Exception:
-                pass # Ignore errors for individual files
+        for record in recent_past_poop_files(MAX_PAST_FILES_CONTEXT):
+            PAST_POOP_FILES_CONTEXT.append(f"- {record['name']}: {record['summary']}")
         if PAST_POOP_FILES_CONTEXT:
             print(f"{POOP_MSG_COLOR}Context from {len(PAST_POOP_FILES_CONTEXT)} recent POOP files loaded.{RESET_COLOR}")
     except Exception as e:
         print(f"{WARNING_COLOR}!Warning: Error scanning for past POOP files: {e}{RESET_COLOR}")
 
+def print_past_poop_files(query=None, limit=20):
+    if query:
+        with _PAST_FILES_INDEX_LOCK:
+            reconcile_past_files_index()
+            ranked = [(PAST_FILES_INDEX[name], score) for name, score in PAST_SCRIPT_RETRIEVAL.query(query, limit)]
+        if not ranked:
+            print(f"{POOP_MSG_COLOR}No past POOP files related to {query!r} in this directory.{RESET_COLOR}"); return
+        print(f"\n{POOP_MSG_COLOR}--- Past POOP Files related to {query!r} (best match first, {len(PAST_FILES_INDEX)} indexed) ---{RESET_COLOR}")
+        for record, score in ranked:
+            print(f"  {BRIGHT_WHITE_COLOR}{record['name']}{RESET_COLOR} [{score:.1f}] ({time.strftime('%Y-%m-%d %H:%M', time.localtime(record['mtime']))}): {record['summary'] or '(no header)'}")
+    else:
+        records = recent_past_poop_files(limit)
+        if not records:
+            print(f"{POOP_MSG_COLOR}No past POOP files in this directory.{RESET_COLOR}"); return
+        print(f"\n{POOP_MSG_COLOR}--- Past POOP Files (newest first, {len(PAST_FILES_INDEX)} indexed) ---{RESET_COLOR}")
+        for record in records:
+            print(f"  {BRIGHT_WHITE_COLOR}{record['name']}{RESET_COLOR} ({time.strftime('%Y-%m-%d %H:%M', time.localtime(record['mtime']))}): {record['summary']}")
+    print(f"{POOP_MSG_COLOR}------------------------------{RESET_COLOR}")
+
 def init_llm(model_name_primary='gemini-2.5-flash-preview-05-20', model_name_secondary='gemini-2.0-flash'):
     global GAK, M_CURRENT_TEXT_MODEL, M_MULTI_CAPABLE_MODEL, M_LIGHT_MODEL
     if not GAK: return False
@@ -322,25 +887,593 @@ def get_llm_response_text(response, model_name_for_error_msg):
     except Exception as e:
         return f"#LLM_ERR: Unexpected error processing LLM response from {model_name_for_error_msg}: {e}\n{traceback.format_exc()}"
 
-def gmp(user_instruction_for_plan, system_info_for_plan, past_files_context_for_plan): # Generate Model Plan
-    planning_model = M_MULTI_CAPABLE_MODEL if M_MULTI_CAPABLE_MODEL else M_CURRENT_TEXT_MODEL
-    if not planning_model: return "#LLM_ERR: No suitable model for planning."
+def _llm_event_loop():
+    global _LLM_LOOP
+    with _LLM_LOOP_LOCK:
+        if _LLM_LOOP is None:
+            _LLM_LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LLM_LOOP.run_forever, name="poop-llm-loop", daemon=True).start()
+    return _LLM_LOOP
+
+def _llm_metrics(model_name):
+    return LLM_CALL_METRICS.setdefault(model_name, {
+        "calls": 0, "errors": 0, "retries": 0, "coalesced": 0, "slo_timeouts": 0, "failovers": 0,
+        "input_tokens": 0, "output_tokens": 0, "latencies": deque(maxlen=LLM_METRICS_WINDOW)
+    })
+
+def _percentile(values, pct):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+async def _acquire_llm_rate_token(model_name):
+    # Token bucket per model. The loop is single-threaded, so check-and-take needs no lock.
+    rate, burst = LLM_RATE_LIMITS.get(model_name.split('/')[-1], LLM_RATE_LIMITS["default"])
+    bucket = _LLM_TOKEN_BUCKETS.setdefault(model_name, [float(burst), time.monotonic()])
+    while True:
+        now = time.monotonic()
+        bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1.0:
+            bucket[0] -= 1.0
+            return
+        await asyncio.sleep((1.0 - bucket[0]) / rate)
+
+def _llm_retry_delay(error, attempt):
+    # Honour a server-provided retry delay (429 RetryInfo) when present, else jittered exponential backoff.
+    for detail in getattr(error, "details", None) or []:
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None and hasattr(retry_delay, "total_seconds"):
+            return min(LLM_RETRY_MAX_DELAY_SECONDS, retry_delay.total_seconds()) + random.uniform(0, 0.5)
+    backoff = min(LLM_RETRY_MAX_DELAY_SECONDS, LLM_RETRY_BASE_DELAY_SECONDS * (2 ** attempt))
+    return backoff / 2 + random.uniform(0, backoff / 2)
+
+async def _llm_generate_with_retries(model, contents, chunk_queue=None):
+    # With chunk_queue, streams chunks into it; a stream is only retried before its first chunk.
+    metrics = _llm_metrics(model.model_name)
+    metrics["calls"] += 1
+    call_started = time.time()
+    for attempt in range(LLM_RETRY_MAX_ATTEMPTS):
+        await _acquire_llm_rate_token(model.model_name)
+        chunks_delivered = 0
+        try:
+            response = await model.generate_content_async(contents, generation_config=GCFG, stream=chunk_queue is not None)
+            usage_source = response
+            if chunk_queue is not None:
+                async for chunk in response:
+                    chunk_queue.put(("chunk", chunk)); chunks_delivered += 1
+                    usage_source = chunk # Streams report cumulative usage; the last chunk has the totals
+            metrics["latencies"].append(time.time() - call_started)
+            record_llm_token_usage(model.model_name, contents, getattr(usage_source, "usage_metadata", None))
+            return response
+        except _LLM_RETRYABLE_ERRORS as e:
+            if chunks_delivered or attempt == LLM_RETRY_MAX_ATTEMPTS - 1:
+                metrics["errors"] += 1
+                raise
+            if isinstance(e, (google.api_core.exceptions.TooManyRequests, google.api_core.exceptions.ResourceExhausted)):
+                _LLM_TOKEN_BUCKETS.get(model.model_name, [0.0, 0.0])[0] = 0.0 # Quota hit: slow every caller of this model down
+            metrics["retries"] += 1
+            delay = _llm_retry_delay(e, attempt)
+            print(f"{WARNING_COLOR}!LLM {model.model_name}: {type(e).__name__}, retrying in {delay:.1f}s (attempt {attempt + 2}/{LLM_RETRY_MAX_ATTEMPTS})...{RESET_COLOR}")
+            await asyncio.sleep(delay)
+        except Exception:
+            metrics["errors"] += 1
+            raise
+
+async def _llm_generate_coalesced(model, contents):
+    # Identical text prompts to the same model that are already in flight share one request. The request is shielded
+    # from any one caller giving up (SLO timeout, Ctrl+C) and only cancelled once no caller waits for it any more.
+    coalesce_key = _llm_cache_key(model.model_name, contents) if isinstance(contents, str) else None
+    if coalesce_key and coalesce_key in _LLM_INFLIGHT:
+        _llm_metrics(model.model_name)["coalesced"] += 1
+        inflight = _LLM_INFLIGHT[coalesce_key]
+    else:
+        inflight = {"task": asyncio.ensure_future(_llm_generate_with_retries(model, contents)), "waiters": 0}
+        if coalesce_key:
+            _LLM_INFLIGHT[coalesce_key] = inflight
+            inflight["task"].add_done_callback(lambda _task: _LLM_INFLIGHT.pop(coalesce_key, None) if _LLM_INFLIGHT.get(coalesce_key) is inflight else None)
+    inflight["waiters"] += 1
+    try:
+        return await asyncio.shield(inflight["task"])
+    except asyncio.CancelledError:
+        if inflight["waiters"] == 1 and not inflight["task"].done():
+            inflight["task"].cancel()
+            if coalesce_key and _LLM_INFLIGHT.get(coalesce_key) is inflight: del _LLM_INFLIGHT[coalesce_key] # New callers start afresh
+        raise
+    finally:
+        inflight["waiters"] -= 1
+
+def _llm_slo_exceeded(model, timeout):
+    metrics = _llm_metrics(model.model_name)
+    metrics["slo_timeouts"] += 1
+    metrics["latencies"].append(timeout) # At least this slow; keeps p95 honest for routing
+    return TimeoutError(f"{model.model_name} exceeded latency SLO of {timeout:g}s")
+
+def llm_generate_content(model, contents, stream=False, timeout=None):
+    # Synchronous front of the async client. Returns the response, or with stream=True an
+    # iterator of response chunks fed live from the event loop. API errors are re-raised here.
+    # timeout bounds the whole call (or the first chunk of a stream) and raises TimeoutError.
+    loop = _llm_event_loop()
+    if not stream:
+        request_future = asyncio.run_coroutine_threadsafe(_llm_generate_coalesced(model, contents), loop)
+        try:
+            return request_future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            request_future.cancel()
+            raise _llm_slo_exceeded(model, timeout)
+        except KeyboardInterrupt:
+            request_future.cancel()
+            raise
+
+    chunk_queue = queue.Queue()
+    async def stream_into_queue():
+        try:
+            await _llm_generate_with_retries(model, contents, chunk_queue)
+            chunk_queue.put(("done", None))
+        except BaseException as e: # Includes cancellation; hand everything to the consumer thread
+            chunk_queue.put(("error", e))
+    def iterate_chunks():
+        request_future = asyncio.run_coroutine_threadsafe(stream_into_queue(), loop)
+        first_chunk_timeout = timeout
+        try:
+            while True:
+                try:
+                    kind, payload = chunk_queue.get(timeout=first_chunk_timeout)
+                except queue.Empty:
+                    raise _llm_slo_exceeded(model, timeout)
+                first_chunk_timeout = None
+                if kind == "chunk": yield payload
+                elif kind == "error": raise payload
+                else: return
+        finally:
+            request_future.cancel() # Consumer stopped early (error/blocked chunk): stop the stream
+    return iterate_chunks()
+
+def _model_p95(model):
+    latencies = list(_llm_metrics(model.model_name)["latencies"])
+    return _percentile(latencies, 95) if len(latencies) >= MODEL_ROUTING_MIN_SAMPLES else None
+
+def route_models(call_kind, code_size=0):
+    # Ordered, de-duplicated candidate models for a call; the first is preferred, the rest are failovers.
+    primary_model = M_MULTI_CAPABLE_MODEL or M_CURRENT_TEXT_MODEL
+    if call_kind in ("plan", "multimodal"):
+        ordered = [primary_model, M_LIGHT_MODEL]
+    elif not MODEL_ROUTING_ENABLED:
+        ordered = [M_CURRENT_TEXT_MODEL, primary_model, M_LIGHT_MODEL]
+    elif call_kind == "chat" or (call_kind == "fix" and code_size < MODEL_ROUTING_LIGHT_MAX_SCRIPT_CHARS and not _AUTO_FIX_ESCALATED):
+        ordered = [M_LIGHT_MODEL, primary_model]
+    else:
+        ordered = [primary_model, M_LIGHT_MODEL]
+
+    candidates = []
+    for model in ordered:
+        if model and model not in candidates: candidates.append(model)
+
+    if MODEL_ROUTING_ENABLED and len(candidates) > 1:
+        slo = MODEL_LATENCY_SLO_SECONDS.get(call_kind)
+        preferred_p95, alternate_p95 = _model_p95(candidates[0]), _model_p95(candidates[1])
+        if slo and preferred_p95 is not None and preferred_p95 > slo and (alternate_p95 is None or alternate_p95 < preferred_p95):
+            candidates[0], candidates[1] = candidates[1], candidates[0] # Measured: preferred model is too slow lately
+    return candidates
+
+def routed_llm_generate(candidate_models, call_kind, contents, stream=False):
+    # Tries candidates in order. Every candidate but the last is bounded by the call kind's latency SLO.
+    # Returns (response_or_chunk_iterator, model_used); re-raises the last model's error.
+    for candidate_index, model in enumerate(candidate_models):
+        has_fallback = candidate_index < len(candidate_models) - 1
+        timeout = MODEL_LATENCY_SLO_SECONDS.get(call_kind) if has_fallback else None
+        try:
+            response = llm_generate_content(model, contents, stream=stream, timeout=timeout)
+            if stream:
+                chunk_iterator = iter(response)
+                first_chunk = next(chunk_iterator, None) # Surface stream setup errors/timeouts while failover is still possible
+                response = chunk_iterator if first_chunk is None else _chain_first_chunk(first_chunk, chunk_iterator)
+            return response, model
+        except (google.api_core.exceptions.GoogleAPIError, TimeoutError) as e:
+            if not has_fallback: raise
+            _llm_metrics(model.model_name)["failovers"] += 1
+            print(f"{WARNING_COLOR}!LLM {model.model_name} failed ({type(e).__name__}: {str(e)[:120]}). Failing over to {candidate_models[candidate_index + 1].model_name}...{RESET_COLOR}")
+
+def _chain_first_chunk(first_chunk, chunk_iterator):
+    yield first_chunk
+    yield from chunk_iterator
+
+def print_llm_call_metrics():
+    print(f"\n{POOP_MSG_COLOR}--- LLM Call Metrics ---{RESET_COLOR}")
+    if not LLM_CALL_METRICS:
+        print(f"{BRIGHT_WHITE_COLOR}No LLM calls made yet.{RESET_COLOR}")
+    for model_name, metrics in LLM_CALL_METRICS.items():
+        latencies = list(metrics["latencies"])
+        p50, p95 = _percentile(latencies, 50), _percentile(latencies, 95)
+        latency_str = f"p50 {p50:.2f}s, p95 {p95:.2f}s over {len(latencies)} calls" if latencies else "no completed calls"
+        print(f"{BRIGHT_WHITE_COLOR}{model_name}:{RESET_COLOR} calls {metrics['calls']}, errors {metrics['errors']}, retries {metrics['retries']}, coalesced {metrics['coalesced']}, SLO timeouts {metrics['slo_timeouts']}, failovers {metrics['failovers']}; {latency_str}; tokens in {metrics['input_tokens']}, out {metrics['output_tokens']}")
+    rate_limits_str = ", ".join(f"{name}: {rate}/s burst {burst}" for name, (rate, burst) in LLM_RATE_LIMITS.items())
+    print(f"{BRIGHT_WHITE_COLOR}Rate limits:{RESET_COLOR} {rate_limits_str}  {BRIGHT_WHITE_COLOR}Max attempts:{RESET_COLOR} {LLM_RETRY_MAX_ATTEMPTS}")
+    print(f"{BRIGHT_WHITE_COLOR}Routing:{RESET_COLOR} {'automatic' if MODEL_ROUTING_ENABLED else 'manual (current model first)'}; SLOs: " + ", ".join(f"{kind} {slo:g}s" for kind, slo in MODEL_LATENCY_SLO_SECONDS.items()))
+    print(f"{POOP_MSG_COLOR}------------------------{RESET_COLOR}")
+
+def stream_llm_response_text(response_stream, model_name_for_error_msg, render_color=None):
+    # Incremental counterpart of get_llm_response_text for generate_content(..., stream=True).
+    # Each chunk is checked for prompt blocks and abnormal finish reasons as it arrives.
+    text_parts = []
+    stream_start = time.time()
+    first_token_time = None
+    finish_reason_val = None
+    candidate = None
+    try:
+        for chunk in response_stream:
+            if chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+                return f"#LLM_ERR: Prompt blocked by API for model {model_name_for_error_msg}. Reason: {chunk.prompt_feedback.block_reason}. Details: {chunk.prompt_feedback.safety_ratings}"
+            if not chunk.candidates: continue
+
+            candidate = chunk.candidates[0]
+            if hasattr(candidate, 'finish_reason'):
+                finish_reason_val = candidate.finish_reason.name if hasattr(candidate.finish_reason, 'name') else candidate.finish_reason
+
+            if candidate.content and candidate.content.parts:
+                for part in candidate.content.parts:
+                    part_text = getattr(part, 'text', "")
+                    if not part_text: continue
+                    if first_token_time is None: first_token_time = time.time()
+                    text_parts.append(part_text)
+                    if render_color:
+                        sys.stdout.write(f"{render_color}{part_text}{RESET_COLOR}"); sys.stdout.flush()
+
+            if finish_reason_val in _LLM_STREAM_STOP_REASONS:
+                safety_ratings_str = str(candidate.safety_ratings) if hasattr(candidate, 'safety_ratings') else "N/A"
+                return f"#LLM_ERR: Model {model_name_for_error_msg} stopped streaming. Finish: {finish_reason_val}. Safety: {safety_ratings_str}"
+    except ValueError as ve:
+        return f"#LLM_ERR: Error reading streamed response from {model_name_for_error_msg} (ValueError): {ve}. Finish: {finish_reason_val}"
+    except AttributeError as ae:
+        return f"#LLM_ERR: Attribute error processing streamed LLM response from {model_name_for_error_msg}: {ae}. Candidate: {str(candidate)[:200]}"
+    finally:
+        total_time = time.time() - stream_start
+        LLM_STREAM_TIMINGS.append({
+            "model": model_name_for_error_msg,
+            "ttft": (first_token_time - stream_start) if first_token_time else None,
+            "total": total_time, "chars": sum(len(t) for t in text_parts)
+        })
+        del LLM_STREAM_TIMINGS[:-LLM_STREAM_TIMINGS_MAX]
+        if render_color and text_parts:
+            ttft_str = f"{first_token_time - stream_start:.2f}s" if first_token_time else "N/A"
+            print(f"\n{POOP_MSG_COLOR}(first token {ttft_str}, total {total_time:.2f}s){RESET_COLOR}")
+
+    if not text_parts:
+        return f"#LLM_ERR: Model {model_name_for_error_msg} returned no text parts (stream). Finish: {finish_reason_val}"
+    return "".join(text_parts)
+
+def clean_llm_code_output(output):
+    # Clean up common markdown formatting if LLM still adds it
+    if output.startswith("```python"): output = output[9:]
+    elif output.startswith("```"): output = output[3:]
+    if output.endswith("```"): output = output[:-3]
+    return output.strip()
+
+def print_llm_stream_stats():
+    print(f"\n{POOP_MSG_COLOR}--- LLM Streaming ---{RESET_COLOR}")
+    print(f"{BRIGHT_WHITE_COLOR}Streaming:{RESET_COLOR} {'on' if LLM_STREAM_OUTPUT else 'off'}")
+    if LLM_STREAM_TIMINGS:
+        ttfts = [t["ttft"] for t in LLM_STREAM_TIMINGS if t["ttft"] is not None]
+        totals = [t["total"] for t in LLM_STREAM_TIMINGS]
+        avg_ttft = f"{sum(ttfts) / len(ttfts):.2f}s" if ttfts else "N/A"
+        print(f"{BRIGHT_WHITE_COLOR}Last {len(LLM_STREAM_TIMINGS)} streams:{RESET_COLOR} avg first token {avg_ttft}, avg total {sum(totals) / len(totals):.2f}s")
+        last = LLM_STREAM_TIMINGS[-1]
+        last_ttft = f"{last['ttft']:.2f}s" if last["ttft"] is not None else "N/A"
+        print(f"{BRIGHT_WHITE_COLOR}Last:{RESET_COLOR} {last['model']}: first token {last_ttft}, total {last['total']:.2f}s, {last['chars']} chars")
+    else:
+        print(f"{BRIGHT_WHITE_COLOR}No streamed responses yet.{RESET_COLOR}")
+    print(f"{POOP_MSG_COLOR}---------------------{RESET_COLOR}")
+
+def _llm_cache_key(model_name, prompt_text):
+    try:
+        gcfg_params = json.dumps(vars(GCFG), sort_keys=True, default=str)
+    except TypeError: # GCFG without __dict__ (e.g. plain dict/proto)
+        gcfg_params = repr(GCFG)
+    key_hash = hashlib.sha256()
+    for key_part in (model_name, gcfg_params, prompt_text):
+        key_hash.update(str(key_part).encode('utf-8', errors='replace'))
+        key_hash.update(b"\x00") # Separator so parts can't run into each other
+    return key_hash.hexdigest()
+
+def _llm_cache_db():
+    # Lazily opens the on-disk store. Returns None if sqlite3 is unavailable or the DB can't be opened.
+    global _LLM_CACHE_DB
+    if _LLM_CACHE_DB is None and sqlite3 is not None:
+        try:
+            os.makedirs(os.path.dirname(LLM_CACHE_DB_FILE), exist_ok=True)
+            _LLM_CACHE_DB = sqlite3.connect(LLM_CACHE_DB_FILE, check_same_thread=False)
+            _LLM_CACHE_DB.execute("CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL, last_used REAL)")
+            _LLM_CACHE_DB.commit()
+        except Exception as e:
+            print(f"{WARNING_COLOR}!Warning: LLM cache DB unavailable, using memory-only cache: {e}{RESET_COLOR}")
+            _LLM_CACHE_DB = False # Don't retry on every call
+    return _LLM_CACHE_DB or None
+
+def llm_cache_get(model_name, prompt_text, bypass=False, one_shot_bypass=True):
+    # Returns (cache_key, cached_text_or_None). A bypassed or disabled lookup always misses. one_shot_bypass=False
+    # neither honours nor consumes LLM_CACHE_BYPASS_NEXT (lookups off the main thread).
+    global LLM_CACHE_BYPASS_NEXT
+    cache_key = _llm_cache_key(model_name, prompt_text)
+    if not LLM_CACHE_ENABLED: return cache_key, None
+    with _LLM_CACHE_LOCK:
+        if bypass or (one_shot_bypass and LLM_CACHE_BYPASS_NEXT):
+            LLM_CACHE_BYPASS_NEXT = False
+            LLM_CACHE_STATS["bypassed"] += 1
+            return cache_key, None
+
+        now = time.time()
+        mem_entry = _LLM_CACHE_MEMORY.get(cache_key)
+        if mem_entry:
+            if now - mem_entry[1] <= LLM_CACHE_TTL_SECONDS:
+                _LLM_CACHE_MEMORY.move_to_end(cache_key)
+                LLM_CACHE_STATS["memory_hits"] += 1
+                return cache_key, mem_entry[0]
+            del _LLM_CACHE_MEMORY[cache_key]
+            LLM_CACHE_STATS["expired"] += 1
+
+        db = _llm_cache_db()
+        if db:
+            try:
+                row = db.execute("SELECT response, created FROM llm_cache WHERE key = ?", (cache_key,)).fetchone()
+                if row and now - row[1] <= LLM_CACHE_TTL_SECONDS:
+                    db.execute("UPDATE llm_cache SET last_used = ? WHERE key = ?", (now, cache_key))
+                    db.commit()
+                    _llm_cache_remember(cache_key, row[0], row[1])
+                    LLM_CACHE_STATS["disk_hits"] += 1
+                    return cache_key, row[0]
+                if row: # Expired on disk
+                    db.execute("DELETE FROM llm_cache WHERE key = ?", (cache_key,))
+                    db.commit()
+                    LLM_CACHE_STATS["expired"] += 1
+            except Exception as e:
+                print(f"{WARNING_COLOR}!Warning: LLM cache read failed: {e}{RESET_COLOR}")
+
+        LLM_CACHE_STATS["misses"] += 1
+        return cache_key, None
+
+def _llm_cache_remember(cache_key, response_text, created):
+    # Memory (LRU) front of the cache. Caller holds _LLM_CACHE_LOCK.
+    _LLM_CACHE_MEMORY[cache_key] = (response_text, created)
+    _LLM_CACHE_MEMORY.move_to_end(cache_key)
+    while len(_LLM_CACHE_MEMORY) > LLM_CACHE_MEMORY_MAX_ENTRIES:
+        _LLM_CACHE_MEMORY.popitem(last=False)
+        LLM_CACHE_STATS["evictions"] += 1
+
+def llm_cache_put(cache_key, model_name, response_text):
+    # Only real answers are cached; errors and empty responses must be retried next time.
+    if not LLM_CACHE_ENABLED or not response_text or not response_text.strip() or response_text.startswith("#LLM_ERR"): return
+    with _LLM_CACHE_LOCK:
+        now = time.time()
+        _llm_cache_remember(cache_key, response_text, now)
+        LLM_CACHE_STATS["stores"] += 1
+        db = _llm_cache_db()
+        if db:
+            try:
+                db.execute("INSERT OR REPLACE INTO llm_cache (key, model, response, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                           (cache_key, model_name, response_text, now, now))
+                db.execute("DELETE FROM llm_cache WHERE created < ?", (now - LLM_CACHE_TTL_SECONDS,))
+                evicted = db.execute("DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                                     (LLM_CACHE_DISK_MAX_ENTRIES,)).rowcount
+                if evicted and evicted > 0: LLM_CACHE_STATS["evictions"] += evicted
+                db.commit()
+            except Exception as e:
+                print(f"{WARNING_COLOR}!Warning: LLM cache write failed: {e}{RESET_COLOR}")
+
+def llm_cache_clear():
+    with _LLM_CACHE_LOCK:
+        _LLM_CACHE_MEMORY.clear()
+        db = _llm_cache_db()
+        if db:
+            try:
+                db.execute("DELETE FROM llm_cache")
+                db.commit()
+            except Exception as e:
+                print(f"{WARNING_COLOR}!Warning: Could not clear LLM cache DB: {e}{RESET_COLOR}")
+
+def print_llm_cache_stats():
+    hits = LLM_CACHE_STATS["memory_hits"] + LLM_CACHE_STATS["disk_hits"]
+    lookups = hits + LLM_CACHE_STATS["misses"]
+    hit_rate = f"{100.0 * hits / lookups:.1f}%" if lookups else "N/A"
+    disk_entries = "N/A"
+    db = _llm_cache_db()
+    if db:
+        try: disk_entries = db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        except Exception: pass
+    print(f"\n{POOP_MSG_COLOR}--- LLM Response Cache ---{RESET_COLOR}")
+    print(f"{BRIGHT_WHITE_COLOR}Enabled:{RESET_COLOR} {LLM_CACHE_ENABLED}{' (next call bypasses cache)' if LLM_CACHE_BYPASS_NEXT else ''}")
+    print(f"{BRIGHT_WHITE_COLOR}Hits:{RESET_COLOR} {hits} (memory: {LLM_CACHE_STATS['memory_hits']}, disk: {LLM_CACHE_STATS['disk_hits']})  {BRIGHT_WHITE_COLOR}Misses:{RESET_COLOR} {LLM_CACHE_STATS['misses']}  {BRIGHT_WHITE_COLOR}Hit rate:{RESET_COLOR} {hit_rate}")
+    print(f"{BRIGHT_WHITE_COLOR}Stores:{RESET_COLOR} {LLM_CACHE_STATS['stores']}  {BRIGHT_WHITE_COLOR}Evictions:{RESET_COLOR} {LLM_CACHE_STATS['evictions']}  {BRIGHT_WHITE_COLOR}Expired:{RESET_COLOR} {LLM_CACHE_STATS['expired']}  {BRIGHT_WHITE_COLOR}Bypassed:{RESET_COLOR} {LLM_CACHE_STATS['bypassed']}")
+    print(f"{BRIGHT_WHITE_COLOR}Entries:{RESET_COLOR} memory {len(_LLM_CACHE_MEMORY)}/{LLM_CACHE_MEMORY_MAX_ENTRIES}, disk {disk_entries}/{LLM_CACHE_DISK_MAX_ENTRIES} ({LLM_CACHE_DB_FILE if db else 'no disk store'})")
+    print(f"{BRIGHT_WHITE_COLOR}TTL:{RESET_COLOR} {LLM_CACHE_TTL_SECONDS}s")
+    print(f"{POOP_MSG_COLOR}--------------------------{RESET_COLOR}")
+
+def record_llm_token_usage(model_name, contents, usage_metadata):
+    # Per-call token accounting from the response's usage metadata; also calibrates the local estimator.
+    if usage_metadata is None: return
+    input_tokens = getattr(usage_metadata, "prompt_token_count", 0) or 0
+    output_tokens = getattr(usage_metadata, "candidates_token_count", 0) or 0
+    metrics = _llm_metrics(model_name)
+    metrics["input_tokens"] += input_tokens
+    metrics["output_tokens"] += output_tokens
+    estimated_input_tokens = None
+    if isinstance(contents, str) and contents and input_tokens:
+        estimated_input_tokens = estimate_tokens(contents, model_name)
+        previous_ratio = _PROMPT_CHARS_PER_TOKEN.get(model_name, PROMPT_CHARS_PER_TOKEN_DEFAULT)
+        _PROMPT_CHARS_PER_TOKEN[model_name] = 0.8 * previous_ratio + 0.2 * (len(contents) / input_tokens)
+    LLM_TOKEN_LOG.append({"model": model_name, "input_tokens": input_tokens, "output_tokens": output_tokens,
+                          "estimated_input_tokens": estimated_input_tokens, "time": time.time()})
+
+def estimate_tokens(text, model_name=None):
+    return int(len(text) / _PROMPT_CHARS_PER_TOKEN.get(model_name, PROMPT_CHARS_PER_TOKEN_DEFAULT)) + 1
+
+def count_prompt_tokens(text, model=None):
+    # Local estimate; with PROMPT_TOKEN_COUNTING == "model", asks the model (one API round trip).
+    model_name = getattr(model, "model_name", None)
+    if PROMPT_TOKEN_COUNTING == "model" and model is not None and hasattr(model, "count_tokens"):
+        try:
+            return model.count_tokens(text).total_tokens
+        except Exception as e:
+            print(f"{WARNING_COLOR}!count_tokens failed for {model_name} ({type(e).__name__}); using the local estimate.{RESET_COLOR}")
+    return estimate_tokens(text, model_name)
+
+_PROMPT_TRIM_MARKER = "... (truncated to fit the prompt budget) ..."
+
+def trim_text_to_budget(text, max_chars, keep="head"):
+    # keep="head" keeps the start, "tail" the end (tracebacks, logs); cuts on line boundaries where possible.
+    if len(text) <= max_chars: return text
+    room = max_chars - len(_PROMPT_TRIM_MARKER) - 1
+    if room <= 0: return ""
+    if keep == "tail":
+        kept = text[-room:]
+        newline_pos = kept.find("\n")
+        if 0 <= newline_pos < room // 4: kept = kept[newline_pos + 1:]
+        return f"{_PROMPT_TRIM_MARKER}\n{kept}"
+    kept = text[:room]
+    newline_pos = kept.rfind("\n")
+    if newline_pos > room * 3 // 4: kept = kept[:newline_pos]
+    return f"{kept}\n{_PROMPT_TRIM_MARKER}"
+
+def trim_code_to_budget(code, max_chars, focus=""):
+    # Shrinks a script without cutting through a definition. First the bodies of top-level functions and
+    # classes not named in `focus` (instruction, traceback) become '...' stubs, earliest first; then whole
+    # top-level statements are dropped from the top (imports last). Unparsable code is trimmed by lines.
+    if len(code) <= max_chars: return code
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return trim_text_to_budget(code, max_chars, "tail")
+    lines = code.splitlines(keepends=True)
+    focus_names = set(re.findall(r"[A-Za-z_]\w*", focus or ""))
+    pieces = [] # [text, stub text or None, keep (focus definition or import)]
+    previous_end = 0
+    for node in tree.body:
+        decorators = getattr(node, "decorator_list", None)
+        start = (decorators[0].lineno if decorators else node.lineno) - 1
+        end = node.end_lineno
+        if start > previous_end: pieces.append(["".join(lines[previous_end:start]), None, False])
+        stub = None
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            body_start = node.body[0].lineno - 1
+            if body_start > start:
+                indent = re.match(r"\s*", lines[body_start]).group(0)
+                stub = "".join(lines[start:body_start]) + f"{indent}...  # body omitted ({end - body_start} lines)\n"
+        keep = getattr(node, "name", None) in focus_names or isinstance(node, (ast.Import, ast.ImportFrom))
+        pieces.append(["".join(lines[start:end]), stub, keep])
+        previous_end = end
+    pieces.append(["".join(lines[previous_end:]), None, False])
+
+    total_chars = sum(len(piece[0]) for piece in pieces)
+    for piece in pieces:
+        if total_chars <= max_chars: break
+        text, stub, keep = piece
+        if stub is not None and not keep and len(stub) < len(text):
+            total_chars -= len(text) - len(stub); piece[0] = stub
+    dropped = 0
+    for allow_kept in (False, True):
+        for piece in pieces:
+            if total_chars <= max_chars: break
+            if piece[0] and (allow_kept or not piece[2]):
+                total_chars -= len(piece[0]); piece[0] = ""; dropped += 1
+    trimmed_code = "".join(piece[0] for piece in pieces)
+    if dropped: trimmed_code = f"# ... ({dropped} earlier top-level blocks omitted to fit the prompt budget) ...\n" + trimmed_code
+    return trimmed_code if len(trimmed_code) <= max_chars else trim_text_to_budget(trimmed_code, max_chars, "tail")
+
+class PromptSection:
+    # A budgeted piece of a prompt. Sections with a higher priority number are trimmed first; plain strings
+    # in a prompt part list are fixed. trim is "head", "tail" or "code" (AST-aware, keeps `focus` names).
+    # max_tokens caps a low-value section even when the whole prompt fits the budget.
+    def __init__(self, text, priority, trim="head", prefix="", suffix="", focus="", name="", max_tokens=None):
+        self.text, self.priority, self.trim = text or "", priority, trim
+        self.prefix, self.suffix, self.focus = prefix, suffix, focus
+        self.name, self.max_tokens = name or trim, max_tokens
+
+    def render(self):
+        return f"{self.prefix}{self.text}{self.suffix}" if self.text else ""
+
+    def shrink_to(self, max_chars):
+        if self.trim == "code": return trim_code_to_budget(self.text, max_chars, self.focus)
+        return trim_text_to_budget(self.text, max_chars, self.trim)
+
+def assemble_prompt(prompt_parts, call_kind, model=None, joiner="\n", quiet=False):
+    # Joins plain strings and PromptSections, trimming sections (lowest priority first) until the
+    # estimated size fits PROMPT_TOKEN_BUDGETS[call_kind]. The report is kept in LAST_PROMPT_REPORTS (unless quiet).
+    model_name = getattr(model, "model_name", None)
+    chars_per_token = _PROMPT_CHARS_PER_TOKEN.get(model_name, PROMPT_CHARS_PER_TOKEN_DEFAULT)
+    budget_tokens = PROMPT_TOKEN_BUDGETS.get(call_kind)
+    sections = [part for part in prompt_parts if isinstance(part, PromptSection)]
+    trimmed = []
+
+    def shrink(section, max_chars):
+        shrunk_text = section.shrink_to(max(0, max_chars))
+        if shrunk_text != section.text:
+            trimmed.append(f"{section.name} {len(section.text)}->{len(shrunk_text)} chars")
+            section.text = shrunk_text
+
+    def render():
+        rendered = [part.render() if isinstance(part, PromptSection) else part for part in prompt_parts]
+        return joiner.join(text for part, text in zip(prompt_parts, rendered) if text or not isinstance(part, PromptSection))
+
+    for section in sections:
+        if section.max_tokens and len(section.text) > section.max_tokens * chars_per_token:
+            shrink(section, int(section.max_tokens * chars_per_token))
+    prompt = render()
+    if budget_tokens:
+        budget_chars = int(budget_tokens * chars_per_token)
+        for section in sorted(sections, key=lambda s: -s.priority):
+            excess_chars = len(prompt) - budget_chars
+            if excess_chars <= 0: break
+            shrink(section, len(section.text) - excess_chars)
+            prompt = render()
+    estimated_tokens = estimate_tokens(prompt, model_name)
+    if budget_tokens and PROMPT_TOKEN_COUNTING == "model" and estimated_tokens > 0.85 * budget_tokens:
+        estimated_tokens = count_prompt_tokens(prompt, model) # Only near the budget, where the estimate's error matters
+
+    if quiet: return prompt
+    LAST_PROMPT_REPORTS[call_kind] = {"estimated_tokens": estimated_tokens, "budget_tokens": budget_tokens, "trimmed": trimmed, "time": time.time()}
+    if trimmed:
+        print(f"{POOP_MSG_COLOR}POOP: {call_kind} prompt trimmed to its {budget_tokens} token budget ({'; '.join(trimmed)}).{RESET_COLOR}")
+    return prompt
+
+def print_prompt_budgets():
+    print(f"\n{POOP_MSG_COLOR}--- Prompt Budgets & Token Usage ---{RESET_COLOR}")
+    print(f"{BRIGHT_WHITE_COLOR}Budgets (tokens):{RESET_COLOR} " + ", ".join(f"{kind} {budget}" for kind, budget in PROMPT_TOKEN_BUDGETS.items()) + f"  {BRIGHT_WHITE_COLOR}Counting:{RESET_COLOR} {PROMPT_TOKEN_COUNTING}")
+    if _PROMPT_CHARS_PER_TOKEN:
+        print(f"{BRIGHT_WHITE_COLOR}Calibrated chars/token:{RESET_COLOR} " + ", ".join(f"{name.split('/')[-1]} {ratio:.2f}" for name, ratio in _PROMPT_CHARS_PER_TOKEN.items()))
+    for call_kind, report in LAST_PROMPT_REPORTS.items():
+        trimmed_str = "; ".join(report["trimmed"]) if report["trimmed"] else "nothing trimmed"
+        print(f"{BRIGHT_WHITE_COLOR}Last {call_kind} prompt:{RESET_COLOR} ~{report['estimated_tokens']}/{report['budget_tokens']} tokens, {trimmed_str}")
+    if FIX_SLICE_STATS["sliced"]:
+        print(f"{BRIGHT_WHITE_COLOR}Sliced fixes:{RESET_COLOR} {FIX_SLICE_STATS['sliced']} (spliced {FIX_SLICE_STATS['spliced']}, whole-script fallbacks {FIX_SLICE_STATS['fallbacks']}), ~{FIX_SLICE_STATS['chars_saved']} prompt chars saved")
+    if CODE_PATCH_STATS["applied"] or CODE_PATCH_STATS["fallbacks"]:
+        output_share = CODE_PATCH_STATS["output_chars"] / CODE_PATCH_STATS["script_chars"] if CODE_PATCH_STATS["script_chars"] else 0
+        print(f"{BRIGHT_WHITE_COLOR}Patch edits ({CODE_EDIT_MODE}):{RESET_COLOR} {CODE_PATCH_STATS['applied']} applied ({CODE_PATCH_STATS['blocks']} blocks, {CODE_PATCH_STATS['fuzzy_blocks']} fuzzy), {CODE_PATCH_STATS['fallbacks']} fell back to full scripts; replies were {output_share:.0%} of the script size")
+    for record in list(LLM_TOKEN_LOG)[-5:]:
+        estimate_str = f" (estimated {record['estimated_input_tokens']})" if record["estimated_input_tokens"] else ""
+        print(f"  {time.strftime('%H:%M:%S', time.localtime(record['time']))} {record['model'].split('/')[-1]}: in {record['input_tokens']}{estimate_str}, out {record['output_tokens']}")
+    print(f"{POOP_MSG_COLOR}------------------------------------{RESET_COLOR}")
+
+def gmp(user_instruction_for_plan, system_info_for_plan, past_files_context_for_plan, bypass_cache=False, relevant_past_scripts=None): # Generate Model Plan
+    candidate_models = route_models("plan")
+    if not candidate_models: return "#LLM_ERR: No suitable model for planning."
+    planning_model = candidate_models[0]
 
     system_info_str = "\n".join([f"{k.replace('_', ' ').title()}: {v}" for k, v in system_info_for_plan.items()])
     past_context_str = "\n".join(past_files_context_for_plan) if past_files_context_for_plan else "No recent POOP activity."
+    relevant_scripts_section = PromptSection(
+        format_relevant_past_scripts(relevant_past_scripts) if relevant_past_scripts else "", priority=2, name="past scripts",
+        prefix="Relevant Past POOP Scripts (most similar earlier work in this directory; where one already does part of this, "
+               "say so in that step's Details and build on its proven code instead of re-deriving it):\n---\n",
+        suffix="\n---"
+    )
 
-    prompt = f"""You are POOP, an AI assistant that creates and executes Python code.
+    prompt_head = f"""You are POOP, an AI assistant that creates and executes Python code.
 First, create a detailed, step-by-step plan for: "{user_instruction_for_plan}"
 
 System Info:
 ---
 {system_info_str}
----
-Recent POOP Activity (other files/tasks):
----
-{past_context_str}
----
-Plan Instructions:
+---"""
+    prompt_instructions = f"""Plan Instructions:
 1. Numbered steps (1., 2., 3.).
 2. For each step, define:
     - `Task:` Concise action for this step.
@@ -354,7 +1487,7 @@ Plan Instructions:
         The first code-generating step in such a sequence can be `Additive_Code: No` (or Yes if adding to an existing buffer).
     - `Requires_User_Input_During_Step:` (Optional) If `Requires_Code_Gen: Yes`, what specific input will the Python script prompt the user for during its execution?
     - `Requires_User_Action:` (Optional) Is there a manual action the user needs to perform OR an internal POOP non-code action (e.g., "POOP will use its AI to describe image at <path_from_previous_step>.")?
-    - `Screenshot_Analysis_Signal:` (Yes/No, only if Requires_Code_Gen: Yes AND the code *takes* a screenshot that POOP's AI should then analyze) If yes, the generated code must print the signal '{IMAGE_ANALYSIS_SIGNAL} <filepath_to_screenshot>'.
+    - `Screenshot_Analysis_Signal:` (Yes/No, only if Requires_Code_Gen: Yes AND the code *takes* a screenshot that POOP's AI should then analyze) If yes, the generated code must hand the screenshot to POOP with `{IMAGE_HANDOFF_MODULE}.analyze_image(image)` (or print the signal '{IMAGE_ANALYSIS_SIGNAL} <filepath_to_screenshot>').
 
 Example Plan for "make a simple pygame snake game":
 1.  Task: Initial Pygame setup and game window.
@@ -380,77 +1513,53 @@ Example Plan for "make a simple pygame snake game":
 
 Return ONLY the numbered plan. Start with "1. Task: ...".
 """
+    prompt = assemble_prompt([
+        prompt_head, PromptSection(past_context_str, priority=3, name="recent activity",
+                                   prefix="Recent POOP Activity (other files/tasks):\n---\n", suffix="\n---"), relevant_scripts_section, prompt_instructions
+    ], "plan", planning_model)
+    cache_key, cached_plan = llm_cache_get(planning_model.model_name, prompt, bypass_cache)
+    if cached_plan is not None:
+        print(f"{POOP_MSG_COLOR}POOP: Using cached plan (LLM response cache hit).{RESET_COLOR}")
+        return cached_plan.strip()
     try:
-        response = planning_model.generate_content(prompt, generation_config=GCFG)
+        response, planning_model = routed_llm_generate(candidate_models, "plan", prompt)
         plan_output = get_llm_response_text(response, planning_model.model_name)
+        llm_cache_put(_llm_cache_key(planning_model.model_name, prompt), planning_model.model_name, plan_output) # Under the model that answered
         return plan_output.strip()
     except google.api_core.exceptions.GoogleAPIError as e:
         return f"#LLM_ERR: API Error during plan generation with {planning_model.model_name}: {e}"
     except Exception as e:
         return f"#LLM_ERR: Error during plan generation with {planning_model.model_name}: {e}\n{traceback.format_exc()}"
 
-def parse_plan_step_details(step_text_content):
+PLAN_STEP_FIELDS = ("task", "details", "dependencies", "outcome", "requires_code_gen", "additive_code",
+                    "requires_user_input_during_step", "requires_user_action", "screenshot_analysis_signal")
+PLAN_STEP_BOOLEAN_FIELDS = ("requires_code_gen", "additive_code", "screenshot_analysis_signal")
+# Field label at the start of a line; tolerates markdown bullets/bold ("- **Details:** ...").
+_PLAN_FIELD_LABEL_RE = re.compile(r"^[\s>*_-]*(" + "|".join(PLAN_STEP_FIELDS) + r")[*_]*\s*:[*_]*\s*(.*)$", re.IGNORECASE)
+_PLAN_STEP_START_RE = re.compile(r"^(\s*)(\d+)\.\s*(.*)$")
+
+def _parse_plan_step_lines(step_lines):
+    # Single pass: a label line opens a field, other lines continue the open field (multi-line
+    # values). Lines before the first label are the task if there is no explicit 'Task:'.
+    fields, preamble_lines, open_field = {}, [], None
+    for line in step_lines:
+        label_match = _PLAN_FIELD_LABEL_RE.match(line)
+        if label_match:
+            field_key = label_match.group(1).lower()
+            open_field = None if field_key in fields else field_key # First occurrence wins
+            if open_field: fields[open_field] = [label_match.group(2).strip()]
+        elif open_field:
+            fields[open_field].append(line.strip())
+        elif not fields:
+            preamble_lines.append(line.strip())
+
     details = {}
-    def extract_field(field_name, text, stop_keywords_list):
-        # More robust pattern: field_name followed by colon, space, then content
-        # Stops at the next field_name or end of text.
-        pattern_str = rf"^\s*{re.escape(field_name)}:\s*(.*?)(?=(" + "|".join(map(lambda kw: r"\n\s*" + re.escape(kw) + ":", stop_keywords_list)) + r")|$)"
-        match = re.search(pattern_str, text, re.DOTALL | re.IGNORECASE | re.MULTILINE)
-        return match.group(1).strip() if match and match.group(1) else None
-
-    all_fields_ordered = ["Task", "Details", "Dependencies", "Outcome", "Requires_Code_Gen", "Additive_Code", "Requires_User_Input_During_Step", "Requires_User_Action", "Screenshot_Analysis_Signal"]
-    current_field_map = {
-        "Task": "task", "Details": "details", "Dependencies": "dependencies", "Outcome": "outcome",
-        "Requires_Code_Gen": "requires_code_gen", "Additive_Code": "additive_code",
-        "Requires_User_Input_During_Step": "requires_user_input_during_step",
-        "Requires_User_Action": "requires_user_action",
-        "Screenshot_Analysis_Signal": "screenshot_analysis_signal"
-    }
-    remaining_text = step_text_content
-
-    # Extract Task first, as it's less strictly formatted sometimes
-    task_match = re.match(r"^\s*Task:\s*(.*?)(?=\n\s*(?:Details:|Dependencies:|Outcome:|Requires_Code_Gen:|Additive_Code:|Requires_User_Input_During_Step:|Requires_User_Action:|Screenshot_Analysis_Signal:|$))", remaining_text, re.DOTALL | re.IGNORECASE)
-    if task_match:
-        details["task"] = task_match.group(1).strip()
-        remaining_text = remaining_text[task_match.end():] # Consume the matched part
-    else: # Fallback if "Task:" label is missing or task is multi-line before other fields
-        temp_remaining_text = remaining_text
-        task_lines = []
-        for line in temp_remaining_text.splitlines(keepends=True):
-            line_stripped_check = line.strip()
-            is_field_label = False
-            for f_kw in all_fields_ordered[1:]: # Check if it's one of the other field labels
-                if line_stripped_check.lower().startswith(f_kw.lower() + ":"):
-                    is_field_label = True
-                    break
-            if not is_field_label and line_stripped_check:
-                task_lines.append(line)
-            elif task_lines: # Stop if we hit a field label after collecting some task lines
-                break
-            elif is_field_label: # If the first content line is already a field, task is likely missing or embedded
-                break
-        if task_lines:
-            details["task"] = "".join(task_lines).strip()
-            # Consume the extracted task lines from remaining_text
-            len_consumed = sum(len(l) for l in task_lines)
-            remaining_text = remaining_text[len_consumed:]
-
-    for i, field_name_caps in enumerate(all_fields_ordered):
-        if field_name_caps == "Task" and "task" in details: continue # Already extracted
-
-        # Create stop keywords for the current field
-        stop_kws_for_current_field = all_fields_ordered[i+1:]
-
-        value = extract_field(field_name_caps, remaining_text, stop_kws_for_current_field)
-        if value:
-            field_key = current_field_map[field_name_caps]
-            if field_key in ["requires_code_gen", "additive_code", "screenshot_analysis_signal"]:
-                details[field_key] = (value.lower() == "yes")
-            else:
-                details[field_key] = value
-            # Attempt to remove the extracted field and its value from remaining_text to avoid re-parsing
-            # This is tricky due to regex overlaps. A simpler way is just to rely on the stop_keywords.
-            # For now, we don't aggressively remove, extract_field should handle it.
+    for field_key, value_lines in fields.items():
+        value = "\n".join(value_lines).strip()
+        if not value: continue
+        details[field_key] = (value.lower() == "yes") if field_key in PLAN_STEP_BOOLEAN_FIELDS else value
+    if "task" not in details and "\n".join(preamble_lines).strip():
+        details["task"] = "\n".join(preamble_lines).strip()
 
     # Defaults if not found
     if "requires_code_gen" not in details: details["requires_code_gen"] = True # Default to True if unspecified
@@ -462,14 +1571,23 @@ def parse_plan_step_details(step_text_content):
         details["screenshot_analysis_signal"] = False
     return details
 
+def parse_plan_step_details(step_text_content):
+    return _parse_plan_step_lines(step_text_content.splitlines())
 
-def parse_plan(plan_text_input):
+def _parse_plan_uncached(plan_text_input):
     parsed_steps_list = []
-    # Regex to find step numbers like "1.", "01.", "  2. "
-    step_pattern = re.compile(r"^\s*(\d+)\.\s*(.*?)(?=(?:\n\s*\d+\.\s*)|$)", re.MULTILINE | re.DOTALL)
-    matches = list(step_pattern.finditer(plan_text_input))
-
-    if not matches and plan_text_input.strip(): # Treat as a single step if no numbered list
+    # Split into numbered steps ("1.", "01.", "  2. ") in the same pass over the lines. Numbered lines
+    # indented deeper than the first step (a list inside Details) stay part of their step.
+    steps_lines, step_indent = [], None
+    for line in plan_text_input.splitlines():
+        step_match = _PLAN_STEP_START_RE.match(line)
+        if step_match and (step_indent is None or len(step_match.group(1).expandtabs()) <= step_indent):
+            if step_indent is None: step_indent = len(step_match.group(1).expandtabs())
+            steps_lines.append([step_match.group(3)])
+        elif steps_lines:
+            steps_lines[-1].append(line)
+
+    if not steps_lines and plan_text_input.strip(): # Treat as a single step if no numbered list
         step_data = parse_plan_step_details(plan_text_input.strip())
         if step_data.get("task"): # Ensure a task was parsed
             parsed_steps_list.append(step_data)
@@ -483,33 +1601,45 @@ def parse_plan(plan_text_input):
              })
         return parsed_steps_list
 
-    for match_obj in matches:
-        # group(1) is the step number, group(2) is the content after "X. "
-        step_content_after_num = match_obj.group(2).strip()
+    for step_lines in steps_lines:
+        step_content_after_num = "\n".join(step_lines).strip()
         if not step_content_after_num: continue # Skip empty steps
 
-        step_data = parse_plan_step_details(step_content_after_num)
+        step_data = _parse_plan_step_lines(step_lines)
 
         if step_data.get("task"): # Ensure a task was parsed
             parsed_steps_list.append(step_data)
         else: # Fallback if detailed parsing fails for a numbered step
-            if step_content_after_num: # If there was some content
-                step_data["task"] = step_content_after_num.splitlines()[0].strip() # Use first line as task
-                if "requires_code_gen" not in step_data: step_data["requires_code_gen"] = True
-                if "additive_code" not in step_data and step_data["requires_code_gen"]: step_data["additive_code"] = False
-                if "screenshot_analysis_signal" not in step_data and step_data["requires_code_gen"]: step_data["screenshot_analysis_signal"] = False
-                parsed_steps_list.append(step_data)
+            step_data["task"] = step_content_after_num.splitlines()[0].strip() # Use first line as task
+            parsed_steps_list.append(step_data)
     return parsed_steps_list
 
-def gmc(current_code="", user_instruction_for_code_gen=LAST_USER_INSTRUCTION, error_feedback=None, previous_task_context_for_code_gen="", system_info_for_code_gen=None, plan_context_for_code_gen=None):
-    global CODE_MODIFIED_BY_LLM_SINCE_LAST_RUN
-    if not M_CURRENT_TEXT_MODEL: return "#LLM_ERR: Current text model not initialized."
+def parse_plan(plan_text_input):
+    # Memoized by plan text hash; callers get fresh step dicts they may mutate.
+    memo_key = hashlib.sha256(plan_text_input.encode("utf-8")).hexdigest()
+    parsed_steps = PLAN_PARSE_MEMO.get(memo_key)
+    if parsed_steps is None:
+        parsed_steps = _parse_plan_uncached(plan_text_input)
+        PLAN_PARSE_MEMO[memo_key] = parsed_steps
+        while len(PLAN_PARSE_MEMO) > PLAN_PARSE_MEMO_MAX_ENTRIES: PLAN_PARSE_MEMO.popitem(last=False)
+    else:
+        PLAN_PARSE_MEMO.move_to_end(memo_key)
+    return [dict(step) for step in parsed_steps]
+
+def _code_gen_prompt(current_code, user_instruction_for_code_gen, error_feedback, previous_task_context_for_code_gen, system_info_for_code_gen, plan_context_for_code_gen, fix_slice=None, patch_mode=False, relevant_past_scripts=None, quiet=False):
+    # gmc()'s prompt: (call_kind, candidate_models, prompt), or an #LLM_ERR string. Touches no state but the prompt
+    # report, and not even that when quiet.
+    call_kind = "fix" if error_feedback else "code"
+    candidate_models = route_models(call_kind, len(fix_slice or current_code or ""))
+    if not candidate_models: return "#LLM_ERR: Current text model not initialized."
+    code_model = candidate_models[0]
 
     is_additive_from_plan = plan_context_for_code_gen.get("is_additive", False) if plan_context_for_code_gen else False
 
     prompt_parts = [
         "You are a Python expert. Create, modify, or debug Python scripts. Use standard libraries. Add imports. Return ONLY raw Python code, no explanations or markdown backticks unless the code itself requires it (e.g. in a string).",
-        f"If the task involves taking a screenshot AND the plan context (if provided) indicates 'Screenshot_Analysis_Signal: Yes' OR the task description strongly implies POOP should analyze the screenshot, the script MUST print the exact signal: '{IMAGE_ANALYSIS_SIGNAL} /path/to/screenshot.png' (using the actual, valid path to the saved image)."
+        f"If the task involves taking a screenshot AND the plan context (if provided) indicates 'Screenshot_Analysis_Signal: Yes' OR the task description strongly implies POOP should analyze the screenshot, the script MUST hand it to POOP: `import {IMAGE_HANDOFF_MODULE}` (always available, no install) and call `{IMAGE_HANDOFF_MODULE}.analyze_image(image)` with the PIL image, numpy uint8 array (pass bgr=True for OpenCV arrays) or mss screenshot, without saving it first. "
+        f"Only if that is not possible, save the image and print the exact signal: '{IMAGE_ANALYSIS_SIGNAL} /path/to/screenshot.png' (using the actual, valid path to the saved image)."
     ]
     if is_additive_from_plan and current_code:
         prompt_parts.append("You are ADDING to existing code. Do NOT repeat imports or setup already present in the 'CURRENT SCRIPT' unless necessary for the new part. Focus on implementing the new functionality as an addition.")
@@ -522,7 +1652,7 @@ def gmc(current_code="", user_instruction_for_code_gen=LAST_USER_INSTRUCTION, er
 
     if previous_task_context_for_code_gen: # This is LAST_SUCCESSFUL_TASK_DESCRIPTION
         prompt_parts.append(f"\n--- CONTEXT FROM PREVIOUS SUCCESSFUL OPERATION ---")
-        prompt_parts.append(f"{previous_task_context_for_code_gen[:1000]}{'...' if len(previous_task_context_for_code_gen)>1000 else ''}") # Truncate if too long
+        prompt_parts.append(PromptSection(previous_task_context_for_code_gen, priority=4, name="previous context", max_tokens=400))
         prompt_parts.append("This might include previous user goals or script output summaries. Consider it for continuity if relevant.")
 
 
@@ -530,7 +1660,7 @@ def gmc(current_code="", user_instruction_for_code_gen=LAST_USER_INSTRUCTION, er
         prompt_parts.append("\n--- EXECUTING PLAN STEP ---")
         prompt_parts.append(f"Overall Goal of the Plan: {plan_context_for_code_gen.get('overall_goal', LAST_USER_INSTRUCTION)}")
         if plan_context_for_code_gen.get("full_plan"):
-            prompt_parts.append(f"Full Plan (for broader context, current step is key):\n{plan_context_for_code_gen['full_plan'][:500]}{'...' if len(plan_context_for_code_gen['full_plan']) > 500 else ''}")
+            prompt_parts.append(PromptSection(plan_context_for_code_gen["full_plan"], priority=3, prefix="Full Plan (for broader context, current step is key):\n", name="full plan", max_tokens=1500))
         prompt_parts.append(f"Current Step Task: {plan_context_for_code_gen.get('current_step_description','N/A')}")
         if plan_context_for_code_gen.get("current_step_details"):
             prompt_parts.append(f"Details for Current Step: {plan_context_for_code_gen['current_step_details']}")
@@ -538,7 +1668,7 @@ def gmc(current_code="", user_instruction_for_code_gen=LAST_USER_INSTRUCTION, er
         if plan_context_for_code_gen.get("requires_user_input_during_step"):
             prompt_parts.append(f"The Python script for this step MUST prompt the user for the following information during its execution: {plan_context_for_code_gen['requires_user_input_during_step']}")
         if plan_context_for_code_gen.get("screenshot_analysis_signal"): # This is a boolean from parsed plan
-            prompt_parts.append(f"This step has 'Screenshot_Analysis_Signal: Yes'. Ensure the script prints '{IMAGE_ANALYSIS_SIGNAL} <filepath_to_screenshot>' if it captures an image for POOP's AI to analyze.")
+            prompt_parts.append(f"This step has 'Screenshot_Analysis_Signal: Yes'. Ensure the script calls `{IMAGE_HANDOFF_MODULE}.analyze_image(image)` (or prints '{IMAGE_ANALYSIS_SIGNAL} <filepath_to_screenshot>') if it captures an image for POOP's AI to analyze.")
         if is_additive_from_plan:
             prompt_parts.append("This is an ADDITIVE step. The generated code will be appended to the existing script content. Do not redefine existing functions/classes from the 'CURRENT SCRIPT' unless the goal is to modify them. Add new logic or extend existing logic. Only provide the new/additional code.")
 
@@ -549,55 +1679,540 @@ def gmc(current_code="", user_instruction_for_code_gen=LAST_USER_INSTRUCTION, er
             prompt_parts.append(f"The script was intended for plan step: {plan_context_for_code_gen['current_step_description']}")
         prompt_parts.append(f"Original instruction for this code segment: {user_instruction_for_code_gen}")
 
-        code_for_error_prompt = current_code # This is the full buffer that failed
-        if len(code_for_error_prompt) > 1500 : # Truncate if extremely long
-            code_for_error_prompt = f"... (previous code, possibly truncated) ...\n{current_code[-1500:]}"
-        prompt_parts.append(f"FAULTY SCRIPT (or relevant part that caused the error):\n```python\n{code_for_error_prompt}\n```")
-        prompt_parts.append(f"ERROR MESSAGE AND TRACEBACK:\n```\n{error_feedback}\n```")
-        prompt_parts.append("Provide the FIXED Python script. If it was an additive step, ensure the fix integrates correctly, potentially modifying the whole script if necessary or just the additive part if the error was localized there. Output only the raw code for the complete fixed script (or fixed additive part if that's clearly identifiable and sufficient).")
+        if fix_slice:
+            prompt_parts.append(f"The failing script has {len(current_code.splitlines())} lines. Only the segments relevant to the traceback are shown; line numbers refer to the whole script and everything else is unchanged.")
+            prompt_parts.append(PromptSection(fix_slice, priority=1, trim="tail", name="script segments",
+                                              prefix="SCRIPT SEGMENTS:\n```python\n", suffix="\n```"))
+        else: # The full buffer that failed; over budget, definitions not named in the traceback are stubbed first
+            prompt_parts.append(PromptSection(current_code, priority=1, trim="code", focus=error_feedback, name="faulty script",
+                                              prefix="FAULTY SCRIPT (or relevant part that caused the error):\n```python\n", suffix="\n```"))
+        prompt_parts.append(PromptSection(error_feedback, priority=2, trim="tail", name="traceback",
+                                          prefix="ERROR MESSAGE AND TRACEBACK:\n```\n", suffix="\n```"))
+        if patch_mode:
+            prompt_parts.append(f"Fix the error with minimal edits. {CODE_PATCH_FORMAT_INSTRUCTIONS}")
+        elif fix_slice:
+            prompt_parts.append(
+                "Fix the error by editing these segments. Output ONLY the segments you change, each in full, starting with its exact "
+                "'# >>> POOP SEGMENT n' marker line and ending with its '# <<< POOP SEGMENT n' line, keeping the original indentation. "
+                "Omit unchanged segments. New top-level code that fits no segment (e.g. a missing import) goes in a "
+                "'# >>> POOP SEGMENT NEW' ... '# <<< POOP SEGMENT NEW' block, which is inserted at the top of the script. No explanations."
+            )
+        else: prompt_parts.append("Provide the FIXED Python script. If it was an additive step, ensure the fix integrates correctly, potentially modifying the whole script if necessary or just the additive part if the error was localized there. Output only the raw code for the complete fixed script (or fixed additive part if that's clearly identifiable and sufficient).")
     elif current_code : # Modifying existing script (could be additive base) or first part of additive
         task_type = "Add to the existing script" if is_additive_from_plan else "Modify the existing script"
         prompt_parts.append(f"\n--- CODE MODIFICATION TASK ---")
         if plan_context_for_code_gen and plan_context_for_code_gen.get("current_step_description"):
              prompt_parts.append(f"This work is for plan step: {plan_context_for_code_gen['current_step_description']}")
-        prompt_parts.append(f"CURRENT SCRIPT (the code you are adding to or modifying):\n```python\n{current_code}\n```")
+        prompt_parts.append(PromptSection(current_code, priority=1, trim="code", focus=f"{user_instruction_for_code_gen} {plan_context_for_code_gen.get('current_step_details', '') if plan_context_for_code_gen else ''}",
+                                          name="current script", prefix="CURRENT SCRIPT (the code you are adding to or modifying):\n```python\n", suffix="\n```"))
         prompt_parts.append(f"NEW INSTRUCTION (what to add or change based on the current plan step or user request): {user_instruction_for_code_gen}")
         prompt_parts.append("Provide the PYTHON SCRIPT. If additive, provide only the new code to append. If not additive (i.e., modifying), provide the full modified script. Raw code only.")
-        CODE_MODIFIED_BY_LLM_SINCE_LAST_RUN = True
     else: # No current_code, so generate new script from scratch
         prompt_parts.append("\n--- NEW SCRIPT TASK ---")
         if plan_context_for_code_gen and plan_context_for_code_gen.get("current_step_description"):
             prompt_parts.append(f"This new script is for plan step: {plan_context_for_code_gen['current_step_description']}")
         prompt_parts.append(f"INSTRUCTION: {user_instruction_for_code_gen}")
+        if relevant_past_scripts is None: relevant_past_scripts = past_scripts_for_code_gen(user_instruction_for_code_gen, plan_context_for_code_gen)
+        if relevant_past_scripts:
+            prompt_parts.append(PromptSection(format_relevant_past_scripts(relevant_past_scripts), priority=5, name="past scripts",
+                                              prefix="\n--- RELEVANT PAST POOP SCRIPTS (worked before in this directory; reuse what fits) ---\n"))
         prompt_parts.append("Provide the PYTHON SCRIPT (raw code only):")
-        CODE_MODIFIED_BY_LLM_SINCE_LAST_RUN = True
 
-    full_prompt = "\n".join(prompt_parts)
-    # print(f"\n{WARNING_COLOR}DEBUG: GMC Prompt:\n{full_prompt[:1000]}...{RESET_COLOR}\n") # For debugging
+    full_prompt = assemble_prompt(prompt_parts, call_kind, code_model, quiet=quiet)
+    return call_kind, candidate_models, full_prompt
+
+def _generate_code_from_prompt(call_kind, candidate_models, full_prompt, cached_output=None, stream=False):
+    code_model = candidate_models[0]
+    output = cached_output
     try:
-        response = M_CURRENT_TEXT_MODEL.generate_content(full_prompt, generation_config=GCFG)
-        output = get_llm_response_text(response, M_CURRENT_TEXT_MODEL.model_name)
-        if output.startswith("#LLM_ERR"): return output
-
-        # Clean up common markdown formatting if LLM still adds it
-        if output.startswith("```python"): output = output[9:]
-        elif output.startswith("```"): output = output[3:]
-        if output.endswith("```"): output = output[:-3]
-        return output.strip()
+        if output is None:
+            if stream:
+                response, code_model = routed_llm_generate(candidate_models, call_kind, full_prompt, stream=True)
+                print(f"{AI_RESPONSE_COLOR}--- Streaming code from {code_model.model_name} ---{RESET_COLOR}")
+                output = stream_llm_response_text(response, code_model.model_name, AI_RESPONSE_COLOR)
+            else:
+                response, code_model = routed_llm_generate(candidate_models, call_kind, full_prompt)
+                output = get_llm_response_text(response, code_model.model_name)
+            if output.startswith("#LLM_ERR"): return output
+            llm_cache_put(_llm_cache_key(code_model.model_name, full_prompt), code_model.model_name, output) # Under the model that answered
+        return clean_llm_code_output(output)
     except google.api_core.exceptions.GoogleAPIError as e:
-        return f"#LLM_ERR: API Error during code generation with {M_CURRENT_TEXT_MODEL.model_name}: {e}"
+        return f"#LLM_ERR: API Error during code generation with {code_model.model_name}: {e}"
     except Exception as e:
-        return f"#LLM_ERR: Error during Python code generation with {M_CURRENT_TEXT_MODEL.model_name}: {e}\n{traceback.format_exc()}"
+        return f"#LLM_ERR: Error during Python code generation with {code_model.model_name}: {e}\n{traceback.format_exc()}"
+
+def gmc(current_code="", user_instruction_for_code_gen=LAST_USER_INSTRUCTION, error_feedback=None, previous_task_context_for_code_gen="", system_info_for_code_gen=None, plan_context_for_code_gen=None, bypass_cache=False, stream=None, fix_slice=None, patch_mode=False, relevant_past_scripts=None):
+    # fix_slice: segments of current_code from build_fix_slice; the reply is then changed segments, not a script.
+    # patch_mode (fixes only): the reply is SEARCH/REPLACE blocks against current_code (see apply_search_replace_blocks).
+    global CODE_MODIFIED_BY_LLM_SINCE_LAST_RUN
+    code_prompt = _code_gen_prompt(current_code, user_instruction_for_code_gen, error_feedback, previous_task_context_for_code_gen, system_info_for_code_gen,
+                                   plan_context_for_code_gen, fix_slice, patch_mode, relevant_past_scripts)
+    if isinstance(code_prompt, str): return code_prompt
+    call_kind, candidate_models, full_prompt = code_prompt
+    CODE_MODIFIED_BY_LLM_SINCE_LAST_RUN = True
+    if stream is None: stream = LLM_STREAM_OUTPUT
+    _, output = llm_cache_get(candidate_models[0].model_name, full_prompt, bypass_cache)
+    if output is not None: print(f"{POOP_MSG_COLOR}POOP: Using cached code (LLM response cache hit).{RESET_COLOR}")
+    return _generate_code_from_prompt(call_kind, candidate_models, full_prompt, output, stream)
+
+def gmc_speculative(current_code="", user_instruction_for_code_gen="", previous_task_context_for_code_gen="", system_info_for_code_gen=None, plan_context_for_code_gen=None, relevant_past_scripts=None):
+    # gmc() for prefetch worker threads: writes no globals, prints nothing, never streams, and leaves the one-shot
+    # cache bypass (LLM_CACHE_BYPASS_NEXT) to the main thread.
+    code_prompt = _code_gen_prompt(current_code, user_instruction_for_code_gen, None, previous_task_context_for_code_gen, system_info_for_code_gen,
+                                   plan_context_for_code_gen, relevant_past_scripts=relevant_past_scripts, quiet=True)
+    if isinstance(code_prompt, str): return code_prompt
+    call_kind, candidate_models, full_prompt = code_prompt
+    _, output = llm_cache_get(candidate_models[0].model_name, full_prompt, one_shot_bypass=False)
+    return _generate_code_from_prompt(call_kind, candidate_models, full_prompt, output)
+
+_IMAGE_UPLOAD_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+def _image_resample(name):
+    return getattr(getattr(Image, "Resampling", Image), name)
+
+def downsample_image_for_upload(pil_img):
+    # Copy whose longest edge is at most IMAGE_MAX_EDGE (the image itself when it's already small enough).
+    if not IMAGE_MAX_EDGE or max(pil_img.size) <= IMAGE_MAX_EDGE: return pil_img
+    scale = IMAGE_MAX_EDGE / max(pil_img.size)
+    return pil_img.resize((max(1, round(pil_img.width * scale)), max(1, round(pil_img.height * scale))), _image_resample("LANCZOS"), reducing_gap=3.0)
+
+def encode_image_for_upload(pil_img, source_bytes=None, source_format=None):
+    # {'mime_type', 'data'} in IMAGE_UPLOAD_FORMAT/IMAGE_UPLOAD_QUALITY. An unscaled source file that's already a
+    # supported format and smaller than the re-encoded image is uploaded as is.
+    upload_format = (IMAGE_UPLOAD_FORMAT or "JPEG").upper()
+    if upload_format not in _IMAGE_UPLOAD_MIME_TYPES: upload_format = "JPEG"
+    keeps_alpha = upload_format != "JPEG" and pil_img.mode in ("RGBA", "LA")
+    if pil_img.mode not in ("RGB", "L") and not keeps_alpha: pil_img = pil_img.convert("RGB")
+    encoded = io.BytesIO()
+    if upload_format == "PNG": pil_img.save(encoded, format="PNG", optimize=True)
+    else: pil_img.save(encoded, format=upload_format, quality=IMAGE_UPLOAD_QUALITY)
+    if source_bytes is not None and source_format in _IMAGE_UPLOAD_MIME_TYPES and len(source_bytes) <= encoded.tell():
+        return {"mime_type": _IMAGE_UPLOAD_MIME_TYPES[source_format], "data": source_bytes}
+    return {"mime_type": _IMAGE_UPLOAD_MIME_TYPES[upload_format], "data": encoded.getvalue()}
+
+def image_mean_color(pil_img):
+    # Mean RGB, so flat images of different colours (all-zero hashes) don't share a description.
+    return [round(channel) for channel in ImageStat.Stat(pil_img.convert("RGB").resize((16, 16), _image_resample("BOX"))).mean]
+
+def image_pixel_hash(pil_img):
+    # sha256 of the decoded pixels (mode, size, raw bytes): the exact cache key, independent of the file encoding.
+    pixel_hash = hashlib.sha256(f"{pil_img.mode} {pil_img.width}x{pil_img.height}\n".encode("ascii"))
+    pixel_hash.update(pil_img.tobytes())
+    return pixel_hash.hexdigest()
+
+def image_difference_hash(pil_img, hash_size=None):
+    # dHash: grayscale (hash_size+1) x hash_size thumbnail, each pixel compared with its right neighbour. hash_size**2 bits.
+    hash_size = hash_size or IMAGE_DESC_HASH_SIZE
+    thumb = pil_img.convert("L").resize((hash_size + 1, hash_size), _image_resample("BOX"))
+    if np is not None:
+        pixels = np.asarray(thumb, dtype=np.int16)
+        return int.from_bytes(np.packbits((pixels[:, 1:] > pixels[:, :-1]).ravel()).tobytes(), "big")
+    pixels = list(thumb.getdata())
+    difference_hash = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            difference_hash = (difference_hash << 1) | (pixels[row * (hash_size + 1) + col + 1] > pixels[row * (hash_size + 1) + col])
+    return difference_hash
+
+def _image_prompt_key(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+def _image_desc_cache():
+    global IMAGE_DESC_CACHE
+    if IMAGE_DESC_CACHE is None:
+        try:
+            with open(IMAGE_DESC_CACHE_FILE, "r", encoding="utf-8") as f_cache: IMAGE_DESC_CACHE = json.load(f_cache)
+        except (OSError, ValueError):
+            IMAGE_DESC_CACHE = []
+    return IMAGE_DESC_CACHE
+
+def _save_image_desc_cache():
+    try:
+        os.makedirs(POOP_STATE_DIR, exist_ok=True)
+        temp_path = f"{IMAGE_DESC_CACHE_FILE}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f_cache: json.dump(IMAGE_DESC_CACHE, f_cache)
+        os.replace(temp_path, IMAGE_DESC_CACHE_FILE)
+    except OSError as e:
+        print(f"{WARNING_COLOR}!Could not save image description cache: {e}{RESET_COLOR}")
+
+def image_desc_cache_lookup(pixel_hash, prompt, difference_hash=None, mean_color=None):
+    # Cached description for the same prompt: identical pixels, or (with difference_hash, i.e. near-duplicate matching on)
+    # the closest dHash within IMAGE_DESC_CACHE_MAX_DISTANCE bits. Returns (entry, distance) or (None, None); distance 0 for identical pixels.
+    prompt_key = _image_prompt_key(prompt)
+    best_entry, best_distance = None, None
+    with _IMAGE_DESC_LOCK:
+        for entry in _image_desc_cache():
+            if entry.get("prompt") != prompt_key or "pixels" not in entry: continue
+            if entry["pixels"] == pixel_hash:
+                best_entry, best_distance = entry, 0
+                break
+            if difference_hash is None or not entry.get("dhash"): continue
+            if max(abs(a - b) for a, b in zip(entry.get("mean", mean_color), mean_color)) > IMAGE_DESC_CACHE_MAX_COLOR_DELTA: continue
+            distance = bin(int(entry["dhash"], 16) ^ difference_hash).count("1")
+            if distance <= IMAGE_DESC_CACHE_MAX_DISTANCE and (best_distance is None or distance < best_distance):
+                best_entry, best_distance = entry, distance
+        if best_entry is not None:
+            best_entry["hits"] = best_entry.get("hits", 0) + 1
+            best_entry["last_used"] = time.time()
+    return best_entry, best_distance
+
+def image_desc_cache_store(pixel_hash, difference_hash, mean_color, prompt, description, source_name):
+    with _IMAGE_DESC_LOCK:
+        cache_entries = _image_desc_cache()
+        cache_entries.append({"pixels": pixel_hash, "dhash": f"{difference_hash:x}", "mean": mean_color, "prompt": _image_prompt_key(prompt),
+                              "description": description, "source": source_name, "created": time.time(), "last_used": time.time(), "hits": 0})
+        if len(cache_entries) > IMAGE_DESC_CACHE_MAX_ENTRIES:
+            cache_entries.sort(key=lambda entry: entry.get("last_used", 0))
+            del cache_entries[:len(cache_entries) - IMAGE_DESC_CACHE_MAX_ENTRIES]
+        _save_image_desc_cache()
+
+def describe_image(pil_img, source_name="image", original_bytes=0, text_prompt="Describe this image in detail.", source_data=None):
+    # Hash -> cache lookup -> downsample, encode and gmc_multimodal on a miss. Returns (description, info); description
+    # may be '#LLM_ERR...'. source_data is the encoded source file, uploaded as is when it's smaller than re-encoding the (unscaled) image.
+    started = time.perf_counter()
+    pixel_hash = image_pixel_hash(pil_img)
+    difference_hash, mean_color = image_difference_hash(pil_img), image_mean_color(pil_img)
+    info = {"cached": False, "distance": None, "original_bytes": original_bytes, "uploaded_bytes": 0, "size": pil_img.size,
+            "hash": pixel_hash, "preprocess_seconds": 0.0, "llm_seconds": 0.0}
+    with _IMAGE_DESC_LOCK:
+        IMAGE_DESC_STATS["calls"] += 1
+        IMAGE_DESC_STATS["original_bytes"] += original_bytes
+    if IMAGE_DESC_CACHE_ENABLED:
+        cached_entry, distance = image_desc_cache_lookup(pixel_hash, text_prompt, *((difference_hash, mean_color) if IMAGE_DESC_CACHE_NEAR_DUPLICATES else ()))
+        if cached_entry is not None:
+            info.update(cached=True, distance=distance, preprocess_seconds=time.perf_counter() - started)
+            with _IMAGE_DESC_LOCK:
+                IMAGE_DESC_STATS["hits"] += 1
+                IMAGE_DESC_STATS["preprocess_seconds"] += info["preprocess_seconds"]
+            return cached_entry["description"], info
+    upload_img = downsample_image_for_upload(pil_img)
+    upload_part = encode_image_for_upload(upload_img, source_data if upload_img is pil_img else None, pil_img.format)
+    info["size"] = upload_img.size
+    llm_started = time.perf_counter()
+    description = gmc_multimodal(upload_part, text_prompt)
+    info.update(uploaded_bytes=len(upload_part["data"]), preprocess_seconds=llm_started - started, llm_seconds=time.perf_counter() - llm_started)
+    with _IMAGE_DESC_LOCK:
+        IMAGE_DESC_STATS["misses"] += 1
+        IMAGE_DESC_STATS["uploaded_bytes"] += info["uploaded_bytes"]
+        IMAGE_DESC_STATS["preprocess_seconds"] += info["preprocess_seconds"]
+        IMAGE_DESC_STATS["llm_seconds"] += info["llm_seconds"]
+        if description.startswith("#LLM_ERR"): IMAGE_DESC_STATS["errors"] += 1
+    if IMAGE_DESC_CACHE_ENABLED and not description.startswith("#LLM_ERR"):
+        image_desc_cache_store(pixel_hash, difference_hash, mean_color, text_prompt, description, source_name)
+    return description, info
+
+def describe_image_file(image_path, text_prompt="Describe this image in detail."):
+    with open(image_path, "rb") as f_image: source_data = f_image.read()
+    with Image.open(io.BytesIO(source_data)) as pil_img:
+        if IMAGE_MAX_EDGE: pil_img.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE)) # JPEG sources decode at reduced scale
+        return describe_image(pil_img, os.path.basename(image_path), len(source_data), text_prompt, source_data)
+
+def format_image_desc_info(info):
+    if info["cached"]: return f"cached, {'identical pixels' if not info['distance'] else str(info['distance']) + ' dHash bit(s) from a described image'}"
+    return (f"{info['original_bytes'] / 1024:.0f} KB -> {info['uploaded_bytes'] / 1024:.0f} KB uploaded at {info['size'][0]}x{info['size'][1]}, "
+            f"{info['llm_seconds']:.2f}s")
+
+def print_image_desc_stats():
+    stats = IMAGE_DESC_STATS
+    print(f"\n{POOP_MSG_COLOR}--- Image preprocessing & description cache ({'on' if IMAGE_DESC_CACHE_ENABLED else 'off'}) ---{RESET_COLOR}")
+    print(f"{BRIGHT_WHITE_COLOR}Upload:{RESET_COLOR} max edge {IMAGE_MAX_EDGE or 'original'}, {IMAGE_UPLOAD_FORMAT}"
+          f"{'' if IMAGE_UPLOAD_FORMAT.upper() == 'PNG' else f' quality {IMAGE_UPLOAD_QUALITY}'}; cache: identical pixels{f', near duplicates within {IMAGE_DESC_CACHE_MAX_DISTANCE} of {IMAGE_DESC_HASH_SIZE ** 2} dHash bits' if IMAGE_DESC_CACHE_NEAR_DUPLICATES else ''}")
+    hit_rate = 100.0 * stats["hits"] / stats["calls"] if stats["calls"] else 0.0
+    print(f"{BRIGHT_WHITE_COLOR}This session:{RESET_COLOR} {stats['calls']} image(s), {stats['hits']} cache hits ({hit_rate:.0f}%), "
+          f"{stats['misses']} uploaded, {stats['errors']} error(s)")
+    if stats["misses"]:
+        print(f"{BRIGHT_WHITE_COLOR}Uploaded:{RESET_COLOR} {stats['uploaded_bytes'] / 1024:.0f} KB total "
+              f"(source files {stats['original_bytes'] / 1024:.0f} KB), avg model latency {stats['llm_seconds'] / stats['misses']:.2f}s")
+    if stats["calls"]:
+        print(f"{BRIGHT_WHITE_COLOR}Local work:{RESET_COLOR} avg {1000 * stats['preprocess_seconds'] / stats['calls']:.1f} ms per image "
+              f"(hash and cache lookup; downsample and encode on a miss)")
+    print(f"{BRIGHT_WHITE_COLOR}Cached descriptions:{RESET_COLOR} {len(_image_desc_cache())} in {IMAGE_DESC_CACHE_FILE}")
+    handoffs = IMAGE_HANDOFF_STATS
+    copy_note = f", avg {1000 * handoffs['seconds'] / handoffs['received']:.1f} ms to copy out" if handoffs["received"] else ""
+    print(f"{BRIGHT_WHITE_COLOR}Script handoffs:{RESET_COLOR} {handoffs['received']} via shared memory ({handoffs['bytes'] / 1048576:.1f} MB{copy_note}), "
+          f"{handoffs['failed']} unreadable, {handoffs['path_signals']} path signal(s){'' if IMAGE_HANDOFF_ENABLED and shared_memory is not None else ' (shared memory off)'}")
+    print(f"{POOP_MSG_COLOR}-------------------------------------------------{RESET_COLOR}")
+
+def expand_image_paths(patterns):
+    # Files, directories (recursively, image extensions only) and globs ('**' allowed) -> sorted unique absolute paths.
+    image_paths = set()
+    for pattern in patterns:
+        pattern = os.path.expanduser(pattern)
+        matches = glob.glob(pattern, recursive=True) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            if os.path.isdir(match):
+                for dir_path, dir_names, file_names in os.walk(match):
+                    dir_names[:] = [d for d in dir_names if not d.startswith(".")]
+                    image_paths.update(os.path.abspath(os.path.join(dir_path, name)) for name in file_names if name.lower().endswith(IMAGE_BATCH_EXTENSIONS))
+            elif os.path.isfile(match) and (match == pattern or match.lower().endswith(IMAGE_BATCH_EXTENSIONS)):
+                image_paths.add(os.path.abspath(match))
+    return sorted(image_paths)
+
+def _batch_output_is_csv(output_path):
+    return output_path.lower().endswith(".csv")
+
+def read_described_hashes(output_path):
+    # Content hashes already described (without error) in a previous run's JSONL/CSV output.
+    described_hashes = set()
+    try:
+        with open(output_path, "r", encoding="utf-8", newline="") as f_out:
+            records = csv.DictReader(f_out) if _batch_output_is_csv(output_path) else f_out
+            for record in records:
+                if not isinstance(record, dict):
+                    try: record = json.loads(record)
+                    except ValueError: continue # e.g. a line cut short by an interrupted run
+                if record.get("sha256") and record.get("description") and not record.get("error"): described_hashes.add(record["sha256"])
+    except OSError:
+        pass
+    return described_hashes
+
+def _describe_batch_image(image_path, described_hashes, text_prompt):
+    started = time.perf_counter()
+    record = {"path": image_path, "sha256": "", "description": "", "error": "", "cached": False, "original_bytes": 0, "uploaded_bytes": 0}
+    try:
+        with open(image_path, "rb") as f_image: source_data = f_image.read()
+        record.update(sha256=hashlib.sha256(source_data).hexdigest(), original_bytes=len(source_data))
+        if record["sha256"] in described_hashes: return None # Resumed: described by an earlier run
+        with Image.open(io.BytesIO(source_data)) as pil_img:
+            if IMAGE_MAX_EDGE: pil_img.draft("RGB", (IMAGE_MAX_EDGE, IMAGE_MAX_EDGE))
+            description, image_info = describe_image(pil_img, os.path.basename(image_path), len(source_data), text_prompt, source_data)
+        if description.startswith("#LLM_ERR"): record["error"] = description
+        else: record["description"] = description
+        record.update(cached=image_info["cached"], uploaded_bytes=image_info["uploaded_bytes"])
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    record.update(seconds=round(time.perf_counter() - started, 3), described_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+    return record
+
+def describe_images_batch(patterns, output_path=None, workers=None, text_prompt="Describe this image in detail."):
+    image_paths = expand_image_paths(patterns)
+    if not image_paths:
+        print(f"{WARNING_COLOR}!No image files match: {' '.join(patterns)}{RESET_COLOR}"); return None
+    output_path = os.path.abspath(output_path or IMAGE_BATCH_DEFAULT_OUTPUT)
+    workers = max(1, workers or IMAGE_BATCH_WORKERS)
+    described_hashes = read_described_hashes(output_path)
+    batch_stats = {"total": len(image_paths), "described": 0, "cached": 0, "skipped": 0, "errors": 0, "uploaded_bytes": 0, "original_bytes": 0, "seconds": 0.0}
+    print(f"{POOP_MSG_COLOR}Describing {len(image_paths)} image(s) with {workers} worker(s) -> {output_path}"
+          f"{f' (resuming: {len(described_hashes)} already described)' if described_hashes else ''}{RESET_COLOR}")
+    is_csv = _batch_output_is_csv(output_path)
+    write_header = is_csv and (not os.path.exists(output_path) or os.path.getsize(output_path) == 0)
+    started = time.perf_counter()
+    done_count = 0
+    futures = []
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poop-img-desc")
+    try:
+        with open(output_path, "a", encoding="utf-8", newline="") as f_out:
+            csv_writer = csv.DictWriter(f_out, fieldnames=IMAGE_BATCH_FIELDS) if is_csv else None
+            if write_header: csv_writer.writeheader()
+            futures = [executor.submit(_describe_batch_image, image_path, described_hashes, text_prompt) for image_path in image_paths]
+            for future in concurrent.futures.as_completed(futures):
+                record = future.result()
+                done_count += 1
+                if record is None:
+                    batch_stats["skipped"] += 1; continue
+                if is_csv: csv_writer.writerow(record)
+                else: f_out.write(json.dumps(record) + "\n")
+                f_out.flush()
+                batch_stats["original_bytes"] += record["original_bytes"]
+                batch_stats["seconds"] += record["seconds"]
+                progress = f"[{done_count}/{len(image_paths)}] {os.path.relpath(record['path'])}"
+                if record["error"]:
+                    batch_stats["errors"] += 1
+                    print(f"{ERROR_COLOR}{progress}: {record['error'][:200]}{RESET_COLOR}")
+                    continue
+                batch_stats["described"] += 1
+                batch_stats["cached"] += record["cached"]
+                batch_stats["uploaded_bytes"] += record["uploaded_bytes"]
+                summary = " ".join(record["description"].split())
+                timing = "cached" if record["cached"] else f"{record['seconds']:.1f}s"
+                print(f"{POOP_MSG_COLOR}{progress}{RESET_COLOR} ({timing}): "
+                      f"{AI_RESPONSE_COLOR}{summary[:160]}{'...' if len(summary) > 160 else ''}{RESET_COLOR}")
+    except KeyboardInterrupt:
+        print(f"\n{WARNING_COLOR}Interrupted; pending images cancelled. Run the same command again to resume.{RESET_COLOR}")
+    finally:
+        for future in futures: future.cancel() # shutdown(cancel_futures=True) needs Python 3.9
+        executor.shutdown(wait=False)
+    batch_stats["elapsed"] = time.perf_counter() - started
+    print_image_batch_stats(batch_stats)
+    return batch_stats
+
+def print_image_batch_stats(batch_stats):
+    processed = batch_stats["described"] + batch_stats["errors"]
+    elapsed = max(batch_stats["elapsed"], 1e-9)
+    print(f"\n{POOP_MSG_COLOR}--- img_desc batch ---{RESET_COLOR}")
+    print(f"{BRIGHT_WHITE_COLOR}Images:{RESET_COLOR} {batch_stats['total']} matched, {batch_stats['described']} described "
+          f"({batch_stats['cached']} from cache), {batch_stats['skipped']} skipped (already in output), {batch_stats['errors']} error(s)")
+    print(f"{BRIGHT_WHITE_COLOR}Throughput:{RESET_COLOR} {processed / elapsed:.2f} images/s ({60 * processed / elapsed:.0f}/min) over {elapsed:.1f}s"
+          + (f", avg {batch_stats['seconds'] / processed:.2f}s per image" if processed else ""))
+    if batch_stats["original_bytes"]:
+        print(f"{BRIGHT_WHITE_COLOR}Upload:{RESET_COLOR} {batch_stats['uploaded_bytes'] / 1024:.0f} KB of {batch_stats['original_bytes'] / 1024:.0f} KB source files")
+    print(f"{POOP_MSG_COLOR}----------------------{RESET_COLOR}")
+
+_IMAGE_HANDOFF_SOURCE = r'''# poop_handoff: hands a screenshot to POOP's multimodal analysis as raw pixels in shared memory, without
+# encoding it or writing it to disk. Written by POOP into .poop/lib, which is on the PYTHONPATH of scripts it runs.
+#     import poop_handoff
+#     poop_handoff.analyze_image(image) # PIL image, numpy uint8 array (HxW, HxWx3, HxWx4), mss screenshot or (data, width, height, mode)
+# Pass bgr=True for OpenCV (BGR/BGRA) arrays. Outside POOP, on Windows or if shared memory fails, the image is saved
+# as a PNG and the path signal is printed instead.
+import os, sys, uuid, tempfile
+
+SHM_SIGNAL = "#POOP_ANALYZE_IMAGE_SHM:"
+PATH_SIGNAL = "#POOP_ANALYZE_IMAGE_PATH:"
+_MODES_BY_CHANNELS = {1: "L", 3: "RGB", 4: "RGBA"}
+
+def _raw_pixels(image, bgr):
+    # -> (contiguous buffer, width, height, mode, rawmode) without converting pixel data where possible.
+    if hasattr(image, "bgra") and hasattr(image, "size") and not hasattr(image, "shape"): # mss ScreenShot
+        return memoryview(image.bgra), image.size[0], image.size[1], "RGB", "BGRX"
+    if isinstance(image, tuple):
+        data, width, height, mode = image[:4]
+        return memoryview(data).cast("B"), int(width), int(height), mode, image[4] if len(image) > 4 else mode
+    if hasattr(image, "shape") and hasattr(image, "dtype"): # numpy array
+        import numpy
+        if image.dtype != numpy.uint8: image = numpy.clip(image, 0, 255).astype(numpy.uint8)
+        if image.ndim == 3 and image.shape[2] == 1: image = image[:, :, 0]
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        mode = _MODES_BY_CHANNELS[channels]
+        rawmode = {"RGB": "BGR", "RGBA": "BGRA"}.get(mode, mode) if bgr else mode
+        return memoryview(numpy.ascontiguousarray(image)).cast("B"), image.shape[1], image.shape[0], mode, rawmode
+    if image.mode not in ("L", "RGB", "RGBA"): # PIL image
+        image = image.convert("RGBA" if "A" in image.mode or "transparency" in image.info else "RGB")
+    return memoryview(image.tobytes()), image.width, image.height, image.mode, image.mode
+
+def _create_segment(size):
+    from multiprocessing import shared_memory
+    name = f"poop_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+    try:
+        return shared_memory.SharedMemory(name=name, create=True, size=size, track=False) # Python 3.13+
+    except TypeError:
+        segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+        try: # POOP unlinks the segment once it has the pixels; this script's exit must not
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(segment._name, "shared_memory")
+        except Exception:
+            pass
+        return segment
+
+def _to_pil(image, bgr):
+    from PIL import Image
+    if isinstance(image, Image.Image): return image
+    data, width, height, mode, rawmode = _raw_pixels(image, bgr)
+    return Image.frombytes(mode, (width, height), bytes(data), "raw", rawmode)
+
+def save_and_signal(image, path=None, bgr=False):
+    # Fallback: PNG on disk + path signal.
+    if path is None:
+        file_descriptor, path = tempfile.mkstemp(prefix="poop_screenshot_", suffix=".png"); os.close(file_descriptor)
+    _to_pil(image, bgr).save(path)
+    print(f"{PATH_SIGNAL} {os.path.abspath(path)}", flush=True)
+    return os.path.abspath(path)
+
+def analyze_image(image, bgr=False, path=None):
+    # Returns the shared memory segment name, or the saved file's path when the fallback was used.
+    if os.environ.get("POOP_IMAGE_HANDOFF") != "shm" or os.name == "nt":
+        return save_and_signal(image, path, bgr)
+    try:
+        data, width, height, mode, rawmode = _raw_pixels(image, bgr)
+        segment = _create_segment(max(1, data.nbytes))
+    except Exception:
+        return save_and_signal(image, path, bgr)
+    try:
+        segment.buf[:data.nbytes] = data
+    finally:
+        data.release()
+    print(f"{SHM_SIGNAL} {segment.name} {width} {height} {mode} {rawmode}", flush=True)
+    segment.close()
+    return segment.name
+'''
+
+def ensure_image_handoff_module():
+    # Writes poop_handoff.py into IMAGE_HANDOFF_LIB_DIR (when missing or outdated); returns the directory or None.
+    global _IMAGE_HANDOFF_LIB_READY
+    if _IMAGE_HANDOFF_LIB_READY: return IMAGE_HANDOFF_LIB_DIR
+    module_path = os.path.join(IMAGE_HANDOFF_LIB_DIR, IMAGE_HANDOFF_MODULE + ".py")
+    try:
+        with open(module_path, "r", encoding="utf-8") as f_module: up_to_date = f_module.read() == _IMAGE_HANDOFF_SOURCE
+    except OSError:
+        up_to_date = False
+    try:
+        if not up_to_date:
+            os.makedirs(IMAGE_HANDOFF_LIB_DIR, exist_ok=True)
+            temp_path = f"{module_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f_module: f_module.write(_IMAGE_HANDOFF_SOURCE)
+            os.replace(temp_path, module_path)
+    except OSError as e:
+        print(f"{WARNING_COLOR}!Could not write the {IMAGE_HANDOFF_MODULE} helper: {e}{RESET_COLOR}")
+        return None
+    _IMAGE_HANDOFF_LIB_READY = True
+    cleanup_stale_image_handoffs()
+    return IMAGE_HANDOFF_LIB_DIR
+
+def script_child_env(image_handoff=True):
+    # Environment for executed scripts: unbuffered output, poop_handoff importable, and whether POOP reads
+    # shared memory handoffs from this run's output (background jobs aren't drained, so they get the file fallback).
+    child_env = os.environ.copy(); child_env["PYTHONUNBUFFERED"] = "1"
+    lib_dir = ensure_image_handoff_module()
+    if lib_dir: child_env["PYTHONPATH"] = os.pathsep.join([lib_dir] + ([child_env["PYTHONPATH"]] if child_env.get("PYTHONPATH") else []))
+    child_env["POOP_IMAGE_HANDOFF"] = "shm" if image_handoff and IMAGE_HANDOFF_ENABLED and shared_memory is not None else "file"
+    return child_env
+
+def consume_image_handoff(signal_line):
+    # Copies the pixels named by an IMAGE_SHM_SIGNAL line into a PIL image and unlinks the segment. Called as soon as
+    # the line is captured, so segments don't outlive the run; later lookups of the same line get the kept image.
+    try:
+        segment_name, width, height, mode, rawmode = signal_line[len(IMAGE_SHM_SIGNAL):].split()[:5]
+        width, height = int(width), int(height)
+    except ValueError:
+        return None
+    with _IMAGE_HANDOFF_LOCK:
+        if segment_name in _IMAGE_HANDOFFS: return _IMAGE_HANDOFFS[segment_name]
+        if shared_memory is None or not segment_name.startswith("poop_"): return None
+        started = time.perf_counter()
+        try:
+            try: segment = shared_memory.SharedMemory(name=segment_name, track=False)
+            except TypeError: segment = shared_memory.SharedMemory(name=segment_name)
+        except (OSError, ValueError):
+            IMAGE_HANDOFF_STATS["failed"] += 1
+            return None
+        try:
+            pixel_bytes = width * height * len(rawmode.split(";")[0])
+            with segment.buf[:pixel_bytes] as pixel_view:
+                pil_img = Image.frombytes(mode, (width, height), pixel_view, "raw", rawmode)
+        except Exception:
+            IMAGE_HANDOFF_STATS["failed"] += 1
+            pil_img = None
+        finally:
+            segment.close()
+            try: segment.unlink()
+            except OSError: pass
+        if pil_img is None: return None
+        IMAGE_HANDOFF_STATS["received"] += 1
+        IMAGE_HANDOFF_STATS["bytes"] += pixel_bytes
+        IMAGE_HANDOFF_STATS["seconds"] += time.perf_counter() - started
+        _IMAGE_HANDOFFS[segment_name] = pil_img
+        while len(_IMAGE_HANDOFFS) > IMAGE_HANDOFF_MAX_PENDING: _IMAGE_HANDOFFS.popitem(last=False)
+        return pil_img
+
+def cleanup_stale_image_handoffs():
+    # Segments nobody claimed (POOP killed mid-run, script run by hand with POOP_IMAGE_HANDOFF=shm). Linux keeps them in /dev/shm.
+    if not os.path.isdir("/dev/shm"): return
+    try:
+        for entry in os.scandir("/dev/shm"):
+            if entry.name.startswith("poop_") and time.time() - entry.stat().st_mtime > IMAGE_HANDOFF_STALE_SECONDS:
+                os.unlink(entry.path)
+    except OSError:
+        pass
 
 def gmc_multimodal(image_data, text_prompt="Describe this image in detail."): # Generate Model Content (Multimodal)
-    active_multimodal_model = M_MULTI_CAPABLE_MODEL if M_MULTI_CAPABLE_MODEL else M_CURRENT_TEXT_MODEL
-    if not active_multimodal_model: return "#LLM_ERR: No suitable multimodal model initialized."
+    candidate_models = route_models("multimodal")
+    if not candidate_models: return "#LLM_ERR: No suitable multimodal model initialized."
+    active_multimodal_model = candidate_models[0]
     if not hasattr(active_multimodal_model, "generate_content"): # Simple check
         return f"#LLM_ERR: Model {active_multimodal_model.model_name} may not support multimodal input or is not configured correctly."
 
     content = [text_prompt, image_data]
     try:
-        response = active_multimodal_model.generate_content(content, generation_config=GCFG)
+        response, active_multimodal_model = routed_llm_generate(candidate_models, "multimodal", content)
         description = get_llm_response_text(response, active_multimodal_model.model_name)
         return description
     except google.api_core.exceptions.GoogleAPIError as e:
@@ -605,21 +2220,240 @@ def gmc_multimodal(image_data, text_prompt="Describe this image in detail."): #
     except Exception as e: # Catch more general errors like type errors if image_data is wrong
         return f"#LLM_ERR: Error during multimodal generation with {active_multimodal_model.model_name}: {e}\n{traceback.format_exc()}"
 
-def gmtc(chat_context_prompt): # Generate Model Text for Chat
-    if not M_CURRENT_TEXT_MODEL: return "#LLM_ERR: Current text model not initialized."
+def gmtc(chat_context_prompt, bypass_cache=False, stream=None): # Generate Model Text for Chat
+    # With stream=True the reply is rendered live (cached replies are printed at once) and the caller shouldn't print it again.
+    candidate_models = route_models("chat")
+    if not candidate_models: return "#LLM_ERR: Current text model not initialized."
+    chat_model = candidate_models[0]
+    if stream is None: stream = LLM_STREAM_OUTPUT
+    cache_key, cached_reply = llm_cache_get(chat_model.model_name, chat_context_prompt, bypass_cache)
+    if cached_reply is not None:
+        if stream: print(f"{CHAT_LLM_RESPONSE_COLOR}{cached_reply}{RESET_COLOR}")
+        return cached_reply
     try:
-        response = M_CURRENT_TEXT_MODEL.generate_content(chat_context_prompt, generation_config=GCFG)
-        return get_llm_response_text(response, M_CURRENT_TEXT_MODEL.model_name)
+        if stream:
+            response, chat_model = routed_llm_generate(candidate_models, "chat", chat_context_prompt, stream=True)
+            reply = stream_llm_response_text(response, chat_model.model_name, CHAT_LLM_RESPONSE_COLOR)
+        else:
+            response, chat_model = routed_llm_generate(candidate_models, "chat", chat_context_prompt)
+            reply = get_llm_response_text(response, chat_model.model_name)
+        llm_cache_put(_llm_cache_key(chat_model.model_name, chat_context_prompt), chat_model.model_name, reply) # Under the model that answered
+        return reply
     except google.api_core.exceptions.GoogleAPIError as e:
-        return f"#LLM_ERR: API Error during chat with {M_CURRENT_TEXT_MODEL.model_name}: {e}"
+        return f"#LLM_ERR: API Error during chat with {chat_model.model_name}: {e}"
     except Exception as e:
-        return f"#LLM_ERR: Error during chat with {M_CURRENT_TEXT_MODEL.model_name}: {e}\n{traceback.format_exc()}"
+        return f"#LLM_ERR: Error during chat with {chat_model.model_name}: {e}\n{traceback.format_exc()}"
+
+
+def plan_step_success_description(step_index, step, requires_code_gen=True):
+    # What LAST_SUCCESSFUL_TASK_DESCRIPTION becomes after a plan step completes; also used to
+    # predict the context of the following step for speculative generation.
+    step_task = step.get('task', f"Unnamed Plan Step {step_index + 1}")
+    if requires_code_gen:
+        return f"Successfully completed plan step {step_index + 1}: {step_task} (Part of overall goal: {LAST_USER_INSTRUCTION})"
+    return f"Completed non-code plan step {step_index + 1}: {step_task}"
+
+def build_plan_step_gmc_request(step_index, step, code_base, previous_task_context, system_info):
+    # Keyword arguments for gmc() to generate the code of a plan step.
+    step_task = step.get('task', f"Unnamed Plan Step {step_index + 1}")
+    instruction = f"Implement the following plan step: {step_task}."
+    if step.get('details'):
+        instruction += f" Specific details for this step: {step['details']}."
+    gmc_request = {
+        "current_code": code_base,
+        "user_instruction_for_code_gen": instruction,
+        "previous_task_context_for_code_gen": previous_task_context, # Context from *previous* step's success
+        "system_info_for_code_gen": system_info,
+        "plan_context_for_code_gen": {
+            "full_plan": CURRENT_PLAN_TEXT,
+            "current_step_description": step_task,
+            "current_step_details": step.get('details', 'N/A'),
+            "requires_user_input_during_step": step.get('requires_user_input_during_step'),
+            "screenshot_analysis_signal": step.get('screenshot_analysis_signal', False),
+            "overall_goal": LAST_USER_INSTRUCTION, # The plan's overall goal
+            "is_additive": step.get("additive_code", False)
+        }
+    }
+    # Past-script retrieval (new scripts only) belongs to the request: computed here on the main thread, and
+    # part of the prefetch fingerprint, so a prefetched step can't have used a stale index.
+    gmc_request["relevant_past_scripts"] = [] if code_base else past_scripts_for_code_gen(instruction, gmc_request["plan_context_for_code_gen"])
+    return gmc_request
+
+def _plan_step_request_fingerprint(gmc_request):
+    model_name = M_CURRENT_TEXT_MODEL.model_name if M_CURRENT_TEXT_MODEL else ""
+    return hashlib.sha256((model_name + json.dumps(gmc_request, sort_keys=True, default=str)).encode('utf-8', errors='replace')).hexdigest()
+
+def _prefetch_plan_step_code(gmc_request):
+    started = time.time()
+    generated_code = gmc_speculative(**gmc_request)
+    return generated_code, time.time() - started
+
+def schedule_plan_prefetches(current_step_index, system_info):
+    # Non-additive steps don't depend on the code buffer, only on the previous step's success
+    # description, which is predictable. Generate their code ahead while the current step runs.
+    global _PLAN_PREFETCH_EXECUTOR
+    if not PLAN_PREFETCH_ENABLED or not M_CURRENT_TEXT_MODEL: return
+    last_index = min(len(CURRENT_PLAN_STEPS), current_step_index + 1 + PLAN_PREFETCH_MAX_AHEAD)
+    for step_index in range(current_step_index + 1, last_index):
+        step = CURRENT_PLAN_STEPS[step_index]
+        if step_index in PLAN_PREFETCH or not step.get("requires_code_gen", True) or step.get("additive_code", False):
+            continue
+        if VERIFIED_SNIPPET_REUSE != "off" and plan_step_fingerprint(step, "", system_info) in _verified_snippets():
+            continue # Will most likely be served from verified code, no LLM call needed
+        previous_step = CURRENT_PLAN_STEPS[step_index - 1]
+        predicted_context = plan_step_success_description(step_index - 1, previous_step, previous_step.get("requires_code_gen", True))
+        gmc_request = build_plan_step_gmc_request(step_index, step, "", predicted_context, system_info)
+        if _PLAN_PREFETCH_EXECUTOR is None:
+            _PLAN_PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=PLAN_PREFETCH_WORKERS, thread_name_prefix="poop-prefetch")
+        PLAN_PREFETCH[step_index] = {
+            "fingerprint": _plan_step_request_fingerprint(gmc_request),
+            "future": _PLAN_PREFETCH_EXECUTOR.submit(_prefetch_plan_step_code, gmc_request)
+        }
+        PLAN_PREFETCH_STATS["submitted"] += 1
+
+def take_prefetched_plan_step_code(step_index, gmc_request):
+    # Returns the speculatively generated code if it was generated from exactly this request, else None.
+    prefetched = PLAN_PREFETCH.pop(step_index, None)
+    if not prefetched: return None
+    if LLM_CACHE_BYPASS_NEXT: # Fresh generation requested; the prefetch may have come from the cache. gmc() consumes the flag.
+        prefetched["future"].cancel()
+        PLAN_PREFETCH_STATS["discarded"] += 1
+        return None
+    if prefetched["fingerprint"] != _plan_step_request_fingerprint(gmc_request):
+        prefetched["future"].cancel()
+        PLAN_PREFETCH_STATS["discarded"] += 1
+        print(f"{POOP_MSG_COLOR}POOP: Context changed since step {step_index + 1} was generated ahead; regenerating.{RESET_COLOR}")
+        return None
+    wait_started = time.time()
+    try:
+        generated_code, generation_seconds = prefetched["future"].result()
+    except Exception:
+        PLAN_PREFETCH_STATS["discarded"] += 1
+        return None
+    if generated_code.startswith("#LLM_ERR") or not generated_code.strip():
+        PLAN_PREFETCH_STATS["discarded"] += 1
+        return None
+    saved_seconds = max(0.0, generation_seconds - (time.time() - wait_started))
+    PLAN_PREFETCH_STATS["used"] += 1
+    PLAN_PREFETCH_STATS["saved_seconds"] += saved_seconds
+    print(f"{POOP_MSG_COLOR}POOP: Using code generated ahead for step {step_index + 1} (saved {saved_seconds:.1f}s).{RESET_COLOR}")
+    return generated_code
+
+def discard_plan_prefetches():
+    for prefetched in PLAN_PREFETCH.values():
+        prefetched["future"].cancel()
+        PLAN_PREFETCH_STATS["discarded"] += 1
+    PLAN_PREFETCH.clear()
+
+def reset_plan_prefetch_stats():
+    discard_plan_prefetches()
+    for stat_key in PLAN_PREFETCH_STATS: PLAN_PREFETCH_STATS[stat_key] = 0
+    PLAN_PREFETCH_STATS["saved_seconds"] = 0.0
+
+def report_plan_prefetch_stats():
+    discard_plan_prefetches() # Whatever is left can't be used anymore
+    if PLAN_PREFETCH_STATS["submitted"]:
+        print(f"{POOP_MSG_COLOR}POOP: Speculative generation: {PLAN_PREFETCH_STATS['used']}/{PLAN_PREFETCH_STATS['submitted']} steps used, {PLAN_PREFETCH_STATS['discarded']} discarded, saved {PLAN_PREFETCH_STATS['saved_seconds']:.1f}s wall time.{RESET_COLOR}")
+
+def environment_fingerprint():
+    # Hash of the Python version and installed distributions; a verified snippet is only trusted
+    # as-is in the environment it was verified in.
+    global _ENVIRONMENT_FINGERPRINT
+    if _ENVIRONMENT_FINGERPRINT is None:
+        try:
+            import importlib.metadata
+            distributions = sorted({f"{(d.metadata['Name'] or '').lower()}=={d.version}" for d in importlib.metadata.distributions()})
+        except Exception:
+            distributions = []
+        python_version = sys.version.split()[0]
+        fingerprint = hashlib.sha256("\n".join([python_version, sys.platform] + distributions).encode("utf-8")).hexdigest()[:16]
+        _ENVIRONMENT_FINGERPRINT = (fingerprint, f"Python {python_version}, {len(distributions)} packages")
+    return _ENVIRONMENT_FINGERPRINT
+
+def _normalize_step_text(text):
+    return re.sub(r"\s+", " ", str(text or "")).strip().lower().rstrip(".")
+
+def plan_step_fingerprint(step, code_base, system_info):
+    # Same normalized task/details/flags on the same system (and, for additive steps, on top of the same
+    # code) -> same fingerprint. Plan numbering and the overall goal wording don't take part.
+    fingerprint_parts = {
+        "task": _normalize_step_text(step.get("task")), "details": _normalize_step_text(step.get("details")),
+        "additive": bool(step.get("additive_code")), "screenshot": bool(step.get("screenshot_analysis_signal")),
+        "user_input": _normalize_step_text(step.get("requires_user_input_during_step")),
+        "system": {k: v for k, v in (system_info or {}).items() if k != "python_version"}, # Python version lives in the env fingerprint
+        "code_base": hashlib.sha256(code_base.encode("utf-8")).hexdigest() if step.get("additive_code") and code_base.strip() else "",
+    }
+    return hashlib.sha256(json.dumps(fingerprint_parts, sort_keys=True).encode("utf-8")).hexdigest()
 
+def _verified_snippets():
+    global VERIFIED_SNIPPETS
+    if VERIFIED_SNIPPETS is None:
+        try:
+            with open(VERIFIED_SNIPPETS_FILE, "r", encoding="utf-8") as f_snippets: VERIFIED_SNIPPETS = json.load(f_snippets)
+        except (OSError, ValueError):
+            VERIFIED_SNIPPETS = {}
+    return VERIFIED_SNIPPETS
+
+def _save_verified_snippets():
+    try:
+        os.makedirs(POOP_STATE_DIR, exist_ok=True)
+        temp_path = VERIFIED_SNIPPETS_FILE + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f_snippets: json.dump(VERIFIED_SNIPPETS, f_snippets)
+        os.replace(temp_path, VERIFIED_SNIPPETS_FILE)
+    except OSError as e:
+        print(f"{WARNING_COLOR}!Could not save verified snippets: {e}{RESET_COLOR}")
+
+def record_verified_snippet(step_fingerprint, step, code):
+    snippets = _verified_snippets()
+    code = "\n".join(line for line in code.splitlines() if not line.startswith("# POOP:")).strip() # Header is re-added per plan
+    if not code: return
+    env_fingerprint, env_summary = environment_fingerprint()
+    snippets[step_fingerprint] = {
+        "task": step.get("task", ""), "code": code, "env_fingerprint": env_fingerprint, "env_summary": env_summary,
+        "verified_at": time.time(), "last_used": time.time(), "uses": snippets.get(step_fingerprint, {}).get("uses", 0),
+    }
+    while len(snippets) > VERIFIED_SNIPPETS_MAX_ENTRIES:
+        del snippets[min(snippets, key=lambda key: snippets[key]["last_used"])]
+    VERIFIED_SNIPPET_STATS["recorded"] += 1
+    _save_verified_snippets()
+
+def take_verified_snippet(step_fingerprint, step_index):
+    # Code to reuse for this step instead of calling the LLM, or None (no match, declined, or 'off').
+    if VERIFIED_SNIPPET_REUSE == "off": return None
+    snippet = _verified_snippets().get(step_fingerprint)
+    if not snippet: return None
+    env_matches = snippet["env_fingerprint"] == environment_fingerprint()[0]
+    verified_when = time.strftime('%Y-%m-%d %H:%M', time.localtime(snippet["verified_at"]))
+    if VERIFIED_SNIPPET_REUSE == "auto" and env_matches:
+        print(f"{POOP_MSG_COLOR}POOP: Reusing code verified on {verified_when} for this step (no LLM call).{RESET_COLOR}")
+    else:
+        env_note = "" if env_matches else f" {WARNING_COLOR}(environment changed since: was {snippet['env_summary']}){POOP_PROMPT_COLOR}"
+        reuse_answer = input(f"{POOP_PROMPT_COLOR}POOP: Step {step_index + 1} matches code that ran successfully on {verified_when}{env_note}. Reuse it instead of generating? (Y/n): {RESET_COLOR}").strip().lower()
+        if reuse_answer not in ("", "y", "yes"): return None
+    snippet["uses"] += 1; snippet["last_used"] = time.time()
+    VERIFIED_SNIPPET_STATS["reused"] += 1
+    _save_verified_snippets()
+    return snippet["code"]
+
+def forget_verified_snippet(step_fingerprint):
+    if _verified_snippets().pop(step_fingerprint, None) is not None:
+        VERIFIED_SNIPPET_STATS["reuse_failed"] += 1
+        _save_verified_snippets()
+
+def print_verified_snippets():
+    snippets = _verified_snippets()
+    print(f"\n{POOP_MSG_COLOR}--- Verified Snippets (reuse: {VERIFIED_SNIPPET_REUSE}) ---{RESET_COLOR}")
+    print(f"{BRIGHT_WHITE_COLOR}Stored:{RESET_COLOR} {len(snippets)}  {BRIGHT_WHITE_COLOR}This session:{RESET_COLOR} {VERIFIED_SNIPPET_STATS['reused']} reused, {VERIFIED_SNIPPET_STATS['reuse_failed']} failed on reuse, {VERIFIED_SNIPPET_STATS['recorded']} recorded")
+    current_env = environment_fingerprint()[0]
+    for snippet in sorted(snippets.values(), key=lambda snippet: -snippet["last_used"])[:15]:
+        env_mark = "" if snippet["env_fingerprint"] == current_env else f" {WARNING_COLOR}[other env]{RESET_COLOR}"
+        print(f"  {snippet['task'][:70]} ({snippet['uses']} reuses, {len(snippet['code'].splitlines())} lines){env_mark}")
+    print(f"{POOP_MSG_COLOR}------------------------------------{RESET_COLOR}")
 
 def create_execution_scope():
     # Basic scope for in-memory execution.
     # More restricted than file execution for safety, though still powerful.
-    s = {"__builtins__": __builtins__}
+    s = {"__builtins__": __builtins__, "poop_cancel_event": threading.Event()} # Set when POOP stops the run; code may poll it
     # Minimal safe libraries by default for in-memory, file exec has more freedom.
     libs_to_try_import = [
         ('os', 'os'), ('sys', 'sys'), ('time', 'time'), ('random', 'random'),
@@ -637,8 +2471,1678 @@ def create_execution_scope():
             pass # Silently ignore if a common lib isn't available in restricted env
     return s
 
-def execute_code(code_buffer_to_exec, last_instruction_for_fix_context, previous_task_context_for_fix, file_path=None, auto_run_source=""):
-    global LAST_SCRIPT_STDOUT_LINES, LAST_SCRIPT_STDERR_MESSAGE, LAST_SUCCESSFUL_TASK_DESCRIPTION
+class BoundedLineCapture:
+    # Per-stream ring buffers of (seconds_since_start, stream_name, line) records; transcript()
+    # merges them back into arrival order. Records pushed out of a ring are appended to a shared
+    # spill file, and POOP signal lines (e.g. image analysis requests) are pinned so they survive eviction.
+    def __init__(self, max_lines, spill_path=None):
+        self.max_lines = max(1, max_lines)
+        self.rings = {}
+        self.pinned = []
+        self.start_time = time.time()
+        self.spill_path = spill_path
+        self.spilled_count = 0
+        self._spill_file = None
+
+    def append(self, stream_name, line, timestamp=None):
+        record = ((timestamp or time.time()) - self.start_time, stream_name, line)
+        ring = self.rings.setdefault(stream_name, deque(maxlen=self.max_lines))
+        if len(ring) == ring.maxlen:
+            self._spill(ring[0])
+        ring.append(record)
+        if stream_name == "stdout" and line.startswith("#POOP_"):
+            self.pinned.append(record)
+            if line.startswith(IMAGE_SHM_SIGNAL): consume_image_handoff(line) # Claim the pixels while the segment exists
+
+    def _spill(self, record):
+        self.spilled_count += 1
+        if not self.spill_path: return
+        try:
+            if self._spill_file is None:
+                os.makedirs(os.path.dirname(self.spill_path), exist_ok=True)
+                self._spill_file = open(self.spill_path, "a", encoding="utf-8")
+            self._spill_file.write(f"[+{record[0]:.3f}s] {record[1]}: {record[2]}\n")
+        except Exception:
+            self.spill_path = None # Disk trouble: keep running, just stop spilling
+
+    def lines(self, stream_name):
+        retained = list(self.rings.get(stream_name, ()))
+        retained_ids = {id(r) for r in retained}
+        evicted_pinned = [r for r in self.pinned if r[1] == stream_name and id(r) not in retained_ids]
+        return [r[2] for r in evicted_pinned + retained]
+
+    def transcript(self):
+        return sorted((r for ring in self.rings.values() for r in ring), key=lambda r: r[0])
+
+    def retained_count(self):
+        return sum(len(ring) for ring in self.rings.values())
+
+    def close(self):
+        if self._spill_file:
+            self._spill_file.close()
+            self._spill_file = None
+
+def set_last_output_capture(output_capture):
+    # Makes output_capture the last run's. The replaced capture's spill file goes with it, and the spill
+    # directory is capped at SCRIPT_OUTPUT_SPILL_MAX_FILES newest files.
+    global LAST_SCRIPT_OUTPUT_CAPTURE
+    previous_capture, LAST_SCRIPT_OUTPUT_CAPTURE = LAST_SCRIPT_OUTPUT_CAPTURE, output_capture
+    if previous_capture is not None and previous_capture is not output_capture and previous_capture.spill_path:
+        previous_capture.close()
+        try: os.remove(previous_capture.spill_path)
+        except OSError: pass
+    try:
+        spill_files = sorted((entry for entry in os.scandir(SCRIPT_OUTPUT_SPILL_DIR) if entry.is_file() and entry.name.endswith(".log")),
+                             key=lambda entry: entry.stat().st_mtime, reverse=True)
+    except OSError: return
+    for entry in spill_files[SCRIPT_OUTPUT_SPILL_MAX_FILES:]:
+        if entry.path == output_capture.spill_path: continue
+        try: os.remove(entry.path)
+        except OSError: pass
+
+class TeeLineWriter(io.TextIOBase):
+    # sys.stdout/sys.stderr stand-in for in-memory runs: text reaches the terminal as soon as it is written, and
+    # complete lines go into a BoundedLineCapture (so long runs neither look frozen nor hold all output in memory).
+    def __init__(self, target, capture, stream_name):
+        self.target, self.capture, self.stream_name = target, capture, stream_name
+        self._partial_line = ""
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self): return getattr(self.target, "encoding", "utf-8")
+    def writable(self): return True
+    def isatty(self): return self.target.isatty()
+    def fileno(self): return self.target.fileno()
+
+    def write(self, text):
+        if not isinstance(text, str): raise TypeError(f"write() argument must be str, not {type(text).__name__}")
+        with self._lock:
+            self.target.write(text)
+            if "\n" in text: self.target.flush()
+            lines = (self._partial_line + text).split("\n")
+            self._partial_line = lines.pop()
+            for line in lines: self.capture.append(self.stream_name, line.strip())
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            try: self.target.flush()
+            except (OSError, ValueError): pass
+
+    def finish(self):
+        # Captures an unterminated last line.
+        with self._lock:
+            if self._partial_line: self.capture.append(self.stream_name, self._partial_line.strip()); self._partial_line = ""
+
+class InMemoryRunCancelled(BaseException):
+    # Raised inside in-memory code to stop it at the wall-clock limit. BaseException, so the script's own
+    # `except Exception:` blocks don't swallow it.
+    pass
+
+def _raise_in_thread(thread, exception_type):
+    # Asynchronous exception: delivered at the thread's next bytecode, not while it blocks inside C code.
+    # exception_type None clears one that is still pending.
+    import ctypes
+    return ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(thread.ident), None if exception_type is None else ctypes.py_object(exception_type))
+
+def run_in_memory_code(compiled_object, execution_scope, deadline=None, echo_target=None):
+    # exec()s on the calling (main) thread, which signal.signal, tkinter/Cocoa and GUI backends require. Ctrl+C arrives
+    # as usual; the deadline (a time.time() value) is enforced by a watchdog thread that sets
+    # execution_scope['poop_cancel_event'] (code may poll it) and raises InMemoryRunCancelled in this thread, then every
+    # IN_MEMORY_CANCEL_GRACE_SECONDS sends it SIGINT (POSIX) to wake a blocking call. Returns
+    # {'outcome': ok|exit|error|timeout|interrupted, 'error', 'traceback'}.
+    echo_target = echo_target or sys.__stdout__
+    result = {"outcome": None}
+    cancel_event = execution_scope["poop_cancel_event"] = threading.Event() # Fresh per run; the scope outlives runs
+    run_thread = threading.current_thread()
+    finished = threading.Event()
+    cancel_lock = threading.Lock() # No cancel may be sent once the code has finished
+    sigint_handler = signal.getsignal(signal.SIGINT) # The code may install its own; POOP's Ctrl+C handling comes back afterwards
+    def watchdog():
+        if finished.wait(max(0.0, deadline - time.time())): return
+        with cancel_lock:
+            if finished.is_set(): return
+            result["cancel_reason"] = "timeout"
+            cancel_event.set()
+            print(f"\n{WARNING_COLOR}!POOP: Wall-clock limit reached, stopping the in-memory code.{RESET_COLOR}", file=echo_target, flush=True)
+            _raise_in_thread(run_thread, InMemoryRunCancelled)
+        while not finished.wait(IN_MEMORY_CANCEL_GRACE_SECONDS) and hasattr(signal, "pthread_kill"):
+            with cancel_lock:
+                if not finished.is_set(): signal.pthread_kill(run_thread.ident, signal.SIGINT) # Still blocked in a call
+    if deadline: threading.Thread(target=watchdog, name="poop-in-memory-watchdog", daemon=True).start()
+    try:
+        try:
+            exec(compiled_object, execution_scope, execution_scope)
+            result["outcome"] = "ok"
+        finally:
+            with cancel_lock: finished.set()
+            signal.signal(signal.SIGINT, sigint_handler)
+            if result.get("cancel_reason"): # A cancel sent just as the code finished must not escape into POOP
+                _raise_in_thread(run_thread, None)
+                try: time.sleep(0.05) # Pending SIGINT handlers run here
+                except KeyboardInterrupt: pass
+    except SystemExit:
+        result["outcome"] = "exit"
+    except (InMemoryRunCancelled, KeyboardInterrupt) as e_cancel:
+        result["outcome"] = result.get("cancel_reason") or ("interrupted" if isinstance(e_cancel, KeyboardInterrupt) else "timeout")
+    except Exception as e_run:
+        result.update(outcome="error", error=e_run, traceback="".join(traceback.format_exception(type(e_run), e_run, e_run.__traceback__.tb_next))) # Without this frame
+    return result
+
+def _kill_run(process):
+    # SIGTERM now, SIGKILL in 3s if still alive. Doesn't reap, so wait_with_rusage still gets the rusage.
+    process.terminate()
+    kill_timer = threading.Timer(3, lambda: process.returncode is None and process.kill())
+    kill_timer.daemon = True; kill_timer.start()
+
+def drain_process_output(process, capture, echo=True, deadline=None):
+    # Reads stdout and stderr concurrently (one reader thread per pipe, which also works on Windows
+    # where selectors can't wait on pipes), so a child filling its stderr pipe can't block while
+    # POOP is still waiting for stdout EOF. Lines are echoed and captured in arrival order.
+    line_queue = queue.Queue()
+    def pump(pipe, stream_name):
+        try:
+            for line in iter(pipe.readline, ""):
+                line_queue.put((stream_name, line, time.time()))
+        except (OSError, ValueError):
+            pass # Pipe closed underneath us
+        finally:
+            try: pipe.close()
+            except Exception: pass
+            line_queue.put((stream_name, None, None))
+
+    readers = []
+    for pipe, stream_name in ((process.stdout, "stdout"), (process.stderr, "stderr")):
+        if pipe:
+            reader = threading.Thread(target=pump, args=(pipe, stream_name), daemon=True)
+            reader.start(); readers.append(reader)
+
+    # Returns True if the process was killed for running past `deadline` (a time.time() value).
+    open_streams = len(readers)
+    timed_out = False
+    while open_streams:
+        try:
+            stream_name, line, timestamp = line_queue.get(timeout=None if deadline is None else max(0.0, deadline - time.time()))
+        except queue.Empty:
+            if timed_out: break # Killed, but something (a grandchild?) still holds the pipes open
+            timed_out = True
+            if echo: print(f"\n{ERROR_COLOR}!POOP: Wall-clock limit reached, killing the script (PID {process.pid}).{RESET_COLOR}", flush=True)
+            _kill_run(process)
+            deadline = time.time() + 2
+            continue
+        if line is None:
+            open_streams -= 1
+            continue
+        if echo:
+            echo_target = sys.stdout if stream_name == "stdout" else sys.stderr
+            echo_target.write(line); echo_target.flush()
+        capture.append(stream_name, line.strip(), timestamp)
+    for reader in readers: reader.join(timeout=0 if timed_out else None)
+    return timed_out
+
+def print_output_transcript(max_lines=40):
+    capture = LAST_SCRIPT_OUTPUT_CAPTURE
+    if not capture or not capture.retained_count():
+        print(f"{POOP_MSG_COLOR}No captured script output yet.{RESET_COLOR}"); return
+    records = capture.transcript()[-max_lines:]
+    print(f"\n{POOP_MSG_COLOR}--- Last Script Output Transcript (last {len(records)} of {capture.retained_count() + capture.spilled_count} lines) ---{RESET_COLOR}")
+    for offset, stream_name, line in records:
+        line_color = ERROR_COLOR if stream_name == "stderr" else BRIGHT_WHITE_COLOR
+        print(f"{CODE_OUTPUT_HEADER_COLOR}[+{offset:7.3f}s]{RESET_COLOR} {line_color}{line}{RESET_COLOR}")
+    if capture.spilled_count:
+        print(f"{POOP_MSG_COLOR}({capture.spilled_count} earlier lines spilled to {capture.spill_path or 'N/A'}){RESET_COLOR}")
+    print(f"{POOP_MSG_COLOR}---------------------------------------{RESET_COLOR}")
+
+_WARM_WORKER_SOURCE = r"""
+import os, sys, json, socket, signal, runpy, traceback, importlib, atexit
+control = socket.socket(fileno=int(sys.argv[1]))
+signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C is for the running script, not the worker
+for module_name in json.loads(sys.argv[2]):
+    try: importlib.import_module(module_name)
+    except BaseException: pass
+control.sendall(b'{"ready": true}\n')
+
+script_exit_handlers = [] # atexit handlers of the script run in a child; the worker's own (from pre-imports) never run there
+def register_exit_handler(func, *args, **kwargs):
+    script_exit_handlers.append((func, args, kwargs))
+    return func
+def unregister_exit_handler(func):
+    script_exit_handlers[:] = [handler for handler in script_exit_handlers if handler[0] != func]
+def run_exit_handlers():
+    while script_exit_handlers: # Last registered first, like atexit
+        func, args, kwargs = script_exit_handlers.pop()
+        try: func(*args, **kwargs)
+        except SystemExit: pass
+        except BaseException: traceback.print_exc()
+
+def run_job(job):
+    sys.argv = [job["path"]]
+    sys.path[0] = os.path.dirname(job["path"])
+    try:
+        runpy.run_path(job["path"], run_name="__main__")
+        return 0
+    except SystemExit as e:
+        if e.code is None: return 0
+        if isinstance(e.code, int): return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    except BaseException as e:
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename != job["path"]:
+            tb = tb.tb_next # Hide runpy/worker frames, like a plain `python script.py` traceback
+        traceback.print_exception(type(e), e, tb)
+        return 1
+
+while True:
+    message, fds, _flags, _addr = socket.recv_fds(control, 1 << 20, 3)
+    if not message: break
+    job = json.loads(message)
+    child_pid = os.fork()
+    if child_pid == 0:
+        exit_code = 1
+        try:
+            control.close()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            for target_fd, received_fd in zip((0, 1, 2), fds):
+                os.dup2(received_fd, target_fd); os.close(received_fd)
+            if job.get("rlimits"):
+                import resource
+                for resource_id, soft_limit, hard_limit in job["rlimits"]:
+                    resource.setrlimit(resource_id, (soft_limit, hard_limit))
+            os.chdir(job["cwd"])
+            os.environ.clear(); os.environ.update(job["env"])
+            atexit.register, atexit.unregister = register_exit_handler, unregister_exit_handler
+            exit_code = run_job(job)
+            run_exit_handlers() # os._exit skips atexit
+        finally:
+            try: sys.stdout.flush(); sys.stderr.flush()
+            except BaseException: pass
+            os._exit(exit_code & 0xFF)
+    for received_fd in fds: os.close(received_fd)
+    control.sendall((json.dumps({"started": child_pid}) + "\n").encode())
+    _pid, wait_status, usage = os.wait4(child_pid, 0)
+    control.sendall((json.dumps({
+        "exit": os.waitstatus_to_exitcode(wait_status),
+        "rusage": {"maxrss_kb": usage.ru_maxrss, "utime": usage.ru_utime, "stime": usage.ru_stime},
+    }) + "\n").encode())
+"""
+
+def _process_rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f_status:
+            for status_line in f_status:
+                if status_line.startswith("VmRSS:"): return int(status_line.split()[1]) / 1024.0
+    except (OSError, ValueError, IndexError): pass
+    return None
+
+def _spawn_warm_worker(interpreter):
+    poop_side, worker_side = socket.socketpair()
+    worker_env = script_child_env(); worker_env["PYTHONIOENCODING"] = "utf-8" # PYTHONPATH is read at startup, so poop_handoff is set up here
+    try:
+        process = subprocess.Popen(
+            [interpreter, "-u", "-c", _WARM_WORKER_SOURCE, str(worker_side.fileno()), json.dumps(WARM_WORKER_PREIMPORTS)],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            pass_fds=(worker_side.fileno(),), env=worker_env
+        )
+    except Exception:
+        poop_side.close()
+        return None
+    finally:
+        worker_side.close()
+    return {"process": process, "socket": poop_side, "reader": poop_side.makefile("r", encoding="utf-8"),
+            "ready": False, "busy": False, "runs": 0, "interpreter": interpreter, "started": time.time()}
+
+def _retire_warm_worker(worker):
+    try: worker["reader"].close(); worker["socket"].close() # Worker exits on EOF
+    except Exception: pass
+    try: worker["process"].wait(timeout=2)
+    except Exception:
+        try: worker["process"].kill()
+        except Exception: pass
+
+def prestart_warm_workers(interpreter=None):
+    # Fills the pool in the background of the REPL; workers import WARM_WORKER_PREIMPORTS while idle.
+    if not WARM_WORKERS_ENABLED: return
+    interpreter = interpreter or sys.executable
+    with _WARM_WORKER_LOCK:
+        pool = _WARM_WORKER_POOLS.setdefault(interpreter, [])
+        pool[:] = [w for w in pool if w["process"].poll() is None]
+        while len(pool) < WARM_WORKER_POOL_SIZE:
+            worker = _spawn_warm_worker(interpreter)
+            if not worker: break
+            pool.append(worker)
+
+def shutdown_warm_workers():
+    with _WARM_WORKER_LOCK:
+        for pool in _WARM_WORKER_POOLS.values():
+            for worker in pool: _retire_warm_worker(worker)
+        _WARM_WORKER_POOLS.clear()
+
+class WarmWorkerRun:
+    # Popen-like handle (stdout/stderr/pid/poll/wait/terminate/kill/returncode) for a script
+    # running in a forked child of a warm worker.
+    def __init__(self, worker, pid, stdout, stderr):
+        self.worker, self.pid, self.stdout, self.stderr = worker, pid, stdout, stderr
+        self.returncode = None
+        self.rusage = None
+
+    def _finish(self, reply):
+        self.returncode = reply.get("exit", 1)
+        self.rusage = reply.get("rusage")
+        _release_warm_worker(self.worker)
+
+    def poll(self):
+        if self.returncode is None:
+            readable, _, _ = select.select([self.worker["socket"]], [], [], 0)
+            if readable: self.wait()
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if self.returncode is None:
+            self.worker["socket"].settimeout(timeout)
+            try:
+                reply_line = self.worker["reader"].readline()
+            except (socket.timeout, TimeoutError):
+                raise subprocess.TimeoutExpired(self.worker["interpreter"], timeout)
+            finally:
+                self.worker["socket"].settimeout(None)
+            try: reply = json.loads(reply_line) if reply_line else {}
+            except ValueError: reply = {}
+            if not reply_line: self.worker["dead"] = True # Worker itself died; don't reuse it
+            self._finish(reply)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            try: os.kill(self.pid, sig)
+            except ProcessLookupError: pass
+
+    def terminate(self): self.send_signal(signal.SIGTERM)
+    def kill(self): self.send_signal(signal.SIGKILL)
+
+def _release_warm_worker(worker):
+    with _WARM_WORKER_LOCK:
+        worker["busy"] = False
+        worker["runs"] += 1
+        rss_mb = _process_rss_mb(worker["process"].pid)
+        if worker.get("dead") or worker["runs"] >= WARM_WORKER_MAX_RUNS or (rss_mb and rss_mb > WARM_WORKER_MAX_RSS_MB):
+            pool = _WARM_WORKER_POOLS.get(worker["interpreter"], [])
+            if worker in pool: pool.remove(worker)
+            threading.Thread(target=_retire_warm_worker, args=(worker,), daemon=True).start()
+            replacement = _spawn_warm_worker(worker["interpreter"]) # Recycled: warm up a fresh one right away
+            if replacement: pool.append(replacement)
+
+def start_in_warm_worker(file_path, interpreter, child_env, rlimits=None):
+    # Returns a WarmWorkerRun, or None if no idle worker could take the job (caller falls back to Popen).
+    with _WARM_WORKER_LOCK:
+        pool = _WARM_WORKER_POOLS.setdefault(interpreter, [])
+        pool[:] = [w for w in pool if w["process"].poll() is None]
+        worker = next((w for w in pool if not w["busy"]), None)
+        if worker is None and len(pool) < WARM_WORKER_POOL_SIZE:
+            worker = _spawn_warm_worker(interpreter)
+            if worker: pool.append(worker)
+        if worker is None: return None
+        worker["busy"] = True
+
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    try:
+        if not worker["ready"]:
+            worker["ready"] = bool(worker["reader"].readline()) # Blocks only while pre-imports finish
+        job = {"path": os.path.abspath(file_path), "cwd": os.getcwd(), "env": child_env, "rlimits": rlimits or []}
+        try: stdin_fd = sys.stdin.fileno()
+        except (AttributeError, ValueError, io.UnsupportedOperation): stdin_fd = os.open(os.devnull, os.O_RDONLY)
+        socket.send_fds(worker["socket"], [json.dumps(job).encode()], [stdin_fd, stdout_write, stderr_write])
+        started_reply = json.loads(worker["reader"].readline())
+        run = WarmWorkerRun(
+            worker, started_reply["started"],
+            io.open(stdout_read, "r", encoding="utf-8", errors="replace"),
+            io.open(stderr_read, "r", encoding="utf-8", errors="replace"),
+        )
+    except Exception:
+        for fd in (stdout_read, stderr_read):
+            try: os.close(fd)
+            except OSError: pass
+        worker["dead"] = True
+        _release_warm_worker(worker)
+        return None
+    finally:
+        os.close(stdout_write); os.close(stderr_write)
+    return run
+
+_PLAN_KERNEL_SOURCE = r"""
+import io, os, sys, ast, json, time, types, atexit, socket, signal, threading, traceback, importlib
+control = socket.socket(fileno=int(sys.argv[1]))
+fork_unsafe_modules = json.loads(sys.argv[2])
+signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C is for the running cell, not the kernel
+main_module = types.ModuleType("__main__")
+sys.modules["__main__"] = main_module
+namespace = main_module.__dict__
+namespace["__builtins__"] = __builtins__
+depth = 0 # Cells committed in this process's state
+parent_status_fd = None # Pipe to the checkpoint this process was forked from
+script_exit_handlers = [] # The script's atexit handlers; run when the state they belong to ends (os._exit skips atexit)
+def register_exit_handler(func, *args, **kwargs):
+    script_exit_handlers.append((func, args, kwargs))
+    return func
+def unregister_exit_handler(func):
+    script_exit_handlers[:] = [handler for handler in script_exit_handlers if handler[0] != func]
+atexit.register, atexit.unregister = register_exit_handler, unregister_exit_handler
+control.sendall(b'{"ready": true}\n')
+
+def flush_script_files():
+    # Files the script left open at module level: a plain run flushes them at exit, a checkpoint never exits.
+    for value in list(namespace.values()):
+        if isinstance(value, io.IOBase) and not value.closed:
+            try: value.flush()
+            except BaseException: pass
+
+def end_script():
+    # What interpreter shutdown would do for the script, for a state that is discarded.
+    while script_exit_handlers: # Last registered first, like atexit
+        func, args, kwargs = script_exit_handlers.pop()
+        try: func(*args, **kwargs)
+        except SystemExit: pass
+        except BaseException: traceback.print_exc()
+    flush_script_files()
+    try: sys.stdout.flush(); sys.stderr.flush()
+    except BaseException: pass
+
+def send(message):
+    control.sendall((json.dumps(message) + "\n").encode())
+
+def leave(status):
+    # Ends this checkpoint; "B<depth>" asks the ancestors above <depth> to end too (rollback / shutdown at -1).
+    if parent_status_fd is not None:
+        try: os.write(parent_status_fd, status.encode())
+        except OSError: pass
+    os._exit(0)
+
+def quiet_std_fds():
+    try: sys.stdout.flush(); sys.stderr.flush()
+    except BaseException: pass
+    null_fd = os.open(os.devnull, os.O_RDWR)
+    for target_fd in (0, 1, 2): os.dup2(null_fd, target_fd)
+    os.close(null_fd)
+
+def usage():
+    import resource
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    return {"maxrss_kb": own.ru_maxrss, "utime": own.ru_utime, "stime": own.ru_stime}
+
+def run_cell(job, fds):
+    for target_fd, received_fd in zip((0, 1, 2), fds): os.dup2(received_fd, target_fd)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    for resource_id, soft_limit, hard_limit in job.get("rlimits") or []:
+        try:
+            import resource
+            resource.setrlimit(resource_id, (soft_limit, hard_limit))
+        except (ValueError, OSError): pass
+    os.chdir(job["cwd"])
+    os.environ.clear(); os.environ.update(job["env"])
+    sys.argv = [job["path"]]
+    sys.path[0] = os.path.dirname(job["path"])
+    namespace["__file__"] = job["path"]
+    for name in job.get("forget") or []: namespace.pop(name, None)
+    importlib.invalidate_caches() # Modules pip-installed since the kernel started
+    with open(job["path"], encoding="utf-8", newline="") as script_file: script_text = script_file.read()
+    cell = job["cells"][0]
+    stopped = False # SystemExit: a plain run would end here, so the cell is final and never committed
+    try:
+        try:
+            tree = ast.parse(script_text[cell["start"]:cell["end"]], job["path"])
+        except SyntaxError as e:
+            if e.lineno: e.lineno += cell["line_offset"]
+            raise
+        ast.increment_lineno(tree, cell["line_offset"]) # Tracebacks show the line numbers of the whole file
+        exec(compile(tree, job["path"], "exec"), namespace)
+        exit_code = 0
+    except SystemExit as e:
+        stopped = True
+        if e.code is None: exit_code = 0
+        elif isinstance(e.code, int): exit_code = e.code
+        else: print(e.code, file=sys.stderr); exit_code = 1
+    except BaseException as e:
+        tb = e.__traceback__
+        while tb is not None and tb.tb_frame.f_code.co_filename != job["path"]:
+            tb = tb.tb_next # Hide kernel frames, like a plain `python script.py` traceback
+        traceback.print_exception(type(e), e, tb)
+        exit_code = 1
+    if exit_code == 0: # Like interpreter shutdown: the cell is done when its non-daemon threads are
+        for thread in threading.enumerate():
+            if thread is not threading.main_thread() and not thread.daemon: thread.join()
+    return exit_code, stopped
+
+pending = None # (job, fds) this process continues with after committing a cell
+while True:
+    if pending is None:
+        message, fds, _flags, _addr = socket.recv_fds(control, 1 << 20, 3)
+        if not message: end_script(); leave("B-1")
+        job = json.loads(message)
+        if "rollback" in job:
+            if job["rollback"] >= depth: send({"depth": depth}); continue
+            end_script(); leave(f"B{job['rollback']}") # This (deepest) state's run is over; the ancestors just leave
+    else:
+        (job, fds), pending = pending, None
+    status_read, status_write = os.pipe()
+    child_pid = os.fork()
+    if child_pid == 0:
+        os.close(status_read)
+        if parent_status_fd is not None: os.close(parent_status_fd)
+        parent_status_fd = status_write
+        send({"started": os.getpid()})
+        cell_started = time.time()
+        exit_code, stopped = run_cell(job, fds)
+        cell_seconds = time.time() - cell_started
+        extra_threads = threading.active_count() - 1
+        loaded_unsafe = [name for name in fork_unsafe_modules if name in sys.modules]
+        if exit_code != 0 or stopped: end_script() # Still on the run's stdout/stderr
+        else: flush_script_files()
+        quiet_std_fds()
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if exit_code != 0 or stopped:
+            send({"exit": exit_code, "final": True, "seconds": cell_seconds, "rusage": usage()})
+            os.write(parent_status_fd, b"R")
+            os._exit(exit_code & 0xFF)
+        depth += 1
+        final = len(job["cells"]) == 1
+        send({"exit": 0, "depth": depth, "final": final, "seconds": cell_seconds, "rusage": usage(),
+              "threads": extra_threads, "fork_unsafe": loaded_unsafe})
+        os.write(parent_status_fd, b"C")
+        if final:
+            for received_fd in fds: os.close(received_fd)
+        else:
+            pending = (dict(job, cells=job["cells"][1:], forget=[]), fds)
+        continue # This process is now the active kernel; its parent stays behind as the checkpoint
+    os.close(status_write)
+    for received_fd in fds: os.close(received_fd)
+    _pid, wait_status, child_usage = os.wait4(child_pid, 0)
+    os.set_blocking(status_read, False) # A cell's own children may still hold the write end
+    child_status = b""
+    try:
+        while True:
+            chunk = os.read(status_read, 4096)
+            if not chunk: break
+            child_status += chunk
+    except BlockingIOError: pass
+    os.close(status_read)
+    child_status = child_status.decode()
+    if "B" in child_status:
+        target_depth = int(child_status.rsplit("B", 1)[1])
+        if target_depth < depth: leave(f"B{target_depth}")
+        send({"depth": depth})
+    elif "C" in child_status:
+        leave("B-1") # A committed checkpoint died on its own: the kernel's state is gone
+    elif "R" not in child_status: # Killed mid-cell (timeout, signal, os._exit); report for it
+        send({"exit": os.waitstatus_to_exitcode(wait_status), "final": True,
+              "rusage": {"maxrss_kb": child_usage.ru_maxrss, "utime": child_usage.ru_utime, "stime": child_usage.ru_stime}})
+"""
+
+class PlanKernelRun:
+    # Popen-like handle (stdout/stderr/pid/poll/wait/terminate/kill/returncode) for cells running in the plan
+    # kernel. `pid` follows the cell currently running; replies are consumed by a reader thread.
+    def __init__(self, kernel, job, stdout, stderr, on_commit):
+        self.kernel, self.job, self.stdout, self.stderr = kernel, job, stdout, stderr
+        self.pid, self.returncode, self.rusage = None, None, None
+        self._on_commit = on_commit
+        self._done = threading.Event()
+        threading.Thread(target=self._read_replies, daemon=True).start()
+
+    def _read_replies(self):
+        exit_code, committed = 1, 0
+        try:
+            for reply_line in iter(self.kernel["reader"].readline, ""):
+                reply = json.loads(reply_line)
+                if "started" in reply:
+                    self.pid = reply["started"]; continue
+                if reply.get("rusage"):
+                    cell_usage = reply["rusage"]
+                    self.rusage = {"maxrss_kb": max(cell_usage["maxrss_kb"], (self.rusage or {}).get("maxrss_kb", 0)),
+                                   "utime": cell_usage["utime"] + (self.rusage or {}).get("utime", 0.0),
+                                   "stime": cell_usage["stime"] + (self.rusage or {}).get("stime", 0.0)}
+                exit_code = reply.get("exit", 1)
+                if exit_code == 0 and "depth" in reply: # No depth: the cell called sys.exit(0), final but not kept
+                    self._on_commit(self.kernel, self.job, committed, reply); committed += 1
+                if reply.get("final") or exit_code != 0: break
+            else:
+                self.kernel["dead"] = True # Kernel went away mid-run
+        except (OSError, ValueError):
+            self.kernel["dead"] = True
+        finally:
+            self.returncode = exit_code
+            self._done.set()
+
+    def poll(self):
+        return self.returncode if self._done.is_set() else None
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout): raise subprocess.TimeoutExpired(self.kernel["interpreter"], timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.pid and not self._done.is_set():
+            try: os.kill(self.pid, sig)
+            except ProcessLookupError: pass
+
+    def terminate(self): self.send_signal(signal.SIGTERM)
+    def kill(self): self.send_signal(signal.SIGKILL)
+
+def _start_plan_kernel(interpreter, file_path):
+    poop_side, kernel_side = socket.socketpair()
+    kernel_env = script_child_env(); kernel_env["PYTHONIOENCODING"] = "utf-8"
+    try:
+        process = subprocess.Popen(
+            [interpreter, "-u", "-c", _PLAN_KERNEL_SOURCE, str(kernel_side.fileno()), json.dumps(PLAN_KERNEL_FORK_UNSAFE_MODULES)],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            pass_fds=(kernel_side.fileno(),), env=kernel_env
+        )
+    except Exception:
+        poop_side.close()
+        return None
+    finally:
+        kernel_side.close()
+    kernel = {"process": process, "socket": poop_side, "reader": poop_side.makefile("r", encoding="utf-8"),
+              "interpreter": interpreter, "path": file_path, "dead": False, "pending_restore": None,
+              # states[d]: the state at checkpoint depth d -- its cells ({'source', 'seconds'}) and the file prefix
+              # whose plain top-to-bottom run it equals (None after a dependency-based partial update).
+              "states": [{"cells": [], "prefix": ""}]}
+    poop_side.settimeout(30)
+    try: ready = kernel["reader"].readline()
+    except (OSError, socket.timeout): ready = ""
+    poop_side.settimeout(None)
+    if not ready:
+        stop_plan_kernel(kernel); return None
+    return kernel
+
+def stop_plan_kernel(kernel=None):
+    # Closing the socket ends the active process; the checkpoints below it follow.
+    global _PLAN_KERNEL
+    kernel = kernel or _PLAN_KERNEL
+    if kernel is None: return
+    if kernel is _PLAN_KERNEL: _PLAN_KERNEL = None
+    try: kernel["reader"].close(); kernel["socket"].close()
+    except Exception: pass
+    try: kernel["process"].wait(timeout=2)
+    except Exception:
+        try: kernel["process"].kill()
+        except Exception: pass
+
+def reset_plan_kernel():
+    # New plan (or 'clear'): drop the namespace and re-enable the kernel if a previous plan had to disable it.
+    global _PLAN_KERNEL_DISABLED_REASON
+    stop_plan_kernel()
+    _PLAN_KERNEL_DISABLED_REASON = None
+
+def _plan_kernel_rollback(kernel, target_depth):
+    kernel["socket"].sendall((json.dumps({"rollback": target_depth}) + "\n").encode())
+    reply = json.loads(kernel["reader"].readline() or "{}")
+    if reply.get("depth") != target_depth: raise OSError(f"kernel rollback to {target_depth} failed: {reply}")
+    del kernel["states"][target_depth + 1:]
+
+_CELL_NAMES_CACHE = OrderedDict()
+_DYNAMIC_NAMESPACE_NAMES = {"globals", "locals", "vars", "exec", "eval", "__import__", "__builtins__"}
+# Calls a reactive re-run may contain. Anything else (open, Path.read_text, df.to_csv, imported functions...) may
+# communicate with other cells through files, the environment or other external state the name analysis can't see.
+_REACTIVE_PURE_CALLS = {
+    "abs", "all", "any", "bool", "chr", "dict", "divmod", "enumerate", "filter", "float", "format", "frozenset", "hash",
+    "int", "isinstance", "issubclass", "iter", "len", "list", "map", "max", "min", "next", "ord", "pow", "print", "range",
+    "repr", "reversed", "round", "set", "slice", "sorted", "str", "sum", "tuple", "zip", "super", "type", "getattr", "hasattr",
+}
+_REACTIVE_PURE_METHODS = {
+    "append", "extend", "insert", "pop", "remove", "clear", "copy", "count", "index", "sort", "reverse", "get", "keys",
+    "values", "items", "update", "setdefault", "add", "discard", "union", "intersection", "difference", "join", "split",
+    "rsplit", "strip", "lstrip", "rstrip", "replace", "lower", "upper", "title", "startswith", "endswith", "format", "find",
+    "splitlines", "encode", "decode", "zfill", "ljust", "rjust", "center", "isdigit", "isalpha", "isspace",
+}
+# Modules a reactive cell may import; others (os, pathlib, pandas...) expose external state without a call (os.environ.get).
+_REACTIVE_PURE_MODULES = {"math", "re", "string", "itertools", "functools", "collections", "operator", "statistics", "fractions", "decimal", "typing", "dataclasses", "copy", "json"}
+
+def _cell_names(source):
+    # Top-level name flow of a cell: {'defs', 'eager', 'function_refs', 'function_globals', 'opaque', 'callables',
+    # 'called', 'external'}. defs include
+    # names the cell mutates (x.append(...), x[i] = ..., x.attr = ...); eager are names read while the cell runs;
+    # function_refs/function_globals are what each function it defines reads / declares global when called later.
+    # callables are its top-level functions/classes, called the plain names it calls; external is set by any other call
+    # (a method outside _REACTIVE_PURE_METHODS, or a call of a call/subscript result) or import outside _REACTIVE_PURE_MODULES.
+    if source in _CELL_NAMES_CACHE: return _CELL_NAMES_CACHE[source]
+    info = {"defs": set(), "eager": set(), "function_refs": {}, "function_globals": {}, "opaque": False,
+            "callables": set(), "called": set(), "external": False}
+    try: tree = ast.parse(source)
+    except (SyntaxError, ValueError): tree = None; info["opaque"] = True
+    def base_name(node):
+        while isinstance(node, (ast.Attribute, ast.Subscript, ast.Call)): node = node.func if isinstance(node, ast.Call) else node.value
+        return node.id if isinstance(node, ast.Name) else None
+    def visit(node, owners):
+        # owners: names of the top-level definitions whose (lazily run) bodies we are in; empty = runs now.
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)):
+            for child in node.args.defaults + node.args.kw_defaults + getattr(node, "decorator_list", []):
+                if child is not None: visit(child, owners)
+            body_owners = owners or ({node.name} if hasattr(node, "name") else set(info["_targets"]))
+            for child in (node.body if isinstance(node.body, list) else [node.body]): visit(child, body_owners)
+            return
+        if isinstance(node, (ast.Global, ast.Nonlocal)):
+            for owner in owners: info["function_globals"].setdefault(owner, set()).update(node.names)
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name): info["called"].add(node.func.id)
+            elif not (isinstance(node.func, ast.Attribute) and node.func.attr in _REACTIVE_PURE_METHODS): info["external"] = True
+        if isinstance(node, ast.Name):
+            if node.id in _DYNAMIC_NAMESPACE_NAMES: info["opaque"] = True
+            if owners:
+                for owner in owners: info["function_refs"].setdefault(owner, set()).add(node.id)
+            elif isinstance(node.ctx, ast.Load): info["eager"].add(node.id)
+            else: info["defs"].add(node.id)
+        elif not owners and isinstance(node, (ast.Attribute, ast.Subscript)) and not isinstance(node.ctx, ast.Load):
+            if base_name(node): info["defs"].add(base_name(node))
+        elif not owners and isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute):
+            if base_name(node.func): info["defs"].add(base_name(node.func)) # A method call may mutate its object
+        for child in ast.iter_child_nodes(node): visit(child, owners)
+    for statement in (tree.body if tree else []):
+        info["_targets"] = set()
+        if isinstance(statement, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            info["defs"].add(statement.name); info["callables"].add(statement.name)
+            if isinstance(statement, ast.ClassDef): # Class bodies run now; methods run later on behalf of the class
+                for child in statement.bases + statement.keywords + statement.decorator_list: visit(child, set())
+                for child in statement.body:
+                    visit(child, {statement.name} if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)) else set())
+                continue
+        elif isinstance(statement, (ast.Import, ast.ImportFrom)):
+            for alias in statement.names:
+                if alias.name == "*": info["opaque"] = True
+                info["defs"].add(alias.asname or alias.name.split(".")[0])
+            modules = [statement.module or ""] if isinstance(statement, ast.ImportFrom) else [alias.name for alias in statement.names]
+            if getattr(statement, "level", 0) or any(m.split(".")[0] not in _REACTIVE_PURE_MODULES for m in modules): info["external"] = True
+            continue
+        elif isinstance(statement, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            for target in (statement.targets if isinstance(statement, ast.Assign) else [statement.target]):
+                info["_targets"].update(n.id for n in ast.walk(target) if isinstance(n, ast.Name))
+            if isinstance(statement, ast.AugAssign) and isinstance(statement.target, ast.Name): info["eager"].add(statement.target.id)
+        visit(statement, set())
+    info.pop("_targets", None)
+    _CELL_NAMES_CACHE[source] = info
+    while len(_CELL_NAMES_CACHE) > 256: _CELL_NAMES_CACHE.popitem(last=False)
+    return info
+
+def _reactive_rerun_positions(cell_sources, changed_index, new_source):
+    # Positions of the later cells that must re-run if cell `changed_index` is re-run on top of the current state, or
+    # None (caller rolls back instead) when the name analysis can't vouch for it: dynamic namespace use, any call that
+    # may touch files/environment/other external state (cells can depend on each other through those, e.g. save CSV
+    # then load CSV), reads of names later cells rebind, or re-run cells rebinding names that kept cells set afterwards.
+    infos = [_cell_names(source) for source in cell_sources]
+    changed_info = _cell_names(new_source)
+    all_infos = infos + [changed_info]
+    if any(info["opaque"] or info["external"] for info in all_infos): return None
+    local_callables = set().union(*(info["callables"] for info in all_infos))
+    if any(info["called"] - _REACTIVE_PURE_CALLS - local_callables for info in all_infos): return None
+    current_infos = infos[:changed_index] + [changed_info] + infos[changed_index + 1:]
+    function_refs, function_globals = {}, {}
+    for info in current_infos:
+        function_refs.update(info["function_refs"]); function_globals.update(info["function_globals"])
+    def effective_defs(info):
+        called_globals = set().union(*(function_globals[name] for name in info["eager"] if name in function_globals))
+        return info["defs"] | called_globals
+    def with_callers(names):
+        # Functions that read a changed name behave differently too.
+        grew = True
+        while grew:
+            grew = False
+            for function_name, refs in function_refs.items():
+                if function_name not in names and refs & names: names.add(function_name); grew = True
+        return names
+    affected = with_callers(effective_defs(changed_info) | effective_defs(infos[changed_index]))
+    dependents = []
+    for position in range(changed_index + 1, len(cell_sources)):
+        if infos[position]["eager"] & affected:
+            dependents.append(position); affected = with_callers(affected | effective_defs(infos[position]))
+    rerun = [changed_index] + dependents
+    for position in rerun:
+        later_defs = set().union(*(effective_defs(info) for info in infos[position + 1:]))
+        if current_infos[position]["eager"] & later_defs: return None
+    kept_defs = set().union(*(effective_defs(infos[p]) for p in range(changed_index + 1, len(cell_sources)) if p not in dependents))
+    if set().union(*(effective_defs(current_infos[p]) for p in rerun)) & kept_defs: return None
+    return dependents
+
+def _plan_kernel_job(kernel, code, file_path):
+    # Decides how to bring the kernel's state up to `code`: (base_depth, cells to run as [(start, end)], the cells list
+    # after the run, 'append'|'rollback'|'reactive', names to forget).
+    state = kernel["states"][-1]
+    sources = [cell["source"] for cell in state["cells"]] if kernel["path"] == file_path else []
+    committed = "".join(sources)
+    if sources and code.startswith(committed) and code[len(committed):].strip():
+        new_cells = state["cells"] + [{"source": code[len(committed):], "seconds": None}]
+        return len(kernel["states"]) - 1, [len(sources)], new_cells, "append", []
+    changed_index = 0
+    while changed_index < len(sources) and code.startswith("".join(sources[:changed_index + 1])): changed_index += 1
+    if sources and changed_index == len(sources): changed_index -= 1 # Same code again: re-run the last cell
+    remainder = code[len("".join(sources[:changed_index])):]
+    # Split the rest into cells again: later cells found unchanged (in order) stay cells of their own, the text
+    # between them becomes new cells.
+    segments, search_from = [], 0
+    for old_cell in state["cells"][changed_index + 1:]:
+        found_at = remainder.find(old_cell["source"], search_from)
+        if found_at < 0 or not old_cell["source"]: continue
+        if found_at > search_from or not segments: segments.append({"source": remainder[search_from:found_at], "seconds": None})
+        segments.append(old_cell); search_from = found_at + len(old_cell["source"])
+    if search_from < len(remainder) or not segments: segments.append({"source": remainder[search_from:], "seconds": None})
+    new_cells = state["cells"][:changed_index] + segments
+    later_kept = segments[1:1 + len(sources) - changed_index - 1]
+    if changed_index < len(sources) and [cell["source"] for cell in later_kept] == sources[changed_index + 1:]:
+        # Exactly one earlier cell changed (plus maybe appended code): re-run it and only the cells that depend on it.
+        dependents = _reactive_rerun_positions(sources, changed_index, segments[0]["source"])
+        if dependents is not None and len(dependents) + 1 < len(sources) - changed_index:
+            run_positions = [changed_index] + dependents + list(range(len(sources), len(new_cells)))
+            still_defined = set().union(*(_cell_names(cell["source"])["defs"] for cell in new_cells))
+            forget = sorted(_cell_names(sources[changed_index])["defs"] - still_defined)
+            return len(kernel["states"]) - 1, run_positions, new_cells, "reactive", forget
+    mode = "rollback"
+    # Roll back to the deepest checkpoint that is a plain run of a prefix of the new cells.
+    boundaries = {0: 0}
+    for position, cell in enumerate(new_cells): boundaries[len("".join(c["source"] for c in new_cells[:position + 1]))] = position + 1
+    for base_depth in range(len(kernel["states"]) - 1, -1, -1):
+        prefix = kernel["states"][base_depth]["prefix"]
+        if (prefix is not None and (kernel["path"] == file_path or base_depth == 0) and code.startswith(prefix)
+                and boundaries.get(len(prefix), len(new_cells)) <= changed_index):
+            first_cell = boundaries[len(prefix)]
+            return base_depth, list(range(first_cell, len(new_cells))), new_cells, mode, []
+
+def _plan_kernel_commit(kernel, job, index, reply):
+    # Reader thread: the job's cell `index` ran and is now checkpoint reply['depth'].
+    position = job["positions"][index]
+    cell = dict(job["new_cells"][position], seconds=reply.get("seconds"))
+    job["new_cells"][position] = cell
+    previous = kernel["states"][-1]
+    if job["mode"] == "reactive":
+        state = {"cells": job["new_cells"] if index == len(job["positions"]) - 1 else previous["cells"], "prefix": None}
+    else:
+        cells = job["new_cells"][:position + 1]
+        state = {"cells": cells, "prefix": "".join(c["source"] for c in cells)}
+    kernel["states"].append(state)
+    PLAN_KERNEL_STATS["cells_run"] += 1
+    if reply.get("threads") or reply.get("fork_unsafe"):
+        global _PLAN_KERNEL_DISABLED_REASON
+        _PLAN_KERNEL_DISABLED_REASON = (f"cell left {reply['threads']} background thread(s) running" if reply.get("threads")
+                                        else f"cell imported {', '.join(reply['fork_unsafe'])}")
+
+def plan_kernel_run(code, file_path, interpreter=None):
+    # Runs `code` (already written to file_path) in the plan kernel, executing only the cells that changed since the
+    # kernel's state was built. Returns a PlanKernelRun, or None when the caller should run the whole file normally.
+    global _PLAN_KERNEL
+    if not PLAN_KERNEL_ENABLED: return None
+    interpreter = interpreter or sys.executable
+    file_path = os.path.abspath(file_path)
+    kernel = _PLAN_KERNEL
+    if _PLAN_KERNEL_DISABLED_REASON:
+        if kernel:
+            print(f"{POOP_MSG_COLOR}POOP: Incremental kernel off for this plan ({_PLAN_KERNEL_DISABLED_REASON}); running the whole file.{RESET_COLOR}")
+            stop_plan_kernel()
+        PLAN_KERNEL_STATS["fallbacks"] += 1
+        return None
+    if kernel and (kernel["dead"] or kernel["interpreter"] != interpreter or kernel["process"].poll() is not None or len(kernel["states"]) > PLAN_KERNEL_MAX_CELLS):
+        stop_plan_kernel(); kernel = None
+        PLAN_KERNEL_STATS["restarts"] += 1
+    if kernel is None:
+        kernel = _PLAN_KERNEL = _start_plan_kernel(interpreter, file_path)
+        if kernel is None:
+            PLAN_KERNEL_STATS["fallbacks"] += 1; return None
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    try:
+        if kernel["pending_restore"] is not None: # A dependency-based update failed half-way: undo its cells
+            _plan_kernel_rollback(kernel, kernel["pending_restore"]); kernel["pending_restore"] = None
+        base_depth, positions, new_cells, mode, forget = _plan_kernel_job(kernel, code, file_path)
+        reused_cells = [cell for position, cell in enumerate(new_cells) if position not in positions]
+        saved_seconds = sum(cell["seconds"] or 0.0 for cell in reused_cells)
+        PLAN_KERNEL_STATS["cells_reused"] += len(reused_cells); PLAN_KERNEL_STATS["seconds_saved"] += saved_seconds
+        if mode != "rollback": PLAN_KERNEL_STATS["appends" if mode == "append" else "reactive_updates"] += 1
+        elif base_depth: PLAN_KERNEL_STATS["rollbacks"] += 1
+        elif len(kernel["states"]) > 1: PLAN_KERNEL_STATS["full_reruns"] += 1
+        if base_depth != len(kernel["states"]) - 1: _plan_kernel_rollback(kernel, base_depth)
+        kernel["path"] = file_path
+        if mode == "reactive": kernel["pending_restore"] = base_depth # Cleared once every cell of the update committed
+        offsets, position_start = [], 0
+        for cell in new_cells:
+            offsets.append((position_start, position_start + len(cell["source"]))); position_start += len(cell["source"])
+        job = {"path": file_path, "cwd": os.getcwd(), "env": script_child_env(), "rlimits": run_limit_rlimits(), "forget": forget,
+               "cells": [{"start": offsets[p][0], "end": offsets[p][1], "line_offset": code[:offsets[p][0]].count("\n")} for p in positions]}
+        if positions and reused_cells:
+            print(f"{POOP_MSG_COLOR}POOP kernel: running {len(positions)} of {len(new_cells)} cell(s) ({mode}); "
+                  f"{len(reused_cells)} reused{f', ~{saved_seconds:.1f}s saved' if saved_seconds >= 0.05 else ''}.{RESET_COLOR}")
+        try: stdin_fd = sys.stdin.fileno()
+        except (AttributeError, ValueError, io.UnsupportedOperation): stdin_fd = os.open(os.devnull, os.O_RDONLY)
+        run_job = {"positions": positions, "new_cells": new_cells, "mode": mode}
+        socket.send_fds(kernel["socket"], [json.dumps(job).encode()], [stdin_fd, stdout_write, stderr_write])
+        def on_commit(kernel_run, job_state, index, reply):
+            _plan_kernel_commit(kernel_run, job_state, index, reply)
+            if job_state["mode"] == "reactive" and index == len(job_state["positions"]) - 1: kernel_run["pending_restore"] = None
+        return PlanKernelRun(kernel, run_job, io.open(stdout_read, "r", encoding="utf-8", errors="replace"),
+                             io.open(stderr_read, "r", encoding="utf-8", errors="replace"), on_commit)
+    except Exception as e_kernel:
+        for fd in (stdout_read, stderr_read):
+            try: os.close(fd)
+            except OSError: pass
+        print(f"{WARNING_COLOR}!POOP: Incremental kernel unavailable ({e_kernel}); running the whole file.{RESET_COLOR}")
+        stop_plan_kernel(kernel)
+        PLAN_KERNEL_STATS["fallbacks"] += 1
+        return None
+    finally:
+        os.close(stdout_write); os.close(stderr_write)
+
+def print_plan_kernel_status():
+    kernel = _PLAN_KERNEL
+    print(f"\n{POOP_MSG_COLOR}--- Plan Kernel ({'on' if PLAN_KERNEL_ENABLED else 'off'}) ---{RESET_COLOR}")
+    if kernel:
+        state = kernel["states"][-1]
+        print(f"{BRIGHT_WHITE_COLOR}Active:{RESET_COLOR} PID {kernel['process'].pid}, {os.path.basename(kernel['path'])}, {len(state['cells'])} cell(s), "
+              f"{len(kernel['states']) - 1} checkpoint(s), interpreter {kernel['interpreter']}")
+        for position, cell in enumerate(state["cells"]):
+            first_line = next((line.strip() for line in cell["source"].splitlines() if line.strip()), "")
+            seconds = f"{cell['seconds']:.2f}s" if cell["seconds"] is not None else "?"
+            print(f"  [{position + 1}] {seconds:>7} {first_line[:90]}")
+    elif _PLAN_KERNEL_DISABLED_REASON:
+        print(f"{WARNING_COLOR}Off for this plan: {_PLAN_KERNEL_DISABLED_REASON}.{RESET_COLOR}")
+    else:
+        print(f"{BRIGHT_WHITE_COLOR}No kernel running (starts with the first plan step).{RESET_COLOR}")
+    stats = PLAN_KERNEL_STATS
+    print(f"{BRIGHT_WHITE_COLOR}This session:{RESET_COLOR} {stats['cells_run']} cells run, {stats['cells_reused']} reused (~{stats['seconds_saved']:.1f}s saved); "
+          f"{stats['appends']} appends, {stats['rollbacks']} rollbacks, {stats['reactive_updates']} dependency updates, {stats['full_reruns']} full re-runs, "
+          f"{stats['restarts']} restarts, {stats['fallbacks']} full-file fallbacks")
+    print(f"{POOP_MSG_COLOR}-----------------------------{RESET_COLOR}")
+
+def run_limit_rlimits():
+    # [(RLIMIT_*, soft, hard), ...] for RUN_LIMITS. The hard CPU limit is a little above the soft
+    # one so the script gets SIGXCPU (recognisable) before the kernel's SIGKILL.
+    if resource is None: return []
+    rlimits = []
+    def add(name, soft_limit, hard_limit):
+        resource_id = getattr(resource, name, None)
+        if resource_id is None: return
+        _current_soft, current_hard = resource.getrlimit(resource_id)
+        if current_hard != resource.RLIM_INFINITY: # Can't raise above an existing hard limit
+            soft_limit, hard_limit = min(soft_limit, current_hard), min(hard_limit, current_hard)
+        rlimits.append((resource_id, soft_limit, hard_limit))
+    if RUN_LIMITS.get("cpu_seconds"):
+        add("RLIMIT_CPU", int(RUN_LIMITS["cpu_seconds"]), int(RUN_LIMITS["cpu_seconds"]) + 5)
+    if RUN_LIMITS.get("memory_mb"):
+        memory_bytes = int(RUN_LIMITS["memory_mb"] * 1024 * 1024)
+        add("RLIMIT_DATA" if hasattr(resource, "RLIMIT_DATA") else "RLIMIT_AS", memory_bytes, memory_bytes)
+    if RUN_LIMITS.get("file_size_mb"):
+        file_size_bytes = int(RUN_LIMITS["file_size_mb"] * 1024 * 1024)
+        add("RLIMIT_FSIZE", file_size_bytes, file_size_bytes)
+    return rlimits
+
+# Limits are applied without running Python between fork and exec (preexec_fn isn't safe with POOP's threads):
+# on Linux with resource.prlimit on the child's pid right after spawn, elsewhere by this launcher that sets them
+# in the new interpreter before running the script.
+_RLIMIT_LAUNCHER_SOURCE = (
+    "import os, resource, runpy, sys\n"
+    "for limit in sys.argv[1].split(','):\n"
+    "    resource_id, soft_limit, hard_limit = map(int, limit.split(':'))\n"
+    "    resource.setrlimit(resource_id, (soft_limit, hard_limit))\n"
+    "sys.argv = sys.argv[2:]\n"
+    "sys.path[0] = os.path.dirname(os.path.abspath(sys.argv[0]))\n"
+    "runpy.run_path(sys.argv[0], run_name='__main__')\n"
+)
+
+def _rlimited_command(interpreter, file_path, rlimits, flags=()):
+    # Command line for running file_path under rlimits; uses the launcher only when prlimit can't be applied after spawn.
+    if not rlimits or hasattr(resource, "prlimit"): return [interpreter, *flags, file_path]
+    limit_spec = ",".join(f"{resource_id}:{soft_limit}:{hard_limit}" for resource_id, soft_limit, hard_limit in rlimits)
+    return [interpreter, *flags, "-c", _RLIMIT_LAUNCHER_SOURCE, limit_spec, file_path]
+
+def _apply_rlimits_after_spawn(process, rlimits):
+    if not rlimits or not hasattr(resource, "prlimit"): return
+    for resource_id, soft_limit, hard_limit in rlimits:
+        try:
+            resource.prlimit(process.pid, resource_id, (soft_limit, hard_limit))
+        except ProcessLookupError:
+            return # Already gone
+        except (OSError, ValueError) as e:
+            print(f"{WARNING_COLOR}!POOP: Couldn't apply a resource limit to the script: {e}{RESET_COLOR}")
+
+def launch_python_script(file_path, interpreter=None):
+    # Runs `interpreter file_path` with piped, unbuffered stdout/stderr under RUN_LIMITS; prefers a warm worker.
+    interpreter = interpreter or sys.executable
+    child_env = script_child_env()
+    rlimits = run_limit_rlimits()
+    if WARM_WORKERS_ENABLED:
+        warm_run = start_in_warm_worker(file_path, interpreter, child_env, rlimits)
+        if warm_run: return warm_run
+    process = subprocess.Popen(
+        _rlimited_command(interpreter, file_path, rlimits), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        text=True, bufsize=1, encoding='utf-8', errors='replace', env=child_env
+    )
+    _apply_rlimits_after_spawn(process, rlimits)
+    return process
+
+def wait_with_rusage(process):
+    # Waits for a launched script and returns (exit_code, rusage dict or None). Popen children are
+    # reaped with os.wait4 so their own peak RSS and CPU times are available.
+    if isinstance(process, (WarmWorkerRun, PlanKernelRun)):
+        process.wait()
+        return process.returncode, process.rusage
+    if hasattr(os, "wait4") and process.returncode is None:
+        try:
+            _pid, wait_status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(wait_status)
+            return process.returncode, {"maxrss_kb": usage.ru_maxrss, "utime": usage.ru_utime, "stime": usage.ru_stime}
+        except ChildProcessError:
+            pass # Already reaped elsewhere
+    process.wait()
+    return process.returncode, None
+
+def build_run_telemetry(return_code, rusage, wall_seconds, wall_limit_hit, stderr_lines):
+    telemetry = {"exit_code": return_code, "wall_seconds": wall_seconds, "user_cpu_seconds": None,
+                 "sys_cpu_seconds": None, "peak_rss_mb": None, "limit_hit": None}
+    if rusage:
+        # ru_maxrss is KiB on Linux, bytes on macOS
+        peak_rss_kb = rusage["maxrss_kb"] / 1024.0 if sys.platform == "darwin" else rusage["maxrss_kb"]
+        telemetry.update(user_cpu_seconds=rusage["utime"], sys_cpu_seconds=rusage["stime"], peak_rss_mb=peak_rss_kb / 1024.0)
+    stderr_tail = "\n".join(stderr_lines[-20:])
+    cpu_used = (telemetry["user_cpu_seconds"] or 0) + (telemetry["sys_cpu_seconds"] or 0)
+    if wall_limit_hit:
+        telemetry["limit_hit"] = f"wall-clock limit of {RUN_LIMITS['wall_seconds']}s"
+    elif return_code in (-getattr(signal, "SIGXCPU", 24), -signal.SIGKILL) and RUN_LIMITS.get("cpu_seconds") and cpu_used >= RUN_LIMITS["cpu_seconds"] * 0.95:
+        telemetry["limit_hit"] = f"CPU time limit of {RUN_LIMITS['cpu_seconds']}s"
+    elif return_code != 0 and RUN_LIMITS.get("memory_mb") and ("MemoryError" in stderr_tail or "Cannot allocate memory" in stderr_tail):
+        telemetry["limit_hit"] = f"memory limit of {RUN_LIMITS['memory_mb']} MB"
+    elif return_code == -getattr(signal, "SIGXFSZ", 25) or (return_code != 0 and "File too large" in stderr_tail):
+        telemetry["limit_hit"] = f"file size limit of {RUN_LIMITS['file_size_mb']} MB"
+    return telemetry
+
+def format_run_telemetry(telemetry):
+    parts = [f"wall {telemetry['wall_seconds']:.2f}s"]
+    if telemetry["user_cpu_seconds"] is not None:
+        parts.append(f"CPU {telemetry['user_cpu_seconds']:.2f}s user / {telemetry['sys_cpu_seconds']:.2f}s sys")
+    if telemetry["peak_rss_mb"] is not None:
+        parts.append(f"peak RSS {telemetry['peak_rss_mb']:.1f} MB")
+    parts.append(f"exit {telemetry['exit_code']}")
+    return ", ".join(parts)
+
+def print_run_limits():
+    print(f"\n{POOP_MSG_COLOR}--- Run Limits ---{RESET_COLOR}")
+    for limit_name, limit_value in RUN_LIMITS.items():
+        print(f"{BRIGHT_WHITE_COLOR}{limit_name}:{RESET_COLOR} {limit_value if limit_value else 'off'}")
+    if resource is None: print(f"{WARNING_COLOR}(resource module unavailable: only wall-clock limits are enforced){RESET_COLOR}")
+    if RUN_TELEMETRY_HISTORY:
+        print(f"{POOP_MSG_COLOR}Recent runs:{RESET_COLOR}")
+        for telemetry in list(RUN_TELEMETRY_HISTORY)[-5:]:
+            limit_note = f" {ERROR_COLOR}[{telemetry['limit_hit']} hit]{RESET_COLOR}" if telemetry["limit_hit"] else ""
+            print(f"  {telemetry.get('file', '?')}: {format_run_telemetry(telemetry)}{limit_note}")
+    print(f"{POOP_MSG_COLOR}------------------{RESET_COLOR}")
+
+def print_warm_worker_status():
+    print(f"\n{POOP_MSG_COLOR}--- Warm Worker Pool ---{RESET_COLOR}")
+    print(f"{BRIGHT_WHITE_COLOR}Enabled:{RESET_COLOR} {WARM_WORKERS_ENABLED}  {BRIGHT_WHITE_COLOR}Size:{RESET_COLOR} {WARM_WORKER_POOL_SIZE}  {BRIGHT_WHITE_COLOR}Pre-imports:{RESET_COLOR} {', '.join(WARM_WORKER_PREIMPORTS) or 'none'}")
+    print(f"{BRIGHT_WHITE_COLOR}Recycle after:{RESET_COLOR} {WARM_WORKER_MAX_RUNS} runs or {WARM_WORKER_MAX_RSS_MB} MB RSS")
+    with _WARM_WORKER_LOCK:
+        for interpreter, pool in _WARM_WORKER_POOLS.items():
+            for worker in pool:
+                rss_mb = _process_rss_mb(worker["process"].pid)
+                state = "busy" if worker["busy"] else ("idle" if worker["ready"] else "warming up")
+                alive = "" if worker["process"].poll() is None else " (exited)"
+                print(f"  {interpreter} PID {worker['process'].pid}: {state}{alive}, {worker['runs']} runs, RSS {f'{rss_mb:.0f} MB' if rss_mb else 'N/A'}")
+    print(f"{POOP_MSG_COLOR}------------------------{RESET_COLOR}")
+
+def _unconditional_import_nodes(statements):
+    # Import nodes that run whenever the script runs: module level, outside functions, classes and conditions (an
+    # `if __name__ == "__main__":` body counts as module level), and not in a try that catches ImportError (optional
+    # dependencies). Imports elsewhere (`if os.name == 'nt': import msvcrt`, TYPE_CHECKING blocks) may never run.
+    nodes = []
+    for statement in statements:
+        if isinstance(statement, (ast.Import, ast.ImportFrom)):
+            nodes.append(statement)
+        elif isinstance(statement, ast.If):
+            test = statement.test
+            if (isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and test.left.id == "__name__" and len(test.ops) == 1
+                    and isinstance(test.ops[0], ast.Eq) and isinstance(test.comparators[0], ast.Constant) and test.comparators[0].value == "__main__"):
+                nodes += _unconditional_import_nodes(statement.body)
+        elif isinstance(statement, (ast.With, ast.AsyncWith)):
+            nodes += _unconditional_import_nodes(statement.body)
+        elif isinstance(statement, ast.Try) or type(statement).__name__ == "TryStar":
+            handler_names = set()
+            for handler in statement.handlers:
+                handler_types = handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]
+                handler_names |= {getattr(handler_type, "id", None) for handler_type in handler_types}
+            if not handler_names & {None, "ImportError", "ModuleNotFoundError", "Exception", "BaseException"}:
+                nodes += _unconditional_import_nodes(statement.body)
+            nodes += _unconditional_import_nodes(statement.finalbody)
+    return nodes
+
+def find_missing_modules(module_names, interpreter=None, script_dir=None):
+    # Top-level module names that interpreter (default: POOP's own) can't import. Other interpreters are asked in one subprocess.
+    interpreter = interpreter or sys.executable
+    candidates = []
+    for module_name in module_names:
+        if (interpreter, module_name) in _PREFLIGHT_FOUND_MODULES or module_name in sys.builtin_module_names: continue
+        if module_name == IMAGE_HANDOFF_MODULE: continue # Provided by POOP on the script's PYTHONPATH
+        if script_dir and (os.path.exists(os.path.join(script_dir, module_name + ".py")) or os.path.isdir(os.path.join(script_dir, module_name))):
+            continue # Local module next to the script
+        candidates.append(module_name)
+    if not candidates: return []
+    if os.path.abspath(interpreter) == os.path.abspath(sys.executable): # Not realpath: a venv's python symlinks to its base interpreter
+        missing = []
+        for module_name in candidates:
+            try:
+                found = importlib.util.find_spec(module_name) is not None
+            except (ImportError, ValueError):
+                found = False
+            if found: _PREFLIGHT_FOUND_MODULES.add((interpreter, module_name))
+            else: missing.append(module_name)
+        return missing
+    try:
+        probe = subprocess.run(
+            [interpreter, "-c", "import importlib.util, json, sys; print(json.dumps([n for n in sys.argv[1:] if importlib.util.find_spec(n) is None]))", *candidates],
+            capture_output=True, text=True, timeout=30
+        )
+        missing = json.loads(probe.stdout.strip().splitlines()[-1]) if probe.returncode == 0 and probe.stdout.strip() else []
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        return [] # Can't tell; the run itself will report it
+    _PREFLIGHT_FOUND_MODULES.update((interpreter, module_name) for module_name in candidates if module_name not in missing)
+    return missing
+
+def _undefined_names(tree, predefined_names=()):
+    # Names that are read somewhere but bound nowhere in the script (any scope) and aren't builtins. Advisory only:
+    # valid code can still read names nobody binds statically (platform-only builtins like WindowsError, names set
+    # through globals()/exec). Skipped entirely for star imports and dynamic namespace use; names only read as
+    # exception types in `except` clauses are left out.
+    bound = set(dir(builtins)) | set(predefined_names) | {"__file__", "__name__", "__doc__", "__builtins__", "__spec__", "__loader__", "__package__", "__path__", "__annotations__"}
+    loads = {}
+    except_type_names = {id(child) for node in ast.walk(tree) if isinstance(node, ast.ExceptHandler) and node.type for child in ast.walk(node.type)}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id in _DYNAMIC_NAMESPACE_NAMES: return []
+            if isinstance(node.ctx, ast.Load):
+                if id(node) not in except_type_names: loads.setdefault(node.id, node.lineno)
+            else: bound.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            bound.add(node.name)
+            if isinstance(node, ast.ClassDef): bound.add("__class__") # Implicit closure cell of methods (used by super())
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*": return []
+                bound.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            bound.update(node.names)
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            bound.add(node.name)
+        elif type(node).__name__ in ("MatchAs", "MatchStar", "MatchMapping", "TypeVar", "ParamSpec", "TypeVarTuple"):
+            for attribute in ("name", "rest"):
+                if isinstance(getattr(node, attribute, None), str): bound.add(getattr(node, attribute))
+    return sorted(((name, line_no) for name, line_no in loads.items() if name not in bound), key=lambda item: item[1])
+
+def preflight_check(code, script_path=None, interpreter=None, predefined_names=()):
+    # Static checks that need no execution. Returns {'syntax_error', 'missing_modules', 'advisory_modules',
+    # 'undefined_names'}. advisory_modules (missing, but only imported conditionally) and undefined_names (a static
+    # guess) don't block the run.
+    started = time.time()
+    result = {"syntax_error": None, "missing_modules": [], "advisory_modules": [], "undefined_names": []}
+    PREFLIGHT_STATS["checks"] += 1
+    try:
+        try:
+            tree = ast.parse(code, filename=script_path or "<in_memory_code>")
+            compile(tree, script_path or "<in_memory_code>", "exec") # Catches what the parser lets through (e.g. 'return' outside function)
+        except SyntaxError as se:
+            result["syntax_error"] = f"SyntaxError: {se.msg} (line {se.lineno}, offset {se.offset}): `{(se.text or '').strip()}`"
+            PREFLIGHT_STATS["syntax_errors"] += 1
+            return result
+        except ValueError as ve: # e.g. null bytes
+            result["syntax_error"] = f"ValueError: {ve}"
+            return result
+        unconditional_imports = {id(node) for node in _unconditional_import_nodes(tree.body)}
+        imported_modules, conditional_modules = [], []
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                module_names = [alias.name.split(".")[0] for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                module_names = [node.module.split(".")[0]]
+            else: continue
+            (imported_modules if id(node) in unconditional_imports else conditional_modules).extend(module_names)
+        script_dir = os.path.dirname(os.path.abspath(script_path)) if script_path else os.getcwd()
+        missing_modules = find_missing_modules(list(dict.fromkeys(imported_modules + conditional_modules)), interpreter, script_dir)
+        result["missing_modules"] = [module_name for module_name in missing_modules if module_name in imported_modules]
+        result["advisory_modules"] = [module_name for module_name in missing_modules if module_name not in imported_modules]
+        result["undefined_names"] = _undefined_names(tree, predefined_names)
+        PREFLIGHT_STATS["missing_modules"] += len(result["missing_modules"])
+        PREFLIGHT_STATS["undefined_names"] += len(result["undefined_names"])
+        return result
+    finally:
+        PREFLIGHT_STATS["seconds"] += time.time() - started
+
+def format_preflight_diagnostics(preflight):
+    diagnostics = []
+    if preflight["syntax_error"]: diagnostics.append(preflight["syntax_error"])
+    if preflight["missing_modules"]:
+        diagnostics.append(f"ModuleNotFoundError (static check): these imported modules are not installed and could not be installed: {', '.join(preflight['missing_modules'])}")
+    return "\n".join(diagnostics)
+
+def distribution_for_import(module_name):
+    # pip distribution providing an import; dotted names are looked up most-specific first ('google.generativeai').
+    parts = module_name.split(".")
+    for prefix_length in range(len(parts), 0, -1):
+        distribution = IMPORT_TO_DISTRIBUTION.get(".".join(parts[:prefix_length]))
+        if distribution: return distribution
+    return parts[0]
+
+def _wheelhouse_has(distribution):
+    normalized = re.sub(r"[-_.]+", "_", distribution).lower()
+    try:
+        return any(re.sub(r"[-_.]+", "_", wheel_name.split("-")[0]).lower() == normalized for wheel_name in os.listdir(DEPENDENCY_WHEELHOUSE_DIR))
+    except OSError:
+        return False
+
+def pip_install_batch(distributions, interpreter=None):
+    # One install for all distributions: from the wheelhouse without network when it has them all, otherwise
+    # 'pip wheel' into the wheelhouse (so the next install is offline) and install from there; plain 'pip install'
+    # as the last resort (e.g. sdists that don't build as wheels). Returns (ok, pip output of the last step).
+    interpreter = interpreter or sys.executable
+    os.makedirs(DEPENDENCY_WHEELHOUSE_DIR, exist_ok=True)
+    started = time.time()
+    offline_install = ["install", "--no-index", "--find-links", DEPENDENCY_WHEELHOUSE_DIR, *distributions]
+    attempts = ([("wheelhouse", [offline_install])] if all(_wheelhouse_has(d) for d in distributions) else []) + [
+        ("index -> wheelhouse", [["wheel", "--wheel-dir", DEPENDENCY_WHEELHOUSE_DIR, *distributions], offline_install]),
+        ("index", [["install", *distributions]]),
+    ]
+    ok, pip_output, source = False, "", "failed"
+    try:
+        for source_name, pip_commands in attempts:
+            for pip_args in pip_commands:
+                remaining_seconds = DEPENDENCY_INSTALL_TIMEOUT_SECONDS - (time.time() - started)
+                if remaining_seconds <= 0: raise subprocess.TimeoutExpired(pip_args, DEPENDENCY_INSTALL_TIMEOUT_SECONDS)
+                pip_process = subprocess.run([interpreter, "-m", "pip", *pip_args], capture_output=True, text=True, timeout=remaining_seconds)
+                ok, pip_output = pip_process.returncode == 0, f"{pip_process.stdout[-2000:]}\n{pip_process.stderr[-2000:]}"
+                if not ok: break
+            if ok:
+                source = source_name; break
+    except subprocess.TimeoutExpired:
+        ok, pip_output = False, f"Timed out after {DEPENDENCY_INSTALL_TIMEOUT_SECONDS}s."
+    except OSError as e_pip:
+        ok, pip_output = False, str(e_pip)
+    DEPENDENCY_INSTALL_LOG.append({"distributions": list(distributions), "source": source, "seconds": time.time() - started, "ok": ok, "time": time.time()})
+    return ok, pip_output
+
+def install_missing_modules(module_names, interpreter=None):
+    # One confirmation and one batched install for all missing modules. Returns the modules importable afterwards.
+    global _ENVIRONMENT_FINGERPRINT
+    distributions = list(dict.fromkeys(distribution_for_import(module_name) for module_name in module_names))
+    listing = ", ".join(module_name if distribution_for_import(module_name) == module_name else f"{module_name} ({distribution_for_import(module_name)})" for module_name in module_names)
+    install_confirm = input(f"{WARNING_COLOR}Missing module(s): {listing}. Install {'them' if len(distributions) > 1 else 'it'} using pip? (y/N): {RESET_COLOR}").strip().lower()
+    if install_confirm != "y":
+        print(f"{POOP_MSG_COLOR}POOP: Installation skipped by user.{RESET_COLOR}")
+        return []
+    print(f"{POOP_MSG_COLOR}POOP: Installing {' '.join(distributions)}...{RESET_COLOR}")
+    ok, pip_output = pip_install_batch(distributions, interpreter)
+    _ENVIRONMENT_FINGERPRINT = None
+    install_record = DEPENDENCY_INSTALL_LOG[-1]
+    if not ok:
+        print(f"{ERROR_COLOR}!POOP: pip install failed after {install_record['seconds']:.1f}s. Pip output:\n{pip_output.strip()}{RESET_COLOR}")
+    importlib.invalidate_caches()
+    still_missing = find_missing_modules(module_names, interpreter)
+    installed = [module_name for module_name in module_names if module_name not in still_missing]
+    if installed: print(f"{SUCCESS_COLOR}POOP: Installed {', '.join(installed)} in {install_record['seconds']:.1f}s (from {install_record['source']}).{RESET_COLOR}")
+    return installed
+
+def print_dependency_status():
+    print(f"\n{POOP_MSG_COLOR}--- Dependencies ---{RESET_COLOR}")
+    try:
+        wheel_files = [name for name in os.listdir(DEPENDENCY_WHEELHOUSE_DIR) if name.endswith(".whl")]
+        wheelhouse_mb = sum(os.path.getsize(os.path.join(DEPENDENCY_WHEELHOUSE_DIR, name)) for name in wheel_files) / 1e6
+    except OSError:
+        wheel_files, wheelhouse_mb = [], 0.0
+    print(f"{BRIGHT_WHITE_COLOR}Wheelhouse:{RESET_COLOR} {DEPENDENCY_WHEELHOUSE_DIR} ({len(wheel_files)} wheels, {wheelhouse_mb:.1f} MB)  {BRIGHT_WHITE_COLOR}Import mappings:{RESET_COLOR} {len(IMPORT_TO_DISTRIBUTION)}")
+    if not DEPENDENCY_INSTALL_LOG:
+        print(f"{BRIGHT_WHITE_COLOR}No installs this session.{RESET_COLOR}")
+    for record in DEPENDENCY_INSTALL_LOG:
+        status_color = SUCCESS_COLOR if record["ok"] else ERROR_COLOR
+        print(f"  {time.strftime('%H:%M:%S', time.localtime(record['time']))} {status_color}{'ok' if record['ok'] else 'failed'}{RESET_COLOR} {record['seconds']:.1f}s via {record['source']}: {' '.join(record['distributions'])}")
+    print(f"{POOP_MSG_COLOR}--------------------{RESET_COLOR}")
+
+_PLAN_REQUIREMENT_RES = [
+    re.compile(r"\b(?:librar(?:y|ies)|packages?|modules?)\s*[:(]?\s*((?:['\"`][\w.\-]+['\"`][\s,/&]*(?:and\s+|or\s+)?)+)", re.IGNORECASE),
+    re.compile(r"\bpip3?[ \t]+install[ \t]+((?:[\w.\-\[\]]+[ \t]*)+)", re.IGNORECASE),
+    # Code-looking lines only ("from X import ...", "import X [as y][, ...]"), not prose like "from the CSV file"
+    re.compile(r"^[ \t]*(?:from[ \t]+([\w.]+)[ \t]+import[ \t]+[\w*(]|import[ \t]+([\w.]+)(?:[ \t]+as[ \t]+\w+)?[ \t]*(?:,|$))", re.MULTILINE),
+]
+
+def plan_requirements(steps):
+    # Sorted pip distributions a plan names in its steps ("library 'numpy'", "pip install x", import lines); stdlib excluded.
+    stdlib_names = getattr(sys, "stdlib_module_names", set(sys.builtin_module_names))
+    requirements = set()
+    for step in steps or []:
+        step_text = "\n".join(str(step.get(field) or "") for field in ("task", "details", "dependencies"))
+        for requirement_re in _PLAN_REQUIREMENT_RES:
+            for match in requirement_re.finditer(step_text):
+                for name in re.findall(r"[A-Za-z_][\w.\-]*", match.group(match.lastindex)):
+                    if name.lower() in ("and", "or", "install", "python") or name.split(".")[0] in stdlib_names: continue
+                    requirements.add(distribution_for_import(name) if "-" not in name else name)
+    return sorted(requirements, key=str.lower)
+
+def _venv_python(venv_dir):
+    return os.path.join(venv_dir, "Scripts", "python.exe") if os.name == "nt" else os.path.join(venv_dir, "bin", "python")
+
+def _read_venv_meta(venv_dir):
+    try:
+        with open(os.path.join(venv_dir, "poop_venv.json"), encoding="utf-8") as meta_file: return json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+
+def _write_venv_meta(venv_dir, meta):
+    with open(os.path.join(venv_dir, "poop_venv.json"), "w", encoding="utf-8") as meta_file: json.dump(meta, meta_file, indent=1)
+
+def plan_venv_key(requirements):
+    key_source = json.dumps([sorted(requirements, key=str.lower), sys.executable, list(sys.version_info[:2])])
+    return hashlib.sha256(key_source.encode("utf-8")).hexdigest()[:16]
+
+def _plan_venv_site_packages(venv_dir):
+    if os.name == "nt": return os.path.join(venv_dir, "Lib", "site-packages")
+    return os.path.join(venv_dir, "lib", f"python{sys.version_info[0]}.{sys.version_info[1]}", "site-packages")
+
+def _create_plan_venv(venv_dir):
+    # Returns 'inherited' or 'own' (where the env's pip comes from). Raises on failure.
+    symlinks = os.name != "nt"
+    venv.EnvBuilder(system_site_packages=True, with_pip=False, symlinks=symlinks).create(venv_dir)
+    if sys.prefix != sys.base_prefix: # POOP runs in a venv; the new env's home is the base interpreter, not POOP's venv
+        parent_site_dirs = [site_dir for site_dir in site.getsitepackages() if os.path.isdir(site_dir)]
+        with open(os.path.join(_plan_venv_site_packages(venv_dir), "poop_parent_site.pth"), "w", encoding="utf-8") as pth_file:
+            pth_file.write("".join(site_dir + "\n" for site_dir in parent_site_dirs))
+    pip_check = subprocess.run([_venv_python(venv_dir), "-m", "pip", "--version"], capture_output=True, timeout=60)
+    if pip_check.returncode == 0: return "inherited"
+    venv.EnvBuilder(system_site_packages=True, with_pip=True, symlinks=symlinks).create(venv_dir) # No pip visible: ensurepip
+    return "own"
+
+def get_plan_venv(requirements):
+    # Interpreter of the venv for this requirement set: reused when it exists, created otherwise. None on failure.
+    venv_dir = os.path.join(PLAN_VENV_DIR, plan_venv_key(requirements))
+    venv_python = _venv_python(venv_dir)
+    meta = _read_venv_meta(venv_dir)
+    if meta and os.path.exists(venv_python):
+        PLAN_VENV_STATS["reused"] += 1
+    else:
+        started = time.time()
+        try:
+            shutil.rmtree(venv_dir, ignore_errors=True) # Half-created env from an interrupted run
+            pip_source = _create_plan_venv(venv_dir)
+        except Exception as e_venv:
+            print(f"{ERROR_COLOR}!POOP: Could not create a venv for this plan ({e_venv}); using {sys.executable}.{RESET_COLOR}")
+            shutil.rmtree(venv_dir, ignore_errors=True) # Without meta it would be retried anyway; don't leave it half-built
+            return None
+        meta = {"requirements": list(requirements), "base": sys.executable, "pip": pip_source, "created": time.time(), "creation_seconds": time.time() - started, "uses": 0}
+        PLAN_VENV_STATS["created"] += 1; PLAN_VENV_STATS["creation_seconds"] += meta["creation_seconds"]
+    meta["uses"] = meta.get("uses", 0) + 1; meta["last_used"] = time.time()
+    _write_venv_meta(venv_dir, meta)
+    gc_plan_venvs(keep=venv_dir)
+    return venv_python
+
+def list_plan_venvs():
+    # [(venv_dir, meta)] most recently used first.
+    try: venv_names = os.listdir(PLAN_VENV_DIR)
+    except OSError: return []
+    venvs = [(os.path.join(PLAN_VENV_DIR, name), _read_venv_meta(os.path.join(PLAN_VENV_DIR, name)) or {}) for name in venv_names]
+    return sorted(venvs, key=lambda venv_entry: venv_entry[1].get("last_used", 0), reverse=True)
+
+def gc_plan_venvs(keep=None, max_count=None):
+    # Deletes least recently used venvs beyond max_count (default PLAN_VENV_MAX_COUNT) and ones unused for PLAN_VENV_MAX_AGE_DAYS.
+    # Venvs in use (the current plan's, background jobs') are kept.
+    max_count = PLAN_VENV_MAX_COUNT if max_count is None else max_count
+    with _BACKGROUND_JOBS_LOCK: interpreters_in_use = {job["interpreter"] for job in BACKGROUND_JOBS.values()} | {CURRENT_PLAN_INTERPRETER}
+    removed = []
+    for position, (venv_dir, meta) in enumerate(list_plan_venvs()):
+        if venv_dir == keep or any(interpreter and interpreter.startswith(venv_dir + os.sep) for interpreter in interpreters_in_use): continue
+        too_old = PLAN_VENV_MAX_AGE_DAYS and time.time() - meta.get("last_used", 0) > PLAN_VENV_MAX_AGE_DAYS * 86400
+        if position >= max_count or too_old:
+            shutil.rmtree(venv_dir, ignore_errors=True); removed.append(venv_dir)
+    PLAN_VENV_STATS["removed"] += len(removed)
+    return removed
+
+def activate_plan_venv(steps):
+    # Picks the venv for a just-confirmed plan and makes it the interpreter of the plan's runs.
+    global CURRENT_PLAN_INTERPRETER
+    CURRENT_PLAN_INTERPRETER = None
+    if not PLAN_VENVS_ENABLED: return
+    requirements = plan_requirements(steps)
+    reused_before = PLAN_VENV_STATS["reused"]
+    CURRENT_PLAN_INTERPRETER = get_plan_venv(requirements)
+    if CURRENT_PLAN_INTERPRETER:
+        state = "reusing" if PLAN_VENV_STATS["reused"] > reused_before else f"created in {_read_venv_meta(os.path.dirname(os.path.dirname(CURRENT_PLAN_INTERPRETER))).get('creation_seconds', 0):.2f}s"
+        print(f"{POOP_MSG_COLOR}POOP: Plan venv ({state}): {os.path.dirname(os.path.dirname(CURRENT_PLAN_INTERPRETER))} [{', '.join(requirements) or 'no extra requirements'}]{RESET_COLOR}")
+        if WARM_WORKERS_ENABLED:
+            threading.Thread(target=prestart_warm_workers, args=(CURRENT_PLAN_INTERPRETER,), daemon=True).start()
+
+def print_plan_venvs():
+    print(f"\n{POOP_MSG_COLOR}--- Plan venvs ({'on' if PLAN_VENVS_ENABLED else 'off'}, keep {PLAN_VENV_MAX_COUNT}, max age {PLAN_VENV_MAX_AGE_DAYS}d) ---{RESET_COLOR}")
+    created, reused = PLAN_VENV_STATS["created"], PLAN_VENV_STATS["reused"]
+    average_creation = PLAN_VENV_STATS["creation_seconds"] / created if created else 0.0
+    print(f"{BRIGHT_WHITE_COLOR}This session:{RESET_COLOR} {created} created (avg {average_creation:.2f}s, total {PLAN_VENV_STATS['creation_seconds']:.2f}s), "
+          f"{reused} reused ({100.0 * reused / (created + reused) if created + reused else 0:.0f}% hits), {PLAN_VENV_STATS['removed']} removed")
+    venvs = list_plan_venvs()
+    if not venvs: print(f"{BRIGHT_WHITE_COLOR}No plan venvs in {PLAN_VENV_DIR}.{RESET_COLOR}")
+    for venv_dir, meta in venvs:
+        active_marker = f" {SUCCESS_COLOR}(active){RESET_COLOR}" if CURRENT_PLAN_INTERPRETER and CURRENT_PLAN_INTERPRETER.startswith(venv_dir + os.sep) else ""
+        last_used = time.strftime('%Y-%m-%d %H:%M', time.localtime(meta['last_used'])) if meta.get("last_used") else "?"
+        print(f"  {os.path.basename(venv_dir)}{active_marker} uses={meta.get('uses', 0)} last={last_used} created in {meta.get('creation_seconds', 0):.2f}s: {' '.join(meta.get('requirements', [])) or '(none)'}")
+    print(f"{POOP_MSG_COLOR}-------------------------------------------------{RESET_COLOR}")
+
+_TRACEBACK_FRAME_RE = re.compile(r'File "([^"]+)", line (\d+)')
+_FIX_SEGMENT_RE = re.compile(r"^# >>> POOP SEGMENT (\d+|NEW)\b[^\n]*\n(.*?)^# <<< POOP SEGMENT \1[ \t]*$", re.MULTILINE | re.DOTALL)
+
+def traceback_line_numbers(error_text, script_name):
+    # Line numbers of traceback frames (outermost first) that point into the script (path or '<in_memory_code>').
+    return [int(line_no) for frame_file, line_no in _TRACEBACK_FRAME_RE.findall(error_text or "")
+            if frame_file == script_name or os.path.basename(frame_file) == os.path.basename(script_name)]
+
+def _fix_slice_ranges(code, error_text, line_numbers):
+    # Merged, sorted [(first_line, last_line, label)] (1-based, inclusive) to show for a fix.
+    line_count = len(code.splitlines())
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        error_line = line_numbers[-1]
+        return [(max(1, error_line - FIX_SLICE_SYNTAX_WINDOW_LINES), min(line_count, error_line + FIX_SLICE_SYNTAX_WINDOW_LINES), "around the syntax error")]
+
+    def node_range(node):
+        decorators = getattr(node, "decorator_list", None)
+        return (decorators[0].lineno if decorators else node.lineno), node.end_lineno
+
+    ranges = []
+    import_run = None
+    for node in tree.body: # Runs of consecutive top-level imports
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            import_run = [import_run[0] if import_run else node.lineno, node.end_lineno]
+        elif import_run:
+            ranges.append((import_run[0], import_run[1], "imports")); import_run = None
+    if import_run: ranges.append((import_run[0], import_run[1], "imports"))
+
+    for line_no in line_numbers: # Innermost top-level definition (or method) around each frame: the call-site chain
+        for node in tree.body:
+            first_line, last_line = node_range(node)
+            if not first_line <= line_no <= last_line: continue
+            if isinstance(node, ast.ClassDef):
+                for member in node.body:
+                    member_first, member_last = node_range(member)
+                    if isinstance(member, (ast.FunctionDef, ast.AsyncFunctionDef)) and member_first <= line_no <= member_last:
+                        ranges.append((member_first, member_last, f"method {node.name}.{member.name}")); break
+                else:
+                    ranges.append((first_line, last_line, f"class {node.name}"))
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                ranges.append((first_line, last_line, f"function {node.name}"))
+            else:
+                ranges.append((first_line, last_line, "module-level code"))
+            break
+
+    error_lines = [line for line in (error_text or "").splitlines() if line.strip()]
+    error_names = set(re.findall(r"'([A-Za-z_]\w*)'", error_lines[-1])) if error_lines else set()
+    for node in tree.body: # Definitions named in the error message, e.g. the class in "'Player' object has no attribute ..."
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)) and node.name in error_names:
+            ranges.append((*node_range(node), f"definition of {node.name}"))
+
+    merged = []
+    for first_line, last_line, label in sorted(ranges):
+        if merged and first_line <= merged[-1][1] + 1:
+            previous = merged[-1]
+            labels = previous[2] if label in previous[2] else f"{previous[2]}; {label}"
+            merged[-1] = (previous[0], max(previous[1], last_line), labels)
+        else:
+            merged.append((first_line, last_line, label))
+    return merged
+
+def build_fix_slice(code, error_text, script_name):
+    # Returns (segments text, ranges) for a sliced fix prompt, or (None, None) when the whole script should be sent.
+    if len(code) < FIX_SLICE_MIN_CHARS: return None, None
+    line_numbers = traceback_line_numbers(error_text, script_name)
+    if not line_numbers: return None, None
+    ranges = _fix_slice_ranges(code, error_text, line_numbers)
+    code_lines = code.splitlines()
+    segments = []
+    for segment_number, (first_line, last_line, label) in enumerate(ranges, 1):
+        segment_code = "\n".join(code_lines[first_line - 1:last_line])
+        segments.append(f"# >>> POOP SEGMENT {segment_number} (lines {first_line}-{last_line}: {label})\n{segment_code}\n# <<< POOP SEGMENT {segment_number}")
+    slice_text = "\n\n".join(segments)
+    if len(slice_text) > FIX_SLICE_MAX_FRACTION * len(code): return None, None
+    return slice_text, ranges
+
+def _code_insertion_line(code):
+    # 0-based line index where code added at the "top" of a script (a missing import, a new helper) belongs: before the
+    # first module-level import, and never above the shebang/encoding/header comments, docstring or __future__ imports.
+    code_lines = code.splitlines()
+    header_end = 0
+    while header_end < len(code_lines) and (not code_lines[header_end].strip() or code_lines[header_end].lstrip().startswith("#")):
+        header_end += 1
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return header_end
+    for index, node in enumerate(tree.body):
+        is_docstring = index == 0 and isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+        if not (is_docstring or (isinstance(node, ast.ImportFrom) and node.module == "__future__")): break
+        header_end = max(header_end, node.end_lineno)
+    first_import = next((node for node in tree.body if isinstance(node, ast.Import)
+                         or (isinstance(node, ast.ImportFrom) and node.module != "__future__")), None)
+    return first_import.lineno - 1 if first_import and first_import.lineno > header_end else header_end
+
+def splice_fix_segments(code, ranges, reply):
+    # Applies the changed segments of a sliced fix to the full script; None if the reply has none or the result doesn't compile.
+    replacements = {match.group(1): match.group(2) for match in _FIX_SEGMENT_RE.finditer(reply)}
+    if not replacements or any(key != "NEW" and not 1 <= int(key) <= len(ranges) for key in replacements): return None
+    code_lines = code.splitlines()
+    for key in sorted((key for key in replacements if key != "NEW"), key=int, reverse=True):
+        first_line, last_line, _ = ranges[int(key) - 1]
+        code_lines[first_line - 1:last_line] = replacements[key].splitlines()
+    if "NEW" in replacements:
+        insert_at = _code_insertion_line("\n".join(code_lines))
+        code_lines[insert_at:insert_at] = replacements["NEW"].splitlines()
+    spliced_code = "\n".join(code_lines) + ("\n" if code.endswith("\n") else "")
+    try:
+        compile(spliced_code, "<poop_fix>", "exec")
+    except (SyntaxError, ValueError):
+        return None
+    return spliced_code
+
+CODE_PATCH_FORMAT_INSTRUCTIONS = (
+    "Output ONLY edit blocks in this exact format, one per change, no explanations:\n"
+    "<<<<<<< SEARCH\n<lines copied verbatim from the script, enough to be unique>\n=======\n<the replacement lines>\n>>>>>>> REPLACE\n"
+    "Keep the original indentation. An empty SEARCH section inserts the replacement before the script's first import (e.g. a missing import). "
+    "To delete lines, leave the replacement empty."
+)
+_SEARCH_REPLACE_BLOCK_RE = re.compile(r"^<{5,9} ?SEARCH[ \t]*\n(.*?)^={5,9}[ \t]*\n(.*?)^>{5,9} ?REPLACE[ \t]*$", re.MULTILINE | re.DOTALL)
+
+def _apply_search_replace(code, search, replacement):
+    # One block: exact match, then the same lines at another indentation, then the most similar window of lines.
+    # Returns (new code, fuzzy) or (None, False) when nothing matches well enough.
+    if not search.strip(): # Insertion "at the top": below the shebang/header/docstring/__future__ block
+        code_lines = code.splitlines(keepends=True)
+        insert_at = _code_insertion_line(code)
+        if insert_at and not code_lines[insert_at - 1].endswith("\n"): code_lines[insert_at - 1] += "\n"
+        code_lines[insert_at:insert_at] = [replacement + ("" if replacement.endswith("\n") or not replacement else "\n")]
+        return "".join(code_lines), False
+    # Exact text, anchored to line boundaries (SEARCH 'x = 1' must not hit 'max_x = 1'), and only when it's unique
+    exact_matches = list(re.finditer(r"(?m)^" + re.escape(search) + ("" if search.endswith("\n") else r"(?=\r?\n|\Z)"), code))
+    if len(exact_matches) == 1:
+        return code[:exact_matches[0].start()] + replacement + code[exact_matches[0].end():], False
+    code_lines = code.splitlines(keepends=True)
+    search_lines = search.rstrip("\n").splitlines()
+    window_size = len(search_lines)
+    stripped_search = [line.strip() for line in search_lines]
+    stripped_code = [line.strip() for line in code_lines]
+    match_index, fuzzy = None, False
+    for index in range(len(code_lines) - window_size + 1):
+        if stripped_code[index:index + window_size] == stripped_search:
+            match_index = index; break
+    if match_index is None:
+        search_text, best_ratio = "\n".join(stripped_search), CODE_PATCH_FUZZY_THRESHOLD
+        matcher = difflib.SequenceMatcher(autojunk=False)
+        matcher.set_seq2(search_text)
+        for index in range(len(code_lines) - window_size + 1):
+            matcher.set_seq1("\n".join(stripped_code[index:index + window_size]))
+            if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio: continue
+            ratio = matcher.ratio()
+            if ratio >= best_ratio: match_index, best_ratio = index, ratio
+        if match_index is None: return None, False
+        fuzzy = True
+
+    matched_lines = code_lines[match_index:match_index + window_size]
+    code_indent = next((re.match(r"[ \t]*", line).group(0) for line in matched_lines if line.strip()), "")
+    search_indent = next((re.match(r"[ \t]*", line).group(0) for line in search_lines if line.strip()), "")
+    replacement_lines = replacement.rstrip("\n").splitlines() if replacement.strip() else []
+    if code_indent != search_indent: # Model copied the block at another indentation; shift the replacement the same way
+        replacement_lines = [code_indent + line[len(search_indent):] if line.startswith(search_indent) else line for line in replacement_lines]
+    trailing_newline = "\n" if matched_lines and matched_lines[-1].endswith("\n") else ""
+    replacement_text = "\n".join(replacement_lines) + (trailing_newline if replacement_lines else "")
+    return "".join(code_lines[:match_index]) + replacement_text + "".join(code_lines[match_index + window_size:]), fuzzy
+
+def apply_search_replace_blocks(code, reply):
+    # Applies all SEARCH/REPLACE blocks of a reply in order; None if there are none, one doesn't apply, or the result doesn't compile.
+    blocks = _SEARCH_REPLACE_BLOCK_RE.findall(reply)
+    if not blocks: return None
+    edited_code = code
+    for search, replacement in blocks:
+        edited_code, fuzzy = _apply_search_replace(edited_code, search, replacement)
+        if edited_code is None: return None
+        CODE_PATCH_STATS["fuzzy_blocks"] += fuzzy
+    try:
+        compile(edited_code, "<poop_patch>", "exec")
+    except (SyntaxError, ValueError):
+        return None
+    CODE_PATCH_STATS["blocks"] += len(blocks)
+    return edited_code
+
+def request_llm_fix(code, instruction, error_output, previous_task_context, system_info, plan_context, script_name):
+    # gmc fix for a failed run. Long scripts whose traceback points into them get a sliced prompt; larger scripts get
+    # SEARCH/REPLACE edits instead of a regenerated script. If the edit doesn't produce a compilable script, the
+    # whole fixed script is requested as before.
+    global LAST_LLM_FIX_SECONDS
+    fix_started = time.time()
+    try:
+        return _request_llm_fix(code, instruction, error_output, previous_task_context, system_info, plan_context, script_name)
+    finally:
+        LAST_LLM_FIX_SECONDS = time.time() - fix_started
+
+def _request_llm_fix(code, instruction, error_output, previous_task_context, system_info, plan_context, script_name):
+    slice_text, slice_ranges = build_fix_slice(code, error_output, script_name)
+    patch_mode = CODE_EDIT_MODE == "patch" and len(code) >= CODE_PATCH_MIN_CHARS
+    if slice_text or patch_mode:
+        if slice_text:
+            FIX_SLICE_STATS["sliced"] += 1
+            print(f"{POOP_MSG_COLOR}POOP: Sending {len(slice_ranges)} relevant segment(s) ({len(slice_text)} of {len(code)} chars) for the fix...{RESET_COLOR}")
+        reply = gmc(code, instruction, error_output, previous_task_context, system_info, plan_context, fix_slice=slice_text, patch_mode=patch_mode)
+        if reply.startswith("#LLM_ERR"): return reply
+        edited_code = apply_search_replace_blocks(code, reply) if patch_mode else splice_fix_segments(code, slice_ranges, reply)
+        if edited_code is not None:
+            if slice_text:
+                FIX_SLICE_STATS["spliced"] += 1
+                FIX_SLICE_STATS["chars_saved"] += len(code) - len(slice_text)
+            if patch_mode:
+                CODE_PATCH_STATS["applied"] += 1
+                CODE_PATCH_STATS["output_chars"] += len(reply); CODE_PATCH_STATS["script_chars"] += len(edited_code)
+            return edited_code
+        if slice_text: FIX_SLICE_STATS["fallbacks"] += 1
+        if patch_mode: CODE_PATCH_STATS["fallbacks"] += 1
+        print(f"{WARNING_COLOR}POOP: The {'patch' if patch_mode else 'segment fix'} couldn't be applied to the script; asking for the whole fixed script.{RESET_COLOR}")
+    return gmc(code, instruction, error_output, previous_task_context, system_info, plan_context)
+
+def execute_code(code_buffer_to_exec, last_instruction_for_fix_context, previous_task_context_for_fix, file_path=None, auto_run_source="", allow_llm_fix=True, interpreter=None, incremental=False):
+    # interpreter: Python for file-mode runs (e.g. the plan's venv); in-memory code always runs inside POOP.
+    # incremental: run file-mode code in the plan kernel, executing only the cells that changed since its last run.
+    global LAST_SCRIPT_STDOUT_LINES, LAST_SCRIPT_STDERR_MESSAGE, LAST_SUCCESSFUL_TASK_DESCRIPTION, LAST_RUN_TELEMETRY
     LAST_SCRIPT_STDOUT_LINES = []
     LAST_SCRIPT_STDERR_MESSAGE = None
 
@@ -663,33 +4167,68 @@ def execute_code(code_buffer_to_exec, last_instruction_for_fix_context, previous
             "is_additive": current_step_fix.get("additive_code", False)
         }
 
+    if PREFLIGHT_ENABLED:
+        preflight = preflight_check(code_buffer_to_exec, file_path, interpreter if file_path else None, predefined_names=() if file_path else create_execution_scope().keys())
+        if preflight["missing_modules"]:
+            print(f"{POOP_MSG_COLOR}POOP: Pre-flight: imports not found: {', '.join(preflight['missing_modules'])}{RESET_COLOR}")
+            installed_modules = install_missing_modules(preflight["missing_modules"], interpreter if file_path else None)
+            preflight["missing_modules"] = [module_name for module_name in preflight["missing_modules"] if module_name not in installed_modules]
+        if preflight["advisory_modules"]:
+            print(f"{WARNING_COLOR}POOP: Pre-flight: conditional imports not found (not blocking the run): {', '.join(preflight['advisory_modules'])}{RESET_COLOR}")
+        if preflight["undefined_names"]:
+            print(f"{WARNING_COLOR}POOP: Pre-flight: possibly undefined names (not blocking the run): {', '.join(f'{name} (line {line_no})' for name, line_no in preflight['undefined_names'])}{RESET_COLOR}")
+        preflight_diagnostics = format_preflight_diagnostics(preflight)
+        if preflight_diagnostics:
+            PREFLIGHT_STATS["blocked"] += 1
+            error_output_for_llm = f"POOP PRE-FLIGHT CHECK FAILED (the script was not run):\n{preflight_diagnostics}"
+            LAST_SCRIPT_STDERR_MESSAGE = error_output_for_llm
+            print(f"{ERROR_COLOR}!POOP: Pre-flight check failed, not running the script:\n{preflight_diagnostics}{RESET_COLOR}")
+            if allow_llm_fix: # All problems in one fix call instead of one crash at a time
+                print(f"{POOP_MSG_COLOR}Attempting to fix with LLM...{RESET_COLOR}")
+                fixed_code = request_llm_fix(code_buffer_to_exec, last_instruction_for_fix_context, error_output_for_llm, previous_task_context_for_fix, current_system_info_for_fix, plan_context_for_fix_gmc, file_path or "<in_memory_code>")
+                if fixed_code.startswith("#LLM_ERR"): print(f"{ERROR_COLOR}{fixed_code}{RESET_COLOR}")
+                elif fixed_code == code_buffer_to_exec: print(f"{WARNING_COLOR}LLM: No change proposed.{RESET_COLOR}")
+                else: print(f"{SUCCESS_COLOR}LLM: Proposed a fix.{RESET_COLOR}"); code_buffer_to_exec = fixed_code; fixed_this_run = True
+            return code_buffer_to_exec, fixed_this_run, False, [], error_output_for_llm
+
 
     if file_path:
         try:
-            with open(file_path, "w", encoding='utf-8') as f: f.write(code_buffer_to_exec)
-            child_env = os.environ.copy(); child_env["PYTHONUNBUFFERED"] = "1"
-            process = subprocess.Popen(
-                [sys.executable, file_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                text=True, bufsize=1, encoding='utf-8', errors='replace', env=child_env
-            )
-            stderr_capture_list = []
+            write_code_file(file_path, code_buffer_to_exec)
+            run_started = time.time()
+            process = (incremental and plan_kernel_run(code_buffer_to_exec, file_path, interpreter)) or launch_python_script(file_path, interpreter)
+            spill_path = os.path.join(SCRIPT_OUTPUT_SPILL_DIR, f"{os.path.basename(file_path)}.{int(time.time() * 1000)}.log")
+            output_capture = BoundedLineCapture(SCRIPT_OUTPUT_MAX_LINES_IN_MEMORY, spill_path)
             print(f"{CODE_OUTPUT_HEADER_COLOR}--- Live Python Output Start (File: {os.path.basename(file_path)}) ---{RESET_COLOR}", flush=True)
-            if process.stdout:
-                for line in iter(process.stdout.readline, ""):
-                    sys.stdout.write(line); sys.stdout.flush(); stdout_lines_capture.append(line.strip())
-                process.stdout.close()
-            if process.stderr:
-                for line in iter(process.stderr.readline, ""):
-                    sys.stderr.write(line); sys.stderr.flush(); stderr_capture_list.append(line.strip())
-                process.stderr.close()
-            process.wait(); return_code = process.returncode
+            try:
+                wall_limit_hit = drain_process_output(process, output_capture, deadline=run_started + RUN_LIMITS["wall_seconds"] if RUN_LIMITS.get("wall_seconds") else None)
+            finally:
+                output_capture.close()
+            return_code, run_rusage = wait_with_rusage(process)
             print(f"\n{CODE_OUTPUT_HEADER_COLOR}--- Live Python Output End ---{RESET_COLOR}", flush=True)
+            LAST_RUN_TELEMETRY = build_run_telemetry(return_code, run_rusage, time.time() - run_started, wall_limit_hit, output_capture.lines("stderr"))
+            LAST_RUN_TELEMETRY["file"] = os.path.basename(file_path)
+            RUN_TELEMETRY_HISTORY.append(LAST_RUN_TELEMETRY)
+            print(f"{POOP_MSG_COLOR}Run stats: {format_run_telemetry(LAST_RUN_TELEMETRY)}{RESET_COLOR}")
+            if LAST_RUN_TELEMETRY["limit_hit"]:
+                print(f"{ERROR_COLOR}!POOP: Script stopped by the {LAST_RUN_TELEMETRY['limit_hit']} (see 'limits').{RESET_COLOR}")
+            if output_capture.spilled_count:
+                print(f"{POOP_MSG_COLOR}({output_capture.spilled_count} earlier output lines spilled to '{output_capture.spill_path}'){RESET_COLOR}")
+            set_last_output_capture(output_capture)
+            stdout_lines_capture = output_capture.lines("stdout")
+            stderr_capture_list = output_capture.lines("stderr")
 
             LAST_SCRIPT_STDOUT_LINES = stdout_lines_capture[:]
 
             if return_code != 0:
                 raw_error_output = "\n".join(stderr_capture_list)
                 error_output_for_llm = raw_error_output
+                if LAST_RUN_TELEMETRY["limit_hit"]:
+                    error_output_for_llm += (
+                        f"\n\nPOOP RESOURCE LIMIT HIT: the script was stopped by the {LAST_RUN_TELEMETRY['limit_hit']} "
+                        f"({format_run_telemetry(LAST_RUN_TELEMETRY)}). Make it finish within the limit, e.g. by processing less data, "
+                        "streaming/chunking instead of loading everything, vectorising hot loops or adding an explicit stop condition."
+                    )
                 LAST_SCRIPT_STDERR_MESSAGE = error_output_for_llm
                 print(f"{ERROR_COLOR}!Python process error (code {return_code}).{RESET_COLOR}")
 
@@ -697,39 +4236,21 @@ def execute_code(code_buffer_to_exec, last_instruction_for_fix_context, previous
                 if module_not_found_match:
                     missing_module = module_not_found_match.group(1)
                     print(f"{POOP_MSG_COLOR}POOP: Detected missing module: '{missing_module}'{RESET_COLOR}")
-                    install_confirm = input(f"{WARNING_COLOR}Attempt to install '{missing_module}' using pip? (y/N): {RESET_COLOR}").strip().lower()
-                    if install_confirm == 'y':
-                        print(f"{POOP_MSG_COLOR}POOP: Attempting 'pip install {missing_module}'...{RESET_COLOR}")
-                        try:
-                            pip_process = subprocess.run(
-                                [sys.executable, "-m", "pip", "install", missing_module],
-                                capture_output=True, text=True, check=False, timeout=120
-                            )
-                            if pip_process.returncode == 0:
-                                print(f"{SUCCESS_COLOR}POOP: Successfully installed '{missing_module}'.{RESET_COLOR}")
-                                # Signal that module was installed, script should be re-run
-                                error_output_for_llm = f"{MODULE_INSTALL_SIGNAL}{missing_module}" # This special string is now the "error"
-                                LAST_SCRIPT_STDERR_MESSAGE = f"Module '{missing_module}' was installed. Retry execution."
-                                fixed_this_run = True # Indicates a change that requires re-evaluation
-                            else:
-                                pip_fail_msg = f"!POOP: Failed to install '{missing_module}'. Pip output:\n{pip_process.stdout}\n{pip_process.stderr}"
-                                print(f"{ERROR_COLOR}{pip_fail_msg}{RESET_COLOR}")
-                                LAST_SCRIPT_STDERR_MESSAGE = pip_fail_msg # Store pip's error
-                        except subprocess.TimeoutExpired:
-                            timeout_msg = f"!POOP: 'pip install {missing_module}' timed out."
-                            print(f"{ERROR_COLOR}{timeout_msg}{RESET_COLOR}")
-                            LAST_SCRIPT_STDERR_MESSAGE = timeout_msg
-                        except Exception as e_pip:
-                            pip_exc_msg = f"!POOP: Error during pip install attempt: {e_pip}"
-                            print(f"{ERROR_COLOR}{pip_exc_msg}{RESET_COLOR}")
-                            LAST_SCRIPT_STDERR_MESSAGE = pip_exc_msg
-                    else:
-                        print(f"{POOP_MSG_COLOR}POOP: Installation of '{missing_module}' skipped by user.{RESET_COLOR}")
+                    # Resolve everything else the script imports that is missing too, so one install covers the whole script
+                    missing_modules = [missing_module] + [module_name for module_name in preflight_check(code_buffer_to_exec, file_path, interpreter if file_path else None)["missing_modules"] if module_name != missing_module.split(".")[0]]
+                    installed_modules = install_missing_modules(missing_modules, interpreter if file_path else None)
+                    if missing_module in installed_modules:
+                        # Signal that modules were installed, script should be re-run
+                        error_output_for_llm = f"{MODULE_INSTALL_SIGNAL}{','.join(installed_modules)}" # This special string is now the "error"
+                        LAST_SCRIPT_STDERR_MESSAGE = f"Module(s) {', '.join(installed_modules)} installed. Retry execution."
+                        fixed_this_run = True # Indicates a change that requires re-evaluation
+                    elif DEPENDENCY_INSTALL_LOG and DEPENDENCY_INSTALL_LOG[-1]["distributions"] and not DEPENDENCY_INSTALL_LOG[-1]["ok"]:
+                        LAST_SCRIPT_STDERR_MESSAGE = f"!POOP: Failed to install {', '.join(DEPENDENCY_INSTALL_LOG[-1]['distributions'])} (see 'deps')."
                 
                 # If not fixed by pip install (or pip install wasn't attempted/failed, and error_output_for_llm is not the special signal)
-                if not (error_output_for_llm and error_output_for_llm.startswith(MODULE_INSTALL_SIGNAL)):
+                if allow_llm_fix and not (error_output_for_llm and error_output_for_llm.startswith(MODULE_INSTALL_SIGNAL)):
                     print(f"{POOP_MSG_COLOR}Attempting to fix with LLM...{RESET_COLOR}")
-                    fixed_code = gmc(code_buffer_to_exec, last_instruction_for_fix_context, error_output_for_llm, previous_task_context_for_fix, current_system_info_for_fix, plan_context_for_fix_gmc)
+                    fixed_code = request_llm_fix(code_buffer_to_exec, last_instruction_for_fix_context, error_output_for_llm, previous_task_context_for_fix, current_system_info_for_fix, plan_context_for_fix_gmc, file_path or "<in_memory_code>")
                     if fixed_code.startswith("#LLM_ERR"): print(f"{ERROR_COLOR}{fixed_code}{RESET_COLOR}")
                     elif fixed_code == code_buffer_to_exec: print(f"{WARNING_COLOR}LLM: No change proposed (error might persist).{RESET_COLOR}")
                     else:
@@ -744,24 +4265,21 @@ def execute_code(code_buffer_to_exec, last_instruction_for_fix_context, previous
                     summary_for_desc = output_summary[:150] + "..." if len(output_summary) > 150 else output_summary
                     LAST_SUCCESSFUL_TASK_DESCRIPTION += f"\nScript Output Summary: {summary_for_desc}"
 
-        except FileNotFoundError: # E.g. sys.executable not found
-            error_output_for_llm = f"Interpreter {sys.executable} not found."
+        except FileNotFoundError: # E.g. the interpreter (or the plan's venv) was deleted
+            error_output_for_llm = f"Interpreter {interpreter or sys.executable} not found."
             print(f"{ERROR_COLOR}!ERROR: {error_output_for_llm}{RESET_COLOR}")
             LAST_SCRIPT_STDERR_MESSAGE = error_output_for_llm
         except Exception as e: # Other exceptions during process setup or file writing
             error_output_for_llm = f"File execution setup error: {e}\n{traceback.format_exc()}"
-            print(f"{ERROR_COLOR}!FILE EXECUTION ERROR: {e}. Attempting to fix...{RESET_COLOR}")
+            print(f"{ERROR_COLOR}!FILE EXECUTION ERROR: {e}{'. Attempting to fix...' if allow_llm_fix else '.'}{RESET_COLOR}")
             LAST_SCRIPT_STDERR_MESSAGE = error_output_for_llm
-            fixed_code = gmc(code_buffer_to_exec, last_instruction_for_fix_context, error_output_for_llm, previous_task_context_for_fix, current_system_info_for_fix, plan_context_for_fix_gmc)
-            if fixed_code.startswith("#LLM_ERR"): print(f"{ERROR_COLOR}{fixed_code}{RESET_COLOR}")
-            elif fixed_code == code_buffer_to_exec: print(f"{WARNING_COLOR}LLM: No change proposed.{RESET_COLOR}")
-            else: print(f"{SUCCESS_COLOR}LLM: Proposed a fix.{RESET_COLOR}"); code_buffer_to_exec = fixed_code; fixed_this_run = True
+            if allow_llm_fix:
+                fixed_code = request_llm_fix(code_buffer_to_exec, last_instruction_for_fix_context, error_output_for_llm, previous_task_context_for_fix, current_system_info_for_fix, plan_context_for_fix_gmc, file_path or "<in_memory_code>")
+                if fixed_code.startswith("#LLM_ERR"): print(f"{ERROR_COLOR}{fixed_code}{RESET_COLOR}")
+                elif fixed_code == code_buffer_to_exec: print(f"{WARNING_COLOR}LLM: No change proposed.{RESET_COLOR}")
+                else: print(f"{SUCCESS_COLOR}LLM: Proposed a fix.{RESET_COLOR}"); code_buffer_to_exec = fixed_code; fixed_this_run = True
     else: # In-Memory Execution
-        original_stdout = sys.stdout
-        from io import StringIO
-        captured_output_io = StringIO()
-        sys.stdout = captured_output_io # Redirect stdout
-        
+        original_stdout, original_stderr = sys.stdout, sys.stderr
         execution_scope, compiled_object, compile_error_msg = create_execution_scope(), None, None
         try:
             compiled_object = compile(code_buffer_to_exec, '<in_memory_code>', 'exec')
@@ -769,32 +4287,49 @@ def execute_code(code_buffer_to_exec, last_instruction_for_fix_context, previous
             compile_error_msg = f"SYNTAX ERROR: Line {se.lineno}, Offset {se.offset}: {se.msg}\nRelevant Code: `{(se.text or '').strip()}`\n{traceback.format_exc(limit=0)}"
         
         if compile_error_msg:
-            sys.stdout = original_stdout # Restore stdout
             error_output_for_llm = compile_error_msg
             LAST_SCRIPT_STDERR_MESSAGE = error_output_for_llm
-            print(f"{ERROR_COLOR}IN-MEMORY COMPILE ERROR: {compile_error_msg.splitlines()[0]}. Attempting to fix...{RESET_COLOR}")
-            fixed_code = gmc(code_buffer_to_exec, last_instruction_for_fix_context, error_output_for_llm, previous_task_context_for_fix, current_system_info_for_fix, plan_context_for_fix_gmc)
-            if fixed_code.startswith("#LLM_ERR"): print(f"{ERROR_COLOR}{fixed_code}{RESET_COLOR}")
-            elif fixed_code == code_buffer_to_exec: print(f"{WARNING_COLOR}LLM: No change proposed.{RESET_COLOR}")
-            else: print(f"{SUCCESS_COLOR}LLM: Proposed a fix.{RESET_COLOR}"); code_buffer_to_exec = fixed_code; fixed_this_run = True
+            print(f"{ERROR_COLOR}IN-MEMORY COMPILE ERROR: {compile_error_msg.splitlines()[0]}{'. Attempting to fix...' if allow_llm_fix else '.'}{RESET_COLOR}")
+            if allow_llm_fix:
+                fixed_code = request_llm_fix(code_buffer_to_exec, last_instruction_for_fix_context, error_output_for_llm, previous_task_context_for_fix, current_system_info_for_fix, plan_context_for_fix_gmc, file_path or "<in_memory_code>")
+                if fixed_code.startswith("#LLM_ERR"): print(f"{ERROR_COLOR}{fixed_code}{RESET_COLOR}")
+                elif fixed_code == code_buffer_to_exec: print(f"{WARNING_COLOR}LLM: No change proposed.{RESET_COLOR}")
+                else: print(f"{SUCCESS_COLOR}LLM: Proposed a fix.{RESET_COLOR}"); code_buffer_to_exec = fixed_code; fixed_this_run = True
         elif compiled_object:
             execution_scope['__name__'] = '__main__' # Some scripts check this
             print_to_original_stdout = lambda *args, **kwargs: print(*args, file=original_stdout, **kwargs) # Helper
+            handoff_lib_dir = ensure_image_handoff_module() # poop_handoff works in-process too
+            if handoff_lib_dir and handoff_lib_dir not in sys.path: sys.path.append(handoff_lib_dir)
+            os.environ["POOP_IMAGE_HANDOFF"] = "shm" if IMAGE_HANDOFF_ENABLED and shared_memory is not None else "file"
+            output_capture = BoundedLineCapture(SCRIPT_OUTPUT_MAX_LINES_IN_MEMORY, os.path.join(SCRIPT_OUTPUT_SPILL_DIR, f"in_memory.{int(time.time() * 1000)}.log"))
+            stdout_tee, stderr_tee = TeeLineWriter(original_stdout, output_capture, "stdout"), TeeLineWriter(original_stderr, output_capture, "stderr")
             
             print_to_original_stdout(f"{CODE_OUTPUT_HEADER_COLOR}--- Live Python Output Start (In-Memory) ---{RESET_COLOR}", flush=True)
+            run_started = time.time()
+            sys.stdout, sys.stderr = stdout_tee, stderr_tee # Streamed to the terminal as written, captured line by line
             try:
-                exec(compiled_object, execution_scope, execution_scope)
+                in_memory_run = run_in_memory_code(compiled_object, execution_scope, run_started + RUN_LIMITS["wall_seconds"] if RUN_LIMITS.get("wall_seconds") else None, original_stdout)
+            finally:
+                sys.stdout, sys.stderr = original_stdout, original_stderr
+                stdout_tee.finish(); stderr_tee.finish(); output_capture.close()
+            outcome = in_memory_run["outcome"]
+            if outcome == "ok":
                 print_to_original_stdout(f"\n{SUCCESS_COLOR}Python execution successful (In-Memory).{RESET_COLOR}"); execution_successful = True
                 LAST_SCRIPT_STDERR_MESSAGE = None
-            except SystemExit:
+            elif outcome == "exit":
                 print_to_original_stdout(f"\n{POOP_MSG_COLOR}Script called exit() (In-Memory).{RESET_COLOR}"); execution_successful = True # Considered success
                 LAST_SCRIPT_STDERR_MESSAGE = None
-            except KeyboardInterrupt:
+            elif outcome == "interrupted":
                 print_to_original_stdout(f"\n{WARNING_COLOR}Execution interrupted by user (In-Memory).{RESET_COLOR}")
                 # Not necessarily an error for LLM to fix, but not a full success
-            except Exception as e:
-                sys.stdout = original_stdout # Restore stdout before printing error details
-                tb_lines = traceback.format_exc().splitlines()
+            elif outcome == "timeout":
+                error_output_for_llm = (f"POOP RESOURCE LIMIT HIT: the in-memory code was stopped by the wall-clock limit of {RUN_LIMITS['wall_seconds']}s. "
+                                        "Make it finish within the limit, e.g. by processing less data or adding an explicit stop condition.")
+                LAST_SCRIPT_STDERR_MESSAGE = error_output_for_llm
+                print_to_original_stdout(f"{ERROR_COLOR}!POOP: In-memory code stopped by the wall-clock limit ({RUN_LIMITS['wall_seconds']}s).{RESET_COLOR}")
+            else: # outcome == "error"
+                e = in_memory_run["error"]
+                tb_lines = in_memory_run["traceback"].splitlines()
                 specific_error_line_detail = f"RUNTIME ERROR: {type(e).__name__}: {e}"
                 for tbl_line in reversed(tb_lines): # Find the line from our exec
                     if '<in_memory_code>' in tbl_line:
@@ -802,87 +4337,339 @@ def execute_code(code_buffer_to_exec, last_instruction_for_fix_context, previous
                         break
                 error_output_for_llm = f"{type(e).__name__}: {e}\nFull Traceback:\n" + "\n".join(tb_lines)
                 LAST_SCRIPT_STDERR_MESSAGE = error_output_for_llm
-                print(f"\n{ERROR_COLOR}{specific_error_line_detail}. Attempting to fix...{RESET_COLOR}")
+                print(f"\n{ERROR_COLOR}{specific_error_line_detail}{'. Attempting to fix...' if allow_llm_fix else '.'}{RESET_COLOR}")
 
-                fixed_code = gmc(code_buffer_to_exec, last_instruction_for_fix_context, error_output_for_llm, previous_task_context_for_fix, current_system_info_for_fix, plan_context_for_fix_gmc)
+            print_to_original_stdout(f"{CODE_OUTPUT_HEADER_COLOR}--- Live Python Output End (In-Memory) ---{RESET_COLOR}", flush=True)
+            if output_capture.spilled_count:
+                print_to_original_stdout(f"{POOP_MSG_COLOR}({output_capture.spilled_count} earlier output lines spilled to '{output_capture.spill_path}'){RESET_COLOR}")
+            set_last_output_capture(output_capture)
+            stdout_lines_capture.extend(output_capture.lines("stdout"))
+            LAST_SCRIPT_STDOUT_LINES = stdout_lines_capture[:]
+            if execution_successful:
+                output_summary = " ".join(stdout_lines_capture).strip()
+                if output_summary:
+                    summary_for_desc = output_summary[:150] + "..." if len(output_summary) > 150 else output_summary
+                    LAST_SUCCESSFUL_TASK_DESCRIPTION += f"\nScript Output Summary (In-Memory): {summary_for_desc}"
+            elif error_output_for_llm and allow_llm_fix:
+                fixed_code = request_llm_fix(code_buffer_to_exec, last_instruction_for_fix_context, error_output_for_llm, previous_task_context_for_fix, current_system_info_for_fix, plan_context_for_fix_gmc, file_path or "<in_memory_code>")
                 if fixed_code.startswith("#LLM_ERR"): print(f"{ERROR_COLOR}{fixed_code}{RESET_COLOR}")
                 elif fixed_code == code_buffer_to_exec: print(f"{WARNING_COLOR}LLM: No change proposed.{RESET_COLOR}")
                 else: print(f"{SUCCESS_COLOR}LLM: Proposed a fix.{RESET_COLOR}"); code_buffer_to_exec = fixed_code; fixed_this_run = True
-            finally:
-                if sys.stdout != original_stdout: # Ensure stdout is restored
-                    sys.stdout = original_stdout
-                
-                output_str_from_exec = captured_output_io.getvalue()
-                if output_str_from_exec: # Print captured output if any
-                   original_stdout.write(output_str_from_exec)
-                stdout_lines_capture.extend(output_str_from_exec.splitlines())
-                LAST_SCRIPT_STDOUT_LINES = stdout_lines_capture[:]
-                
-                print_to_original_stdout(f"{CODE_OUTPUT_HEADER_COLOR}--- Live Python Output End (In-Memory) ---{RESET_COLOR}", flush=True)
-                if execution_successful: # If exec was successful and we are in finally
-                    output_summary = " ".join(stdout_lines_capture).strip()
-                    if output_summary:
-                        summary_for_desc = output_summary[:150] + "..." if len(output_summary) > 150 else output_summary
-                        LAST_SUCCESSFUL_TASK_DESCRIPTION += f"\nScript Output Summary (In-Memory): {summary_for_desc}"
-
-        captured_output_io.close()
 
     return code_buffer_to_exec, fixed_this_run, execution_successful, stdout_lines_capture, error_output_for_llm
 
 
-def start_code_in_background(file_path_to_start):
-    global ACTIVE_SUBPROCESS, ACTIVE_SUBPROCESS_FILE
+def _error_signature(error_text):
+    # The exception line without volatile parts (numbers, addresses, paths), so the same failure hashes the same after edits.
+    error_lines = [line.strip() for line in (error_text or "").splitlines() if line.strip()]
+    exception_line = next((line for line in reversed(error_lines) if re.match(r"^[\w.]+(Error|Exception|Exit|Interrupt)\b", line)), error_lines[-1] if error_lines else "")
+    normalized = re.sub(r"0x[0-9a-fA-F]+|\d+", "#", re.sub(r"(/[^\s'\"]+)+", "<path>", exception_line))
+    return normalized[:200]
+
+def execute_with_auto_fix(code_buffer_to_exec, last_instruction_for_fix_context, previous_task_context_for_fix, file_path=None, auto_run_source="", allow_llm_fix=True, confirm_fix=None, interpreter=None, incremental=False):
+    # execute_code in a bounded fix -> re-run loop (AUTO_FIX_MAX_ATTEMPTS, AUTO_FIX_TIME_BUDGET_SECONDS). Stops early when a
+    # fix brings back a code version that already failed or the same code fails the same way twice. Once a fix has failed,
+    # further fixes skip the light model (AUTO_FIX_ESCALATE). confirm_fix(old_code, new_code) -> bool may veto re-running
+    # a fix. Same return value as execute_code; `fixed` means the returned code differs from the input.
+    global _AUTO_FIX_ESCALATED
+    original_code = code_buffer_to_exec
+    loop_started = time.time()
+    failed_states, failed_code_hashes = set(), set()
+    llm_attempts, run_number = 0, 0
+    try:
+        while True:
+            run_number += 1
+            budget_left = llm_attempts < AUTO_FIX_MAX_ATTEMPTS and time.time() - loop_started < AUTO_FIX_TIME_BUDGET_SECONDS
+            _AUTO_FIX_ESCALATED = AUTO_FIX_ESCALATE and llm_attempts > 0 # This code is an LLM fix; if it fails too, ask the primary model
+            run_started = time.time()
+            result_code, fixed_this_run, successful, stdout_lines, error_output = execute_code(
+                code_buffer_to_exec, last_instruction_for_fix_context, previous_task_context_for_fix, file_path=file_path,
+                auto_run_source=auto_run_source, allow_llm_fix=allow_llm_fix and (budget_left or AUTO_FIX_MAX_ATTEMPTS == 0), interpreter=interpreter,
+                incremental=incremental
+            )
+            installed_module = bool(error_output and error_output.startswith(MODULE_INSTALL_SIGNAL))
+            llm_fixed = fixed_this_run and not installed_module and result_code != code_buffer_to_exec
+            fix_seconds = LAST_LLM_FIX_SECONDS if llm_fixed else 0.0
+            log_entry = {
+                "attempt": run_number, "run_seconds": time.time() - run_started - fix_seconds, "fix_seconds": fix_seconds,
+                "error": None if successful else _error_signature(error_output), "escalated": llm_fixed and _AUTO_FIX_ESCALATED,
+                "file": os.path.basename(file_path) if file_path else "<in_memory_code>", "time": time.time(),
+                "outcome": "success" if successful else "installed module" if installed_module else "fix proposed" if llm_fixed else "failed",
+            }
+            AUTO_FIX_LOG.append(log_entry)
+            if successful or AUTO_FIX_MAX_ATTEMPTS == 0 or not (llm_fixed or installed_module):
+                return result_code, result_code != original_code, successful, stdout_lines, error_output
+
+            code_hash = hashlib.sha256(code_buffer_to_exec.encode("utf-8", errors="replace")).hexdigest()
+            failed_code_hashes.add(code_hash)
+            stop_reason = None
+            if (code_hash, log_entry["error"]) in failed_states:
+                stop_reason = "the same code failed the same way again"
+            elif llm_fixed and hashlib.sha256(result_code.encode("utf-8", errors="replace")).hexdigest() in failed_code_hashes:
+                stop_reason = "the fix brought back a version that already failed (oscillating)"
+                result_code = code_buffer_to_exec # Keep the latest version rather than going back
+            elif time.time() - loop_started >= AUTO_FIX_TIME_BUDGET_SECONDS:
+                stop_reason = f"time budget ({AUTO_FIX_TIME_BUDGET_SECONDS:g}s) used up"
+            elif llm_fixed and confirm_fix is not None and not confirm_fix(code_buffer_to_exec, result_code):
+                stop_reason = "re-run declined"
+            failed_states.add((code_hash, log_entry["error"]))
+            if stop_reason:
+                log_entry["outcome"] += f"; stopped: {stop_reason}"
+                print(f"{WARNING_COLOR}POOP: Auto-fix loop stopped after {run_number} run(s): {stop_reason}.{RESET_COLOR}")
+                return result_code, result_code != original_code, successful, stdout_lines, error_output
+            if llm_fixed: llm_attempts += 1
+            print(f"{POOP_MSG_COLOR}POOP: {'Re-running after the module install' if installed_module else f'Running fix attempt {llm_attempts}/{AUTO_FIX_MAX_ATTEMPTS}'} "
+                  f"({time.time() - loop_started:.0f}s of the {AUTO_FIX_TIME_BUDGET_SECONDS:g}s budget used)...{RESET_COLOR}")
+            code_buffer_to_exec = result_code
+    finally:
+        _AUTO_FIX_ESCALATED = False
+
+def print_auto_fix_log(limit=15):
+    print(f"\n{POOP_MSG_COLOR}--- Auto-Fix Loop ---{RESET_COLOR}")
+    print(f"{BRIGHT_WHITE_COLOR}Max fix attempts:{RESET_COLOR} {AUTO_FIX_MAX_ATTEMPTS}  {BRIGHT_WHITE_COLOR}Time budget:{RESET_COLOR} {AUTO_FIX_TIME_BUDGET_SECONDS:g}s  {BRIGHT_WHITE_COLOR}Escalate to primary:{RESET_COLOR} {AUTO_FIX_ESCALATE}")
+    if not AUTO_FIX_LOG:
+        print(f"{BRIGHT_WHITE_COLOR}No runs logged yet.{RESET_COLOR}")
+    for entry in list(AUTO_FIX_LOG)[-limit:]:
+        outcome_color = SUCCESS_COLOR if entry["outcome"] == "success" else WARNING_COLOR
+        error_str = f" | {entry['error']}" if entry["error"] else ""
+        print(f"  {time.strftime('%H:%M:%S', time.localtime(entry['time']))} {entry['file']} #{entry['attempt']}: {outcome_color}{entry['outcome']}{RESET_COLOR} "
+              f"(run {entry['run_seconds']:.1f}s, fix {entry['fix_seconds']:.1f}s{', primary' if entry['escalated'] else ''}){error_str}")
+    print(f"{BRIGHT_WHITE_COLOR}Pre-flight ({'on' if PREFLIGHT_ENABLED else 'off'}):{RESET_COLOR} {PREFLIGHT_STATS['checks']} checks in {PREFLIGHT_STATS['seconds']:.2f}s, {PREFLIGHT_STATS['blocked']} runs skipped "
+          f"({PREFLIGHT_STATS['syntax_errors']} syntax errors, {PREFLIGHT_STATS['missing_modules']} missing modules; {PREFLIGHT_STATS['undefined_names']} possibly undefined names reported)")
+    fixed_runs = [entry for entry in AUTO_FIX_LOG if entry["attempt"] > 1]
+    if fixed_runs:
+        print(f"{BRIGHT_WHITE_COLOR}Re-runs after a fix:{RESET_COLOR} {len(fixed_runs)}, {sum(entry['outcome'] == 'success' for entry in fixed_runs)} succeeded")
+    print(f"{POOP_MSG_COLOR}---------------------{RESET_COLOR}")
+
+def confirm_auto_fix_rerun(old_code, new_code):
+    # Review step for the 'run' command's fix loop: show the fix as a diff instead of making the user type 'run' again.
+    diff_lines = list(difflib.unified_diff(old_code.splitlines(), new_code.splitlines(), "before fix", "after fix", lineterm="", n=2))
+    print(f"{AI_RESPONSE_COLOR}--- Proposed fix ---{RESET_COLOR}")
+    for diff_line in diff_lines[:80]:
+        line_color = SUCCESS_COLOR if diff_line.startswith("+") else ERROR_COLOR if diff_line.startswith("-") else BRIGHT_WHITE_COLOR
+        print(f"{line_color}{diff_line}{RESET_COLOR}")
+    if len(diff_lines) > 80: print(f"{POOP_MSG_COLOR}... ({len(diff_lines) - 80} more diff lines){RESET_COLOR}")
+    return input(f"{WARNING_COLOR}Run the fixed code? (Y/n): {RESET_COLOR}").strip().lower() in ("", "y", "yes")
+
+def _spawn_background_job_process(job):
+    child_env = script_child_env(image_handoff=False)
+    # Output goes straight into the job's log file: nothing for POOP to drain, nothing on the prompt.
+    with open(job["log_path"], "a", encoding="utf-8") as log_file:
+        log_file.write(f"\n=== POOP: {'restart #' + str(job['restarts']) if job['restarts'] else 'start'} of '{job['file']}' at {time.strftime('%Y-%m-%d %H:%M:%S')} ===\n")
+        log_file.flush()
+        rlimits = run_limit_rlimits()
+        job["process"] = subprocess.Popen(
+            _rlimited_command(job["interpreter"], job["file"], rlimits, ("-u",)), stdout=log_file, stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL, env=child_env
+        )
+        _apply_rlimits_after_spawn(job["process"], rlimits)
+    job.update(status="running", exit_code=None, started=time.time(), last_cpu_sample=None)
+    if RUN_LIMITS.get("background_wall_seconds"):
+        wall_timer = threading.Timer(RUN_LIMITS["background_wall_seconds"], lambda p=job["process"]: p.poll() is None and _kill_run(p))
+        wall_timer.daemon = True; wall_timer.start()
+
+def _sample_job_usage(job):
+    # CPU% (since the previous sample) and RSS from /proc; None on platforms without it.
+    pid = job["process"].pid
+    try:
+        with open(f"/proc/{pid}/stat") as f_stat:
+            stat_fields = f_stat.read().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(stat_fields[11]) + int(stat_fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return
+    now = time.time()
+    cpu_percent = None
+    if job["last_cpu_sample"]:
+        previous_time, previous_cpu = job["last_cpu_sample"]
+        if now > previous_time: cpu_percent = 100.0 * (cpu_seconds - previous_cpu) / (now - previous_time)
+    job["last_cpu_sample"] = (now, cpu_seconds)
+    job["samples"].append({"time": now, "cpu_percent": cpu_percent, "rss_mb": _process_rss_mb(pid), "cpu_seconds": cpu_seconds})
+
+def _monitor_background_jobs():
+    while True:
+        time.sleep(BACKGROUND_JOB_SAMPLE_INTERVAL_SECONDS)
+        with _BACKGROUND_JOBS_LOCK:
+            for job in BACKGROUND_JOBS.values():
+                if job["status"] != "running": continue
+                exit_code = job["process"].poll()
+                if exit_code is None:
+                    _sample_job_usage(job); continue
+                job.update(status="exited", exit_code=exit_code, ended=time.time())
+                wants_restart = job["restart_policy"] == "always" or (job["restart_policy"] == "on-failure" and exit_code != 0)
+                if _BACKGROUND_JOBS_SHUTDOWN.is_set(): continue
+                if wants_restart and job["restarts"] < BACKGROUND_JOB_MAX_RESTARTS:
+                    job["restarts"] += 1
+                    job["status"] = "restarting"
+                    backoff_seconds = min(60, 2 ** (job["restarts"] - 1)) # 1, 2, 4... so a crash loop doesn't spin
+                    restart_timer = threading.Timer(backoff_seconds, _restart_background_job, args=(job,))
+                    restart_timer.daemon = True; restart_timer.start() # A pending restart must not keep POOP alive on exit
+                elif wants_restart:
+                    job["status"] = "failed" # Gave up after BACKGROUND_JOB_MAX_RESTARTS
+
+def _restart_background_job(job):
+    with _BACKGROUND_JOBS_LOCK:
+        if job["status"] != "restarting" or _BACKGROUND_JOBS_SHUTDOWN.is_set(): return # Stopped in the meantime
+        try: _spawn_background_job_process(job)
+        except Exception as e: job.update(status="failed", error=str(e))
+
+def start_code_in_background(file_path_to_start, restart_policy=None, interpreter=None):
+    global BACKGROUND_JOB_NEXT_ID, _BACKGROUND_JOB_MONITOR
     if not file_path_to_start : print(f"{WARNING_COLOR}!No Python file path provided.{RESET_COLOR}"); return
     if not os.path.exists(file_path_to_start): print(f"{ERROR_COLOR}!File to start not found: '{file_path_to_start}'{RESET_COLOR}"); return
-    if ACTIVE_SUBPROCESS and ACTIVE_SUBPROCESS.poll() is None: print(f"{WARNING_COLOR}!Process ({ACTIVE_SUBPROCESS_FILE}) already running. Use 'stop'.{RESET_COLOR}"); return
-    
+
     print(f"{POOP_MSG_COLOR}Starting '{file_path_to_start}' in background...{RESET_COLOR}")
     try:
-        child_env = os.environ.copy(); child_env["PYTHONUNBUFFERED"] = "1"
-        ACTIVE_SUBPROCESS = subprocess.Popen(
-            [sys.executable, file_path_to_start], stdout=sys.stdout, stderr=sys.stderr, # Direct output to POOP's console
-            text=True, encoding='utf-8', errors='replace', env=child_env
-        )
-        ACTIVE_SUBPROCESS_FILE = file_path_to_start
-        print(f"{SUCCESS_COLOR}'{file_path_to_start}' now running in background (PID: {ACTIVE_SUBPROCESS.pid}). Use 'stop' to terminate.{RESET_COLOR}")
-    except FileNotFoundError: print(f"{ERROR_COLOR}!ERROR: Python interpreter '{sys.executable}' not found.{RESET_COLOR}"); ACTIVE_SUBPROCESS=None
-    except Exception as e: print(f"{ERROR_COLOR}!ERROR starting process: {e}{RESET_COLOR}"); ACTIVE_SUBPROCESS=None
-
-def stop_active_subprocess():
-    global ACTIVE_SUBPROCESS, ACTIVE_SUBPROCESS_FILE
-    if ACTIVE_SUBPROCESS:
-        if ACTIVE_SUBPROCESS.poll() is None: # Process is running
-            print(f"{POOP_MSG_COLOR}Stopping background process '{ACTIVE_SUBPROCESS_FILE}' (PID: {ACTIVE_SUBPROCESS.pid})...{RESET_COLOR}");
-            ACTIVE_SUBPROCESS.terminate() # Send SIGTERM
-            try:
-                ACTIVE_SUBPROCESS.wait(timeout=5) # Wait for graceful termination
-                print(f"{SUCCESS_COLOR}Process stopped.{RESET_COLOR}")
-            except subprocess.TimeoutExpired:
-                print(f"{WARNING_COLOR}!SIGTERM timeout, sending SIGKILL to '{ACTIVE_SUBPROCESS_FILE}'...{RESET_COLOR}");
-                ACTIVE_SUBPROCESS.kill() # Force kill
-                ACTIVE_SUBPROCESS.wait() # Wait for SIGKILL to be processed
-                print(f"{SUCCESS_COLOR}Process killed.{RESET_COLOR}")
-        else:
-            print(f"{POOP_MSG_COLOR}Background process '{ACTIVE_SUBPROCESS_FILE}' was already stopped (Exit code: {ACTIVE_SUBPROCESS.poll()}).{RESET_COLOR}")
-        ACTIVE_SUBPROCESS = None; ACTIVE_SUBPROCESS_FILE = None
-    else:
-        print(f"{POOP_MSG_COLOR}No active background process to stop.{RESET_COLOR}")
-
-def get_process_status():
-    global ACTIVE_SUBPROCESS, ACTIVE_SUBPROCESS_FILE
-    if ACTIVE_SUBPROCESS:
-        poll_result = ACTIVE_SUBPROCESS.poll()
-        status = f"{SUCCESS_COLOR}running{RESET_COLOR}" if poll_result is None else f"{WARNING_COLOR}stopped (Exit Code: {poll_result}){RESET_COLOR}"
-        print(f"{POOP_MSG_COLOR}Background process '{ACTIVE_SUBPROCESS_FILE}' (PID: {ACTIVE_SUBPROCESS.pid}) is {status}.")
+        os.makedirs(BACKGROUND_JOB_LOG_DIR, exist_ok=True)
+        with _BACKGROUND_JOBS_LOCK:
+            job_id = BACKGROUND_JOB_NEXT_ID
+            job = {
+                "id": job_id, "file": file_path_to_start, "process": None, "status": "starting", "exit_code": None,
+                "restart_policy": restart_policy or BACKGROUND_JOB_DEFAULT_RESTART_POLICY, "restarts": 0,
+                "log_path": os.path.join(BACKGROUND_JOB_LOG_DIR, f"job{job_id}_{os.path.splitext(os.path.basename(file_path_to_start))[0]}.log"),
+                "samples": deque(maxlen=BACKGROUND_JOB_SAMPLES_KEPT), "last_cpu_sample": None, "started": time.time(),
+                "interpreter": interpreter or sys.executable,
+            }
+            _spawn_background_job_process(job)
+            BACKGROUND_JOBS[job_id] = job
+            BACKGROUND_JOB_NEXT_ID += 1
+            if _BACKGROUND_JOB_MONITOR is None:
+                _BACKGROUND_JOB_MONITOR = threading.Thread(target=_monitor_background_jobs, daemon=True)
+                _BACKGROUND_JOB_MONITOR.start()
+        print(f"{SUCCESS_COLOR}Job [{job_id}] '{file_path_to_start}' running in background (PID: {job['process'].pid}, restart: {job['restart_policy']}).{RESET_COLOR}")
+        print(f"{POOP_MSG_COLOR}Output: 'logs {job_id} [--follow]' (file: {job['log_path']}). Stop with 'stop {job_id}'.{RESET_COLOR}")
+    except FileNotFoundError: print(f"{ERROR_COLOR}!ERROR: Python interpreter '{interpreter or sys.executable}' not found.{RESET_COLOR}")
+    except Exception as e: print(f"{ERROR_COLOR}!ERROR starting process: {e}{RESET_COLOR}")
+
+def resolve_background_job(job_ref):
+    # 'stop'/'logs'/'status_process' accept a job id or nothing (= most recent job).
+    with _BACKGROUND_JOBS_LOCK:
+        if not BACKGROUND_JOBS: return None
+        if not job_ref: return next(reversed(BACKGROUND_JOBS.values()))
+        try: return BACKGROUND_JOBS.get(int(job_ref.lstrip("[%").rstrip("]")))
+        except ValueError: return None
+
+def stop_background_job(job):
+    with _BACKGROUND_JOBS_LOCK:
+        previous_status = job["status"]
+        job["status"] = "stopped" # Before terminating, so the monitor doesn't restart it
+    process = job["process"]
+    if process and process.poll() is None: # Process is running
+        print(f"{POOP_MSG_COLOR}Stopping job [{job['id']}] '{job['file']}' (PID: {process.pid})...{RESET_COLOR}");
+        process.terminate() # Send SIGTERM
+        try:
+            process.wait(timeout=5) # Wait for graceful termination
+            print(f"{SUCCESS_COLOR}Job [{job['id']}] stopped.{RESET_COLOR}")
+        except subprocess.TimeoutExpired:
+            print(f"{WARNING_COLOR}!SIGTERM timeout, sending SIGKILL to '{job['file']}'...{RESET_COLOR}");
+            process.kill() # Force kill
+            process.wait() # Wait for SIGKILL to be processed
+            print(f"{SUCCESS_COLOR}Job [{job['id']}] killed.{RESET_COLOR}")
+        job.update(exit_code=process.returncode, ended=time.time())
+    elif previous_status == "restarting":
+        print(f"{POOP_MSG_COLOR}Pending restart of job [{job['id']}] cancelled.{RESET_COLOR}")
     else:
-        print(f"{POOP_MSG_COLOR}No active background process information.{RESET_COLOR}")
+        job["status"] = previous_status
+        print(f"{POOP_MSG_COLOR}Job [{job['id']}] '{job['file']}' was already stopped (Exit code: {process.poll() if process else 'N/A'}).{RESET_COLOR}")
+
+def stop_active_subprocess(job_ref=""):
+    if job_ref == "all":
+        running_jobs = [j for j in list(BACKGROUND_JOBS.values()) if j["status"] in ("running", "restarting")]
+        if not running_jobs: print(f"{POOP_MSG_COLOR}No running background jobs.{RESET_COLOR}")
+        for job in running_jobs: stop_background_job(job)
+        return
+    job = resolve_background_job(job_ref)
+    if job: stop_background_job(job)
+    elif job_ref: print(f"{ERROR_COLOR}!No background job '{job_ref}'. See 'jobs'.{RESET_COLOR}")
+    else: print(f"{POOP_MSG_COLOR}No active background process to stop.{RESET_COLOR}")
+
+def _job_runtime(job):
+    return (job.get("ended") if job["status"] not in ("running", "restarting") and job.get("ended") else time.time()) - job["started"]
+
+def list_background_jobs():
+    with _BACKGROUND_JOBS_LOCK:
+        if not BACKGROUND_JOBS: print(f"{POOP_MSG_COLOR}No background jobs. Start one with 'start [path]'.{RESET_COLOR}"); return
+        print(f"\n{POOP_MSG_COLOR}--- Background Jobs ---{RESET_COLOR}")
+        for job in BACKGROUND_JOBS.values():
+            status_color = SUCCESS_COLOR if job["status"] == "running" else (WARNING_COLOR if job["status"] in ("restarting", "stopped") else ERROR_COLOR if job["status"] == "failed" or job["exit_code"] else POOP_MSG_COLOR)
+            last_sample = job["samples"][-1] if job["samples"] and job["status"] == "running" else None
+            usage = ""
+            if last_sample:
+                cpu_text = f"{last_sample['cpu_percent']:.0f}%" if last_sample["cpu_percent"] is not None else "N/A"
+                usage = f", CPU {cpu_text}, RSS {last_sample['rss_mb']:.0f} MB" if last_sample["rss_mb"] else f", CPU {cpu_text}"
+            exit_text = f" (exit {job['exit_code']})" if job["exit_code"] is not None else ""
+            print(f"  [{job['id']}] {status_color}{job['status']}{exit_text}{RESET_COLOR} {job['file']} PID {job['process'].pid if job['process'] else 'N/A'}, up {_job_runtime(job):.0f}s, restarts {job['restarts']} ({job['restart_policy']}){usage}")
+        print(f"{POOP_MSG_COLOR}-----------------------{RESET_COLOR}")
+
+def show_background_job_logs(job_ref, follow=False, tail_lines=40):
+    job = resolve_background_job(job_ref)
+    if not job: print(f"{ERROR_COLOR}!No background job '{job_ref}'. See 'jobs'.{RESET_COLOR}" if job_ref else f"{POOP_MSG_COLOR}No background jobs.{RESET_COLOR}"); return
+    try:
+        with open(job["log_path"], "r", encoding="utf-8", errors="replace") as log_file:
+            print(f"{CODE_OUTPUT_HEADER_COLOR}--- Log of job [{job['id']}] '{job['file']}' ({job['log_path']}) ---{RESET_COLOR}")
+            for log_line in deque(log_file, maxlen=tail_lines): sys.stdout.write(log_line)
+            if follow:
+                print(f"{POOP_MSG_COLOR}(following; Ctrl+C to return to the prompt){RESET_COLOR}", flush=True)
+                try:
+                    while True:
+                        log_line = log_file.readline()
+                        if log_line: sys.stdout.write(log_line); sys.stdout.flush(); continue
+                        if job["status"] not in ("running", "restarting"):
+                            print(f"{POOP_MSG_COLOR}(job [{job['id']}] is {job['status']}){RESET_COLOR}"); break
+                        time.sleep(0.2)
+                except KeyboardInterrupt:
+                    print()
+            print(f"{CODE_OUTPUT_HEADER_COLOR}--- End of log ---{RESET_COLOR}")
+    except FileNotFoundError:
+        print(f"{WARNING_COLOR}!Log file '{job['log_path']}' not found.{RESET_COLOR}")
+
+def get_process_status(job_ref=""):
+    job = resolve_background_job(job_ref)
+    if not job:
+        if job_ref: print(f"{ERROR_COLOR}!No background job '{job_ref}'. See 'jobs'.{RESET_COLOR}")
+        else: print(f"{POOP_MSG_COLOR}No active background process information.{RESET_COLOR}")
+        return
+    if job["status"] == "running" and not job["samples"]: _sample_job_usage(job) # Fresh job: take a first sample now
+    status = f"{SUCCESS_COLOR}{job['status']}{RESET_COLOR}" if job["status"] == "running" else f"{WARNING_COLOR}{job['status']} (Exit Code: {job['exit_code']}){RESET_COLOR}"
+    print(f"{POOP_MSG_COLOR}Background job [{job['id']}] '{job['file']}' (PID: {job['process'].pid}) is {status}.")
+    print(f"{POOP_MSG_COLOR}Uptime {_job_runtime(job):.0f}s, restarts {job['restarts']}/{BACKGROUND_JOB_MAX_RESTARTS} (policy: {job['restart_policy']}), log: {job['log_path']}{RESET_COLOR}")
+    cpu_samples = [sample["cpu_percent"] for sample in job["samples"] if sample["cpu_percent"] is not None]
+    rss_samples = [sample["rss_mb"] for sample in job["samples"] if sample["rss_mb"]]
+    if rss_samples:
+        print(f"{POOP_MSG_COLOR}RSS: now {rss_samples[-1]:.1f} MB, peak {max(rss_samples):.1f} MB{RESET_COLOR}")
+    if cpu_samples:
+        print(f"{POOP_MSG_COLOR}CPU: now {cpu_samples[-1]:.0f}%, avg {sum(cpu_samples) / len(cpu_samples):.0f}%, max {max(cpu_samples):.0f}% "
+              f"(total {job['samples'][-1]['cpu_seconds']:.1f}s over the last {len(job['samples'])} samples){RESET_COLOR}")
+    elif not rss_samples:
+        print(f"{POOP_MSG_COLOR}(No CPU/RSS samples yet or /proc unavailable.){RESET_COLOR}")
 
 def handle_image_analysis_signal(script_stdout_lines_list, image_path_from_plan_dependency=None):
+    global LAST_SUCCESSFUL_TASK_DESCRIPTION
     image_path_to_analyze = None
     signal_found_in_stdout = False
 
     for line in script_stdout_lines_list:
+        if line.startswith(IMAGE_SHM_SIGNAL):
+            signal_found_in_stdout = True
+            handoff_img = consume_image_handoff(line) # Normally already claimed while the output was drained
+            if handoff_img is None:
+                print(f"{WARNING_COLOR}POOP: Shared memory image from the script could not be read; looking for a path signal instead.{RESET_COLOR}")
+                continue
+            with _IMAGE_HANDOFF_LOCK: _IMAGE_HANDOFFS.pop(line[len(IMAGE_SHM_SIGNAL):].split()[0], None)
+            image_name = f"screenshot {handoff_img.width}x{handoff_img.height}"
+            print(f"\n{POOP_MSG_COLOR}POOP: Script handed over a {image_name} via shared memory. Requesting AI description...{RESET_COLOR}")
+            try:
+                description, image_info = describe_image(handoff_img, image_name, handoff_img.width * handoff_img.height * len(handoff_img.getbands()))
+            except Exception as e_img:
+                print(f"{ERROR_COLOR}POOP: Error analyzing the handed-over image: {e_img}{RESET_COLOR}")
+                return False
+            if description.startswith("#LLM_ERR"):
+                print(f"{ERROR_COLOR}POOP: AI Error during image description: {description}{RESET_COLOR}")
+                return False
+            print(f"{POOP_MSG_COLOR}POOP AI Description of the {image_name} ({format_image_desc_info(image_info)}):{RESET_COLOR}\n---\n{AI_RESPONSE_COLOR}{description}{RESET_COLOR}\n---")
+            LAST_SUCCESSFUL_TASK_DESCRIPTION += f"\nAI image description of the script's {image_name} (summary): {description[:100]}..."
+            return True
         if line.startswith(IMAGE_ANALYSIS_SIGNAL):
+            IMAGE_HANDOFF_STATS["path_signals"] += 1
             image_path_to_analyze = line.replace(IMAGE_ANALYSIS_SIGNAL, "").strip()
             signal_found_in_stdout = True
             print(f"\n{POOP_MSG_COLOR}POOP: Script signaled image analysis for: '{image_path_to_analyze}'{RESET_COLOR}")
@@ -903,20 +4690,14 @@ def handle_image_analysis_signal(script_stdout_lines_list, image_path_from_plan_
 
         if os.path.exists(image_path_to_analyze):
             try:
-                pil_img = Image.open(image_path_to_analyze)
-                # Ensure image is in a compatible format (e.g., RGB) if needed by the model
-                if pil_img.mode not in ['RGB', 'RGBA']: # Common modes; some models might prefer RGB
-                    pil_img = pil_img.convert('RGB')
                 print(f"{POOP_MSG_COLOR}POOP: Requesting AI description for '{os.path.basename(image_path_to_analyze)}'...{RESET_COLOR}")
-                description = gmc_multimodal(pil_img) # pil_img is PIL.Image object
-                pil_img.close()
+                description, image_info = describe_image_file(image_path_to_analyze) # Downsampled, re-encoded, cached by perceptual hash
 
                 if description.startswith("#LLM_ERR"):
                     print(f"{ERROR_COLOR}POOP: AI Error during image description: {description}{RESET_COLOR}")
                     return False # Analysis attempted but failed
                 else:
-                    print(f"{POOP_MSG_COLOR}POOP AI Description of '{os.path.basename(image_path_to_analyze)}':{RESET_COLOR}\n---\n{AI_RESPONSE_COLOR}{description}{RESET_COLOR}\n---")
-                    global LAST_SUCCESSFUL_TASK_DESCRIPTION
+                    print(f"{POOP_MSG_COLOR}POOP AI Description of '{os.path.basename(image_path_to_analyze)}' ({format_image_desc_info(image_info)}):{RESET_COLOR}\n---\n{AI_RESPONSE_COLOR}{description}{RESET_COLOR}\n---")
                     LAST_SUCCESSFUL_TASK_DESCRIPTION += f"\nAI image description of '{os.path.basename(image_path_to_analyze)}' (summary): {description[:100]}..."
                     return True # Analysis successful
             except Exception as e_img:
@@ -950,6 +4731,7 @@ if __name__ == "__main__":
 
     if not init_llm():
         sys.exit(1)
+    prestart_warm_workers()
     print("-" * shutil.get_terminal_size(fallback=(80,24)).columns)
     print_centered(f"Welcome to POOP ({POOP_NAME})", BRIGHT_WHITE_COLOR)
     print_poop_ascii_art()
@@ -974,6 +4756,7 @@ if __name__ == "__main__":
                 
                 if retry_choice == 'r':
                     print(f"{POOP_MSG_COLOR}POOP: Retrying failed step...{RESET_COLOR}")
+                    LLM_CACHE_BYPASS_NEXT = True # Cached code for this step is what just failed
                     if PLAN_STEP_FAILED_INFO.get('code_at_failure'):
                          current_code_buffer = PLAN_STEP_FAILED_INFO['code_at_failure'] # Restore code state at failure
                     PLAN_STEP_FAILED_INFO = None # Clear failure state for retry
@@ -1010,15 +4793,21 @@ if __name__ == "__main__":
 
                     if PLAN_STEP_INDEX >= len(CURRENT_PLAN_STEPS):
                         print(f"\n{POOP_MSG_COLOR}🤖 POOP: Plan ended (last step was skipped).{RESET_COLOR}")
+                        report_plan_prefetch_stats()
+                        stop_plan_kernel()
                         CURRENT_PLAN_TEXT = ""; CURRENT_PLAN_STEPS = []; PLAN_CONFIRMED = False; PLAN_STEP_INDEX = 0
                     else:
                         user_input_raw = "#POOP_CONTINUE_PLAN" # Continue with the new PLAN_STEP_INDEX
                 elif retry_choice == 'a':
                     print(f"{POOP_MSG_COLOR}POOP: Plan aborted by user.{RESET_COLOR}")
+                    report_plan_prefetch_stats()
+                    stop_plan_kernel()
                     CURRENT_PLAN_TEXT = ""; CURRENT_PLAN_STEPS = []; PLAN_CONFIRMED = False; PLAN_STEP_INDEX = 0; PLAN_STEP_FAILED_INFO = None
                     current_code_buffer = "" # Clear code buffer after aborting plan
                 else: # Assumed to be a new instruction
                     user_input_raw = retry_choice
+                    discard_plan_prefetches()
+                    stop_plan_kernel()
                     # Reset all plan state as user is giving a new top-level instruction
                     CURRENT_PLAN_TEXT = ""; CURRENT_PLAN_STEPS = []; PLAN_CONFIRMED = False; PLAN_STEP_INDEX = 0; PLAN_STEP_FAILED_INFO = None
                     current_code_buffer = "" # New instruction means new code context
@@ -1037,7 +4826,11 @@ if __name__ == "__main__":
             current_system_info = get_system_info()
 
             if command in ['exit', 'quit', 'q']:
-                stop_active_subprocess()
+                _BACKGROUND_JOBS_SHUTDOWN.set() # Before stopping, so a job exiting meanwhile isn't restarted
+                stop_active_subprocess("all")
+                discard_plan_prefetches()
+                shutdown_warm_workers()
+                stop_plan_kernel()
                 if CURRENT_TARGET_FILE and os.path.exists(CURRENT_TARGET_FILE) and CURRENT_TARGET_FILE.startswith("poop"):
                     del_q = input(f"{WARNING_COLOR}Delete temporary POOP file '{CURRENT_TARGET_FILE}'? (y/N): {RESET_COLOR}").lower()
                     if del_q == 'y':
@@ -1056,7 +4849,10 @@ if __name__ == "__main__":
                     print(f"{BRIGHT_WHITE_COLOR}{k.replace('_',' ').title()}:{RESET_COLOR} {v_sys}")
                 print(f"{POOP_MSG_COLOR}--------------------------{RESET_COLOR}")
             elif command in ['model', 'm']:
-                if argument:
+                if argument == "auto":
+                    MODEL_ROUTING_ENABLED = True
+                    print(f"{SUCCESS_COLOR}Automatic model routing enabled.{RESET_COLOR}")
+                elif argument:
                     target_model_obj = None
                     multi_short = M_MULTI_CAPABLE_MODEL.model_name.split('/')[-1] if M_MULTI_CAPABLE_MODEL else ""
                     light_short = M_LIGHT_MODEL.model_name.split('/')[-1] if M_LIGHT_MODEL else ""
@@ -1068,7 +4864,8 @@ if __name__ == "__main__":
                     
                     if target_model_obj:
                         M_CURRENT_TEXT_MODEL = target_model_obj
-                        print(f"{SUCCESS_COLOR}Current text model set to: '{M_CURRENT_TEXT_MODEL.model_name}'.{RESET_COLOR}")
+                        MODEL_ROUTING_ENABLED = False
+                        print(f"{SUCCESS_COLOR}Current text model set to: '{M_CURRENT_TEXT_MODEL.model_name}'. Automatic routing off ('m auto' to re-enable).{RESET_COLOR}")
                     else:
                         print(f"{ERROR_COLOR}!Model '{argument}' unknown or unavailable.{RESET_COLOR}")
                         if M_MULTI_CAPABLE_MODEL: print(f"  {POOP_MSG_COLOR}Primary available: '{M_MULTI_CAPABLE_MODEL.model_name}' (aliases: primary, {multi_short}){RESET_COLOR}")
@@ -1077,6 +4874,11 @@ if __name__ == "__main__":
                     print(f"{POOP_MSG_COLOR}Current text model: {M_CURRENT_TEXT_MODEL.model_name if M_CURRENT_TEXT_MODEL else 'N/A'}{RESET_COLOR}")
                     if M_MULTI_CAPABLE_MODEL: print(f"  {POOP_MSG_COLOR}Primary: {M_MULTI_CAPABLE_MODEL.model_name}{RESET_COLOR}")
                     if M_LIGHT_MODEL and M_LIGHT_MODEL != M_MULTI_CAPABLE_MODEL: print(f"  {POOP_MSG_COLOR}Light:   {M_LIGHT_MODEL.model_name}{RESET_COLOR}")
+                    print(f"  {POOP_MSG_COLOR}Routing: {'automatic' if MODEL_ROUTING_ENABLED else 'manual'}{RESET_COLOR}")
+                    for routed_model in [m_obj for m_obj in (M_MULTI_CAPABLE_MODEL, M_LIGHT_MODEL) if m_obj]:
+                        routed_latencies = list(_llm_metrics(routed_model.model_name)["latencies"])
+                        if routed_latencies:
+                            print(f"  {POOP_MSG_COLOR}{routed_model.model_name}: p50 {_percentile(routed_latencies, 50):.2f}s, p95 {_percentile(routed_latencies, 95):.2f}s ({len(routed_latencies)} calls){RESET_COLOR}")
 
             elif command == "run":
                 if not current_code_buffer.strip(): print(f"{WARNING_COLOR}!No code in buffer to run.{RESET_COLOR}"); continue
@@ -1108,11 +4910,13 @@ if __name__ == "__main__":
                         code_to_run_with_comment = current_code_buffer
 
                     # Execute the code (either from buffer directly if in-memory, or via file)
-                    ran_code_buffer, fixed, successful, script_stdout_lines, exec_error_msg = execute_code(
+                    ran_code_buffer, fixed, successful, script_stdout_lines, exec_error_msg = execute_with_auto_fix(
                         code_to_run_with_comment, # Pass the potentially commented version
                         LAST_USER_INSTRUCTION,
                         LAST_SUCCESSFUL_TASK_DESCRIPTION,
-                        file_path=target_file_for_run_cmd # Pass file path if one is determined
+                        file_path=target_file_for_run_cmd, # Pass file path if one is determined
+                        confirm_fix=confirm_auto_fix_rerun, # Each fix is reviewed as a diff before it runs
+                        interpreter=CURRENT_PLAN_INTERPRETER if PLAN_CONFIRMED else None
                     )
 
                     if fixed and ran_code_buffer != code_to_run_with_comment: # If LLM fixed it
@@ -1121,21 +4925,25 @@ if __name__ == "__main__":
                         # The fixed code is now in current_code_buffer. If user runs again, new temp file or existing.
                         if target_file_for_run_cmd: # If a file was used, re-write it with the fix.
                             try:
-                                with open(target_file_for_run_cmd, "w", encoding='utf-8') as f_fix: f_fix.write(current_code_buffer)
+                                write_code_file(target_file_for_run_cmd, current_code_buffer)
                                 print(f"{POOP_MSG_COLOR}Fixed code saved to '{target_file_for_run_cmd}'.{RESET_COLOR}")
                             except Exception as e_fix_save:
                                 print(f"{ERROR_COLOR}!Error saving fixed code to '{target_file_for_run_cmd}': {e_fix_save}{RESET_COLOR}")
 
 
-                    CODE_MODIFIED_BY_LLM_SINCE_LAST_RUN = fixed # If fixed, it's "modified by LLM"
-                    if fixed:
-                        LAST_CODE_FOR_CONFIRMATION = "" # Requires re-confirmation if run again
+                    if successful: # Every fix in the loop was reviewed as a diff and the final code ran fine: it counts as confirmed
+                        CODE_MODIFIED_BY_LLM_SINCE_LAST_RUN = False
+                        LAST_CODE_FOR_CONFIRMATION = current_code_buffer
+                    else:
+                        CODE_MODIFIED_BY_LLM_SINCE_LAST_RUN = fixed # If fixed, it's "modified by LLM"
+                        if fixed:
+                            LAST_CODE_FOR_CONFIRMATION = "" # Requires re-confirmation if run again
 
                     if exec_error_msg and exec_error_msg.startswith(MODULE_INSTALL_SIGNAL):
                         # Module was installed, don't clear successful task desc.
                         print(f"{POOP_MSG_COLOR}POOP: A required module was installed. Please 'run' the command again to use the module.{RESET_COLOR}")
-                    elif successful and not fixed:
-                        LAST_SUCCESSFUL_TASK_DESCRIPTION = LAST_USER_INSTRUCTION # Update on successful, un-fixed run
+                    elif successful:
+                        LAST_SUCCESSFUL_TASK_DESCRIPTION = LAST_USER_INSTRUCTION # Also after fixes: the code that ran is the code in the buffer
                     elif not successful :
                         LAST_SUCCESSFUL_TASK_DESCRIPTION = "" # Clear if execution failed
 
@@ -1152,10 +4960,8 @@ if __name__ == "__main__":
                     f"Last high-level user instruction to POOP: \"{LAST_USER_INSTRUCTION}\"",
                 ]
                 if current_code_buffer.strip():
-                    code_summary = current_code_buffer
-                    if len(code_summary) > 700: # Summarize if too long for chat context
-                        code_summary = current_code_buffer[:350] + "\n...\n(code truncated for chat context)\n...\n" + current_code_buffer[-350:]
-                    chat_context_parts.append(f"Current code in buffer:\n```python\n{code_summary}\n```")
+                    chat_context_parts.append(PromptSection(current_code_buffer, priority=2, trim="code", focus=f"{argument} {LAST_SCRIPT_STDERR_MESSAGE}",
+                                                            name="code buffer", prefix="Current code in buffer:\n```python\n", suffix="\n```"))
                 else:
                     chat_context_parts.append("The code buffer is currently empty.")
 
@@ -1174,32 +4980,176 @@ if __name__ == "__main__":
 
 
                 if LAST_SCRIPT_STDOUT_LINES:
-                    output_preview = "\n".join(LAST_SCRIPT_STDOUT_LINES[:10]) # Show first 10 lines
-                    if len(LAST_SCRIPT_STDOUT_LINES) > 10: output_preview += "\n... (stdout truncated)"
-                    chat_context_parts.append(f"Last script's standard output (stdout) preview:\n```\n{output_preview}\n```")
+                    chat_context_parts.append(PromptSection("\n".join(LAST_SCRIPT_STDOUT_LINES), priority=4, name="stdout", max_tokens=500,
+                                                            prefix="Last script's standard output (stdout) preview:\n```\n", suffix="\n```"))
                 
                 if LAST_SCRIPT_STDERR_MESSAGE:
-                     chat_context_parts.append(f"Last script's error message (stderr):\n```\n{LAST_SCRIPT_STDERR_MESSAGE[:500]}{'...' if len(LAST_SCRIPT_STDERR_MESSAGE)>500 else ''}\n```")
+                     chat_context_parts.append(PromptSection(LAST_SCRIPT_STDERR_MESSAGE, priority=3, trim="tail", name="stderr", max_tokens=1000,
+                                                             prefix="Last script's error message (stderr):\n```\n", suffix="\n```"))
 
 
                 user_chat_query = argument if argument else "What are your thoughts on the current situation or the last operation? What should I consider doing next, or are there any potential issues you foresee based on this context?"
                 chat_context_parts.append(f"\nUser's specific chat query: \"{user_chat_query}\"")
                 chat_context_parts.append("\nPlease provide a concise, helpful, and conversational response. If you suggest code changes, provide them in brief or conceptually unless asked for full code.")
 
-                full_chat_prompt = "\n\n".join(chat_context_parts)
+                full_chat_prompt = assemble_prompt(chat_context_parts, "chat", route_models("chat")[0], joiner="\n\n")
                 # print(f"DEBUG CHAT PROMPT: {full_chat_prompt}") # For debugging
-                print(f"{POOP_MSG_COLOR}POOP: Asking LLM to chat (model: {M_CURRENT_TEXT_MODEL.model_name})...{RESET_COLOR}")
+                print(f"{POOP_MSG_COLOR}POOP: Asking LLM to chat (model: {route_models('chat')[0].model_name})...{RESET_COLOR}")
                 
-                response_text = gmtc(full_chat_prompt)
+                if LLM_STREAM_OUTPUT: print(f"\n{CHAT_LLM_RESPONSE_COLOR}POOP Chat:{RESET_COLOR}")
+                response_text = gmtc(full_chat_prompt, stream=LLM_STREAM_OUTPUT)
                 
                 if response_text.startswith("#LLM_ERR"):
                     print(f"{ERROR_COLOR}{response_text}{RESET_COLOR}")
-                else:
+                elif not LLM_STREAM_OUTPUT: # Streamed replies were already rendered live
                     print(f"\n{CHAT_LLM_RESPONSE_COLOR}POOP Chat:{RESET_COLOR}\n{response_text}")
 
 
+            elif command == "llm_stats":
+                print_llm_call_metrics()
+                print_prompt_budgets()
+
+            elif command == "venvs":
+                venvs_arg = argument.strip().lower()
+                if venvs_arg in ("on", "off"):
+                    PLAN_VENVS_ENABLED = venvs_arg == "on"
+                    if not PLAN_VENVS_ENABLED: CURRENT_PLAN_INTERPRETER = None
+                    print(f"{POOP_MSG_COLOR}Per-plan venvs {'enabled (from the next confirmed plan)' if PLAN_VENVS_ENABLED else 'disabled; plans run with ' + sys.executable}.{RESET_COLOR}")
+                elif venvs_arg in ("gc", "clear"):
+                    removed_venvs = gc_plan_venvs(max_count=0 if venvs_arg == "clear" else None)
+                    print(f"{POOP_MSG_COLOR}Removed {len(removed_venvs)} venv(s){' (the active plan venv is kept)' if CURRENT_PLAN_INTERPRETER else ''}.{RESET_COLOR}")
+                elif venvs_arg:
+                    print(f"{WARNING_COLOR}!Usage: venvs [gc|clear|on|off]{RESET_COLOR}")
+                print_plan_venvs()
+
+            elif command == "deps":
+                deps_args = argument.split()
+                if len(deps_args) == 3 and deps_args[0] == "map":
+                    IMPORT_TO_DISTRIBUTION[deps_args[1]] = deps_args[2]
+                    print(f"{POOP_MSG_COLOR}'import {deps_args[1]}' now installs '{deps_args[2]}'.{RESET_COLOR}")
+                elif deps_args:
+                    print(f"{WARNING_COLOR}!Usage: deps [map <import_name> <distribution>]{RESET_COLOR}")
+                print_dependency_status()
+
+            elif command == "fixloop":
+                fixloop_args = argument.split()
+                try:
+                    if len(fixloop_args) == 2 and fixloop_args[0] == "attempts":
+                        AUTO_FIX_MAX_ATTEMPTS = max(0, int(fixloop_args[1]))
+                    elif len(fixloop_args) == 2 and fixloop_args[0] == "seconds":
+                        AUTO_FIX_TIME_BUDGET_SECONDS = max(1.0, float(fixloop_args[1]))
+                    elif len(fixloop_args) == 2 and fixloop_args[0] == "escalate" and fixloop_args[1] in ("on", "off"):
+                        AUTO_FIX_ESCALATE = fixloop_args[1] == "on"
+                    elif len(fixloop_args) == 2 and fixloop_args[0] == "preflight" and fixloop_args[1] in ("on", "off"):
+                        PREFLIGHT_ENABLED = fixloop_args[1] == "on"
+                    elif fixloop_args:
+                        print(f"{WARNING_COLOR}!Usage: fixloop [attempts <n> | seconds <s> | escalate on|off | preflight on|off]{RESET_COLOR}")
+                except ValueError:
+                    print(f"{ERROR_COLOR}!Invalid value '{fixloop_args[1]}'.{RESET_COLOR}")
+                print_auto_fix_log()
+
+            elif command == "edits":
+                if argument in ("patch", "full"):
+                    CODE_EDIT_MODE = argument
+                elif argument:
+                    print(f"{WARNING_COLOR}!Usage: edits [patch|full]{RESET_COLOR}")
+                print(f"{POOP_MSG_COLOR}Code edits: {CODE_EDIT_MODE} (fixes of scripts from {CODE_PATCH_MIN_CHARS} chars {'use SEARCH/REPLACE blocks' if CODE_EDIT_MODE == 'patch' else 'regenerate the whole script'}).{RESET_COLOR}")
+
+            elif command == "budget":
+                budget_args = argument.split()
+                if len(budget_args) == 1 and budget_args[0] in ("estimate", "model"):
+                    PROMPT_TOKEN_COUNTING = budget_args[0]
+                elif len(budget_args) == 2 and budget_args[0] in PROMPT_TOKEN_BUDGETS and budget_args[1].isdigit() and int(budget_args[1]) > 0:
+                    PROMPT_TOKEN_BUDGETS[budget_args[0]] = int(budget_args[1])
+                elif budget_args:
+                    print(f"{WARNING_COLOR}!Usage: budget [<{'|'.join(PROMPT_TOKEN_BUDGETS)}> <tokens>] | budget estimate|model{RESET_COLOR}")
+                print_prompt_budgets()
+
+            elif command == "limits":
+                limit_args = argument.split()
+                if limit_args == ["off"]:
+                    for limit_name in RUN_LIMITS: RUN_LIMITS[limit_name] = None
+                    print(f"{WARNING_COLOR}All run limits disabled.{RESET_COLOR}")
+                elif len(limit_args) == 2 and limit_args[0] in RUN_LIMITS:
+                    try:
+                        RUN_LIMITS[limit_args[0]] = None if limit_args[1] in ("off", "none", "0") else float(limit_args[1])
+                        print(f"{SUCCESS_COLOR}{limit_args[0]} set to {RUN_LIMITS[limit_args[0]] or 'off'}.{RESET_COLOR}")
+                    except ValueError:
+                        print(f"{ERROR_COLOR}!Invalid value '{limit_args[1]}'.{RESET_COLOR}")
+                elif limit_args:
+                    print(f"{WARNING_COLOR}!Usage: limits [<{'|'.join(RUN_LIMITS)}> <value|off>] | limits off{RESET_COLOR}")
+                print_run_limits()
+
+            elif command == "snippets":
+                if argument in ("ask", "auto", "off"):
+                    VERIFIED_SNIPPET_REUSE = argument
+                    print(f"{POOP_MSG_COLOR}Verified snippet reuse: {argument}.{RESET_COLOR}")
+                elif argument == "clear":
+                    _verified_snippets().clear(); _save_verified_snippets()
+                    print(f"{POOP_MSG_COLOR}Verified snippets cleared.{RESET_COLOR}")
+                elif argument:
+                    print(f"{WARNING_COLOR}!Usage: snippets [ask|auto|off|clear]{RESET_COLOR}")
+                print_verified_snippets()
+
+            elif command == "past":
+                print_past_poop_files(argument or None)
+
+            elif command == "kernel":
+                kernel_arg = argument.strip().lower()
+                if kernel_arg in ("on", "off"):
+                    PLAN_KERNEL_ENABLED = kernel_arg == "on" and FORK_WORKERS_SUPPORTED
+                    if not PLAN_KERNEL_ENABLED: stop_plan_kernel()
+                    print(f"{POOP_MSG_COLOR}Incremental plan kernel {'on' if PLAN_KERNEL_ENABLED else 'off (plan steps re-run the whole file)'}.{RESET_COLOR}")
+                elif kernel_arg == "reset":
+                    reset_plan_kernel()
+                    print(f"{POOP_MSG_COLOR}Plan kernel stopped; the next plan step runs the whole file in a fresh one.{RESET_COLOR}")
+                elif kernel_arg:
+                    print(f"{WARNING_COLOR}!Usage: kernel [on|off|reset]{RESET_COLOR}")
+                print_plan_kernel_status()
+
+            elif command == "workers":
+                if argument == "restart":
+                    shutdown_warm_workers(); prestart_warm_workers()
+                    print(f"{POOP_MSG_COLOR}Warm worker pool restarted.{RESET_COLOR}")
+                print_warm_worker_status()
+
+            elif command == "transcript":
+                print_output_transcript(int(argument) if argument.isdigit() else 40)
+
+            elif command == "stream":
+                if argument in ["on", "off"]:
+                    LLM_STREAM_OUTPUT = (argument == "on")
+                    print(f"{POOP_MSG_COLOR}LLM output streaming {'enabled' if LLM_STREAM_OUTPUT else 'disabled'}.{RESET_COLOR}")
+                elif not argument:
+                    print_llm_stream_stats()
+                else:
+                    print(f"{WARNING_COLOR}!Usage: stream [on|off]{RESET_COLOR}")
+
+            elif command == "cache":
+                if not argument or argument == "stats":
+                    print_llm_cache_stats()
+                elif argument == "clear":
+                    llm_cache_clear()
+                    print(f"{POOP_MSG_COLOR}LLM response cache cleared.{RESET_COLOR}")
+                elif argument in ["on", "off"]:
+                    LLM_CACHE_ENABLED = (argument == "on")
+                    print(f"{POOP_MSG_COLOR}LLM response cache {'enabled' if LLM_CACHE_ENABLED else 'disabled'}.{RESET_COLOR}")
+                elif argument == "bypass":
+                    LLM_CACHE_BYPASS_NEXT = True
+                    print(f"{POOP_MSG_COLOR}The next LLM call will bypass the response cache (fresh generation).{RESET_COLOR}")
+                else:
+                    print(f"{WARNING_COLOR}!Usage: cache [stats|clear|on|off|bypass]{RESET_COLOR}")
+
             elif command == "start":
-                target_f_start = argument if argument else CURRENT_TARGET_FILE
+                start_args = user_input_raw.split()[1:] # Raw input: paths are case-sensitive
+                restart_policy = None
+                for start_arg in list(start_args):
+                    if start_arg.startswith("--restart"):
+                        start_args.remove(start_arg)
+                        restart_policy = start_arg.partition("=")[2] or "on-failure"
+                if restart_policy and restart_policy not in BACKGROUND_JOB_RESTART_POLICIES:
+                    print(f"{ERROR_COLOR}!Unknown restart policy '{restart_policy}'. Use one of: {', '.join(BACKGROUND_JOB_RESTART_POLICIES)}.{RESET_COLOR}"); continue
+                target_f_start = " ".join(start_args) if start_args else CURRENT_TARGET_FILE
                 
                 if not current_code_buffer.strip() and not (target_f_start and os.path.exists(target_f_start)):
                     print(f"{WARNING_COLOR}!No code in buffer and no existing file specified to start.{RESET_COLOR}"); continue
@@ -1227,13 +5177,13 @@ if __name__ == "__main__":
 
                 if final_code_to_write: # If there's code to write (from buffer)
                     try:
-                        with open(target_f_start, "w", encoding='utf-8') as f_write: f_write.write(final_code_to_write)
+                        write_code_file(target_f_start, final_code_to_write)
                         print(f"{POOP_MSG_COLOR}Code successfully written to '{target_f_start}'.{RESET_COLOR}")
-                        start_code_in_background(target_f_start)
+                        start_code_in_background(target_f_start, restart_policy, CURRENT_PLAN_INTERPRETER if PLAN_CONFIRMED else None)
                     except Exception as e:
                         print(f"{ERROR_COLOR}!Error writing code to '{target_f_start}': {e}{RESET_COLOR}")
                 elif target_f_start and os.path.exists(target_f_start): # No code to write, just run existing file
-                    start_code_in_background(target_f_start)
+                    start_code_in_background(target_f_start, restart_policy, CURRENT_PLAN_INTERPRETER if PLAN_CONFIRMED else None)
                 # else case handled above
 
                 # Mark buffer as "used" for confirmation purposes if it was written
@@ -1242,31 +5192,71 @@ if __name__ == "__main__":
                     LAST_CODE_FOR_CONFIRMATION = code_to_start_from_buffer
                     # LAST_SUCCESSFUL_TASK_DESCRIPTION = LAST_USER_INSTRUCTION # Starting a process is a kind of success
 
-            elif command == "stop": stop_active_subprocess()
-            elif command == "status_process": get_process_status()
+            elif command == "stop": stop_active_subprocess(argument)
+            elif command == "status_process": get_process_status(argument)
+            elif command == "jobs": list_background_jobs()
+            elif command == "logs":
+                log_args = argument.split()
+                show_background_job_logs(next((a for a in log_args if not a.startswith("-")), ""), follow=any(a in ("--follow", "-f") for a in log_args))
             elif command == "img_desc":
                 if not argument: print(f"{WARNING_COLOR}!Path to image file is required for 'img_desc'.{RESET_COLOR}"); continue
                 if not M_MULTI_CAPABLE_MODEL: print(f"{ERROR_COLOR}!Multimodal model is not available for image description.{RESET_COLOR}"); continue
+                try:
+                    img_desc_args = shlex.split(argument, posix=os.name != "nt")
+                except ValueError as e:
+                    print(f"{WARNING_COLOR}!Could not parse 'img_desc' arguments: {e}{RESET_COLOR}"); continue
+                img_desc_patterns, img_desc_output, img_desc_workers = [], None, None
+                while img_desc_args:
+                    img_desc_token = img_desc_args.pop(0)
+                    if img_desc_token in ("-o", "--out") and img_desc_args: img_desc_output = img_desc_args.pop(0)
+                    elif img_desc_token in ("-j", "--workers") and img_desc_args and img_desc_args[0].isdigit(): img_desc_workers = int(img_desc_args.pop(0))
+                    else: img_desc_patterns.append(img_desc_token.strip('"') if os.name == "nt" else img_desc_token)
+                if img_desc_output or len(img_desc_patterns) > 1 or any(glob.has_magic(p) or os.path.isdir(p) for p in img_desc_patterns):
+                    describe_images_batch(img_desc_patterns, img_desc_output, img_desc_workers); continue
+                argument = img_desc_patterns[0] if img_desc_patterns else argument
                 
                 try:
                     image_path_arg = os.path.abspath(argument)
                     if not os.path.exists(image_path_arg):
                         print(f"{ERROR_COLOR}!Image file not found at: '{image_path_arg}'{RESET_COLOR}"); continue
                     
-                    pil_image = Image.open(image_path_arg)
-                    if pil_image.mode not in ['RGB', 'RGBA']: pil_image = pil_image.convert('RGB')
-                    
                     print(f"{POOP_MSG_COLOR}Generating description for image '{os.path.basename(image_path_arg)}'...{RESET_COLOR}");
-                    description = gmc_multimodal(pil_image) # Pass PIL.Image object
-                    pil_image.close()
+                    description, image_info = describe_image_file(image_path_arg)
                     
                     if description.startswith("#LLM_ERR"):
                         print(f"{ERROR_COLOR}Error during image description: {description}{RESET_COLOR}")
                     else:
                         print(f"\n{AI_RESPONSE_COLOR}--- Image Description ---\n{description}\n------------------------{RESET_COLOR}")
+                        print(f"{POOP_MSG_COLOR}({format_image_desc_info(image_info)}){RESET_COLOR}")
                 except Exception as e:
                     print(f"{ERROR_COLOR}!Error processing image for 'img_desc': {e}{RESET_COLOR}")
 
+            elif command == "img_cache":
+                img_cache_args = argument.split()
+                img_cache_option = img_cache_args[0].lower() if img_cache_args else ""
+                img_cache_value = img_cache_args[1] if len(img_cache_args) > 1 else ""
+                if img_cache_option in ("on", "off"):
+                    IMAGE_DESC_CACHE_ENABLED = img_cache_option == "on"
+                    print(f"{POOP_MSG_COLOR}Image description cache {'enabled' if IMAGE_DESC_CACHE_ENABLED else 'disabled'}.{RESET_COLOR}")
+                elif img_cache_option == "clear":
+                    with _IMAGE_DESC_LOCK: _image_desc_cache().clear(); _save_image_desc_cache()
+                    print(f"{POOP_MSG_COLOR}Image description cache cleared.{RESET_COLOR}")
+                elif img_cache_option == "maxedge" and (img_cache_value.isdigit() or img_cache_value == "off"):
+                    IMAGE_MAX_EDGE = int(img_cache_value) if img_cache_value.isdigit() and int(img_cache_value) > 0 else None
+                elif img_cache_option == "quality" and img_cache_value.isdigit() and 1 <= int(img_cache_value) <= 100:
+                    IMAGE_UPLOAD_QUALITY = int(img_cache_value)
+                elif img_cache_option == "format" and img_cache_value.upper() in _IMAGE_UPLOAD_MIME_TYPES:
+                    IMAGE_UPLOAD_FORMAT = img_cache_value.upper()
+                elif img_cache_option == "near" and img_cache_value in ("on", "off"):
+                    IMAGE_DESC_CACHE_NEAR_DUPLICATES = img_cache_value == "on"
+                elif img_cache_option == "distance" and img_cache_value.isdigit():
+                    IMAGE_DESC_CACHE_MAX_DISTANCE = int(img_cache_value)
+                elif img_cache_option == "handoff" and img_cache_value in ("on", "off"):
+                    IMAGE_HANDOFF_ENABLED = img_cache_value == "on"
+                elif img_cache_option:
+                    print(f"{WARNING_COLOR}!Usage: img_cache [on|off|clear|maxedge px|off|quality q|format jpeg|webp|png|near on|off|distance bits|handoff on|off]{RESET_COLOR}")
+                print_image_desc_stats()
+
             elif command == "show":
                 print(f"\n{POOP_MSG_COLOR}--- Current POOP Status ---{RESET_COLOR}")
                 print(f"{BRIGHT_WHITE_COLOR}Target File:{RESET_COLOR} {CURRENT_TARGET_FILE if CURRENT_TARGET_FILE else 'In-Memory / Auto-generated per plan'}")
@@ -1308,6 +5298,7 @@ if __name__ == "__main__":
 
             elif command == "clear":
                 current_code_buffer = "";
+                discard_plan_prefetches()
                 LAST_USER_INSTRUCTION = "print('Hello from POOP!')"; # Reset to default
                 LAST_SUCCESSFUL_TASK_DESCRIPTION = ""
                 LAST_SCRIPT_STDOUT_LINES = []
@@ -1321,6 +5312,8 @@ if __name__ == "__main__":
                 LAST_CODE_FOR_CONFIRMATION = ""
                 
                 CURRENT_PLAN_TEXT = ""; CURRENT_PLAN_STEPS = []; PLAN_CONFIRMED = False; PLAN_STEP_INDEX = 0; PLAN_STEP_FAILED_INFO = None
+                CURRENT_PLAN_INTERPRETER = None
+                reset_plan_kernel()
                 
                 print(f"{POOP_MSG_COLOR}Code buffer, task history, and active plan cleared. Target file association remains unless changed with 'f'.{RESET_COLOR}");
                 update_cmds_display()
@@ -1369,6 +5362,7 @@ if __name__ == "__main__":
                 if command != "#poop_continue_plan": # New user instruction, not internal continuation
                     LAST_USER_INSTRUCTION = user_input_raw
                     # Reset plan state for a new top-level instruction
+                    discard_plan_prefetches()
                     CURRENT_PLAN_TEXT = ""; CURRENT_PLAN_STEPS = []; PLAN_CONFIRMED = False; PLAN_STEP_INDEX = 0; PLAN_STEP_FAILED_INFO = None
                     current_code_buffer = "" # New user instruction implies starting fresh with code, unless 'f' was used.
                     LAST_SUCCESSFUL_TASK_DESCRIPTION = "" # Reset this as well for a new goal
@@ -1383,10 +5377,6 @@ if __name__ == "__main__":
                     print(f"\n{POOP_MSG_COLOR}🤖 POOP Plan Step {PLAN_STEP_INDEX + 1}/{len(CURRENT_PLAN_STEPS)}: {RESET_COLOR}{BRIGHT_WHITE_COLOR}{step_task_exec}{RESET_COLOR} {'(Additive Code)' if is_additive_step_exec else '(New/Replace Code)'}")
 
                     if current_step_details_exec.get("requires_code_gen", True):
-                        instruction_for_gmc_step = f"Implement the following plan step: {step_task_exec}."
-                        if current_step_details_exec.get('details'):
-                            instruction_for_gmc_step += f" Specific details for this step: {current_step_details_exec['details']}."
-                        
                         # Determine code base for gmc: if additive, use current_code_buffer; if not, gmc gets empty.
                         code_base_for_gmc_step = current_code_buffer if is_additive_step_exec else ""
                         
@@ -1408,23 +5398,18 @@ if __name__ == "__main__":
                         
                         update_cmds_display() # If CURRENT_TARGET_FILE changed
 
-                        print(f"{POOP_MSG_COLOR}POOP: Generating code for this step...{RESET_COLOR}")
-                        gmc_plan_context_step = {
-                            "full_plan": CURRENT_PLAN_TEXT,
-                            "current_step_description": step_task_exec,
-                            "current_step_details": current_step_details_exec.get('details', 'N/A'),
-                            "requires_user_input_during_step": current_step_details_exec.get('requires_user_input_during_step'),
-                            "screenshot_analysis_signal": current_step_details_exec.get('screenshot_analysis_signal', False),
-                            "overall_goal": LAST_USER_INSTRUCTION, # The plan's overall goal
-                            "is_additive": is_additive_step_exec
-                        }
-                        generated_code_for_step_exec = gmc(
-                            code_base_for_gmc_step,
-                            instruction_for_gmc_step,
-                            previous_task_context_for_code_gen=LAST_SUCCESSFUL_TASK_DESCRIPTION, # Context from *previous* step's success
-                            system_info_for_code_gen=current_system_info,
-                            plan_context_for_code_gen=gmc_plan_context_step
-                        )
+                        gmc_request_step = build_plan_step_gmc_request(PLAN_STEP_INDEX, current_step_details_exec, code_base_for_gmc_step, LAST_SUCCESSFUL_TASK_DESCRIPTION, current_system_info)
+                        instruction_for_gmc_step = gmc_request_step["user_instruction_for_code_gen"]
+                        step_fingerprint_exec = plan_step_fingerprint(current_step_details_exec, code_base_for_gmc_step, current_system_info)
+                        code_buffer_before_step = current_code_buffer
+                        generated_code_for_step_exec = take_verified_snippet(step_fingerprint_exec, PLAN_STEP_INDEX)
+                        reused_verified_snippet = generated_code_for_step_exec is not None
+                        if generated_code_for_step_exec is None:
+                            generated_code_for_step_exec = take_prefetched_plan_step_code(PLAN_STEP_INDEX, gmc_request_step)
+                        if generated_code_for_step_exec is None:
+                            print(f"{POOP_MSG_COLOR}POOP: Generating code for this step...{RESET_COLOR}")
+                            generated_code_for_step_exec = gmc(**gmc_request_step)
+                        schedule_plan_prefetches(PLAN_STEP_INDEX, current_system_info) # Runs while this step executes
 
                         if generated_code_for_step_exec.startswith("#LLM_ERR"):
                             PLAN_STEP_FAILED_INFO = {'index': PLAN_STEP_INDEX, 'reason': f"LLM code generation failed for step: {generated_code_for_step_exec}", 'step_task': step_task_exec, 'code_at_failure': current_code_buffer} # Save buffer before modification attempt
@@ -1453,7 +5438,7 @@ if __name__ == "__main__":
                             # Save the (potentially combined) code to the target file before execution
                             if CURRENT_TARGET_FILE:
                                 try:
-                                    with open(CURRENT_TARGET_FILE, "w", encoding='utf-8') as f_w_step: f_w_step.write(current_code_buffer)
+                                    write_code_file(CURRENT_TARGET_FILE, current_code_buffer)
                                     # print(f"{POOP_MSG_COLOR}Code for step {PLAN_STEP_INDEX + 1} {'appended to' if is_additive_step_exec and code_base_for_gmc_step else 'saved to'} '{CURRENT_TARGET_FILE}'.{RESET_COLOR}")
                                 except Exception as e_save_step:
                                     print(f"{ERROR_COLOR}!Error saving code to '{CURRENT_TARGET_FILE}' for step execution: {e_save_step}{RESET_COLOR}")
@@ -1461,12 +5446,15 @@ if __name__ == "__main__":
                                     # Don't proceed to execute if save failed
 
                             if not PLAN_STEP_FAILED_INFO: # Only execute if save (if attempted) was okay
-                                executed_code_buffer_step, fixed_by_llm_after_exec_step, successful_exec_step, script_stdout_lines_step, exec_error_msg_step = execute_code(
+                                executed_code_buffer_step, fixed_by_llm_after_exec_step, successful_exec_step, script_stdout_lines_step, exec_error_msg_step = execute_with_auto_fix(
                                     current_code_buffer, # Execute the full current buffer
                                     instruction_for_gmc_step, # Context for potential fix
                                     LAST_SUCCESSFUL_TASK_DESCRIPTION, # Prev step's success context
                                     file_path=CURRENT_TARGET_FILE, # Execute from this file
-                                    auto_run_source=f"POOP (Plan Step {PLAN_STEP_INDEX + 1}) "
+                                    auto_run_source=f"POOP (Plan Step {PLAN_STEP_INDEX + 1}) ",
+                                    allow_llm_fix=not reused_verified_snippet, # A failing reused snippet is regenerated, not patched
+                                    interpreter=CURRENT_PLAN_INTERPRETER,
+                                    incremental=True # Additive steps only run their new code on top of the kept namespace
                                 )
 
                                 if fixed_by_llm_after_exec_step and executed_code_buffer_step != current_code_buffer:
@@ -1475,7 +5463,7 @@ if __name__ == "__main__":
                                     # Re-save the fixed code to the file
                                     if CURRENT_TARGET_FILE:
                                         try:
-                                            with open(CURRENT_TARGET_FILE, "w", encoding='utf-8') as f_fix_step: f_fix_step.write(current_code_buffer)
+                                            write_code_file(CURRENT_TARGET_FILE, current_code_buffer)
                                         except Exception as e_fix_save_step:
                                             print(f"{ERROR_COLOR}!Error saving fixed code to '{CURRENT_TARGET_FILE}': {e_fix_save_step}{RESET_COLOR}")
 
@@ -1485,8 +5473,16 @@ if __name__ == "__main__":
                                     # Do not advance PLAN_STEP_INDEX. PLAN_STEP_FAILED_INFO is not set.
                                     # The next loop iteration will re-trigger '#POOP_CONTINUE_PLAN' for the same step.
                                     print(f"{POOP_MSG_COLOR}POOP: A module was installed. Retrying step {PLAN_STEP_INDEX + 1} automatically.{RESET_COLOR}")
+                                elif reused_verified_snippet and not successful_exec_step:
+                                    # Verified code no longer works here: drop it and retry the step with normal generation.
+                                    forget_verified_snippet(step_fingerprint_exec)
+                                    current_code_buffer = code_buffer_before_step
+                                    print(f"{WARNING_COLOR}POOP: Reused code failed; discarded it. Generating step {PLAN_STEP_INDEX + 1} with the LLM instead.{RESET_COLOR}")
                                 elif successful_exec_step:
-                                    LAST_SUCCESSFUL_TASK_DESCRIPTION = f"Successfully completed plan step {PLAN_STEP_INDEX + 1}: {step_task_exec} (Part of overall goal: {LAST_USER_INSTRUCTION})"
+                                    if not fixed_by_llm_after_exec_step or not is_additive_step_exec:
+                                        # Additive steps fixed as a whole script no longer have a separable snippet.
+                                        record_verified_snippet(step_fingerprint_exec, current_step_details_exec, current_code_buffer if not is_additive_step_exec else generated_code_for_step_exec)
+                                    LAST_SUCCESSFUL_TASK_DESCRIPTION = plan_step_success_description(PLAN_STEP_INDEX, current_step_details_exec)
                                     PLAN_STEP_INDEX += 1
                                     handle_image_analysis_signal(script_stdout_lines_step) # Handle signal from successful script
                                 else: # Execution failed and wasn't a module install fix
@@ -1496,6 +5492,7 @@ if __name__ == "__main__":
 
 
                     else: # Step does not require code generation (e.g., manual action or POOP internal AI action)
+                        schedule_plan_prefetches(PLAN_STEP_INDEX, current_system_info)
                         action_completed_non_code = False;
                         action_desc_non_code = current_step_details_exec.get('requires_user_action', '')
                         
@@ -1535,15 +5532,20 @@ if __name__ == "__main__":
                             action_completed_non_code = True 
                         
                         if action_completed_non_code:
-                            LAST_SUCCESSFUL_TASK_DESCRIPTION = f"Completed non-code plan step {PLAN_STEP_INDEX + 1}: {step_task_exec}"
+                            LAST_SUCCESSFUL_TASK_DESCRIPTION = plan_step_success_description(PLAN_STEP_INDEX, current_step_details_exec, requires_code_gen=False)
                             PLAN_STEP_INDEX += 1
                         elif not PLAN_STEP_FAILED_INFO: # Action not completed, and not already marked as failed
                             print(f"{WARNING_COLOR}Plan paused. Please complete the required non-code action for step {PLAN_STEP_INDEX + 1}.{RESET_COLOR}")
                             # Plan will not advance, user will be prompted again or can issue new command
 
+                    if PLAN_STEP_FAILED_INFO:
+                        discard_plan_prefetches() # Generated-ahead code assumed this step would succeed
+
                     # Check if plan is fully completed
                     if PLAN_STEP_INDEX >= len(CURRENT_PLAN_STEPS) and not PLAN_STEP_FAILED_INFO:
                         print(f"\n{SUCCESS_COLOR}🎉 POOP: Plan Succeeded! All {len(CURRENT_PLAN_STEPS)} steps completed for goal: '{LAST_USER_INSTRUCTION}'.{RESET_COLOR}")
+                        report_plan_prefetch_stats()
+                        stop_plan_kernel()
                         CURRENT_PLAN_TEXT = ""; CURRENT_PLAN_STEPS = []; PLAN_CONFIRMED = False; PLAN_STEP_INDEX = 0
                         # current_code_buffer might contain the final script of the plan. User can 'show', 'run', or 'clear' it.
 
@@ -1552,7 +5554,10 @@ if __name__ == "__main__":
                     # User provided a new instruction, and no plan is active or failed. Time to generate a plan.
                     print(f"{POOP_MSG_COLOR}🤖 POOP: Received new instruction: '{LAST_USER_INSTRUCTION}'. Generating a plan...{RESET_COLOR}")
                     load_past_poop_files_context() # Refresh past files context for new plan
-                    plan_text_output_gen = gmp(LAST_USER_INSTRUCTION, current_system_info, PAST_POOP_FILES_CONTEXT)
+                    relevant_past_scripts = find_relevant_past_scripts(LAST_USER_INSTRUCTION)
+                    if relevant_past_scripts:
+                        print(f"{POOP_MSG_COLOR}POOP: Related past scripts for planning: {', '.join(script['name'] for script in relevant_past_scripts)}{RESET_COLOR}")
+                    plan_text_output_gen = gmp(LAST_USER_INSTRUCTION, current_system_info, PAST_POOP_FILES_CONTEXT, relevant_past_scripts=relevant_past_scripts)
 
                     if plan_text_output_gen.startswith("#LLM_ERR"):
                         print(f"{ERROR_COLOR}{plan_text_output_gen}{RESET_COLOR}")
@@ -1573,6 +5578,9 @@ if __name__ == "__main__":
                             confirm_plan_input = input(f"{WARNING_COLOR}Proceed with this plan? (y/N/edit): {RESET_COLOR}").strip().lower()
                             if confirm_plan_input == 'y':
                                 PLAN_CONFIRMED = True; PLAN_STEP_INDEX = 0;
+                                reset_plan_prefetch_stats()
+                                activate_plan_venv(CURRENT_PLAN_STEPS)
+                                reset_plan_kernel()
                                 # Reset file/buffer for the new plan, unless user explicitly set a file they want to use as base
                                 if not CURRENT_TARGET_FILE: # If user hasn't fixed a file with 'f', plan starts clean.
                                     current_code_buffer = ""